@@ -0,0 +1,269 @@
+"""Reproducible benchmarks for splay_tree.
+
+Runs seeded mixes of insert/find/remove over several key access patterns
+against SplayTree variants and dict and bisect baselines, and writes one JSON
+object per (workload, structure) pair so that results can be compared across
+commits:
+
+  python splay_bench.py --n 100000 --ops 200000 --seed 1 > bench_output.txt
+
+"""
+import argparse
+import bisect
+import gc
+import json
+import platform
+import random
+import sys
+import time
+from splay_tree import SplayTree, CompactNode
+
+try:
+  import tracemalloc
+except ImportError: #Python 2 has no tracemalloc; memory is not reported
+  tracemalloc = None
+
+timer = getattr(time, "perf_counter", time.time)
+
+def uniform(rng, n, count):
+  """Generate keys drawn uniformly from the key space."""
+
+  keyspace = 2*n
+  for i in range(count):
+    yield rng.randrange(keyspace)
+
+def sequential(rng, n, count):
+  """Generate keys in ascending order, wrapping around the key space."""
+
+  keyspace = 2*n
+  for i in range(count):
+    yield i % keyspace
+
+def reverse(rng, n, count):
+  """Generate keys in descending order, wrapping around the key space."""
+
+  keyspace = 2*n
+  for i in range(count):
+    yield keyspace - 1 - i % keyspace
+
+def zipfian(rng, n, count, s=1.0):
+  """Generate keys with Zipf's law: key k is drawn in proportion to 1/k**s.
+
+  Ranks are mapped to keys through a seeded permutation, so the popular keys
+  are spread over the key space instead of clustered at its start.
+
+  """
+  keyspace = 2*n
+  cdf = []
+  total = 0.0
+  for k in range(1, keyspace+1):
+    total += 1.0 / k**s
+    cdf.append(total)
+  keys = list(range(keyspace))
+  rng.shuffle(keys)
+  for i in range(count):
+    yield keys[bisect.bisect_left(cdf, rng.random() * total)]
+
+def workingSet(rng, n, count, size=None, hot=0.9, period=None):
+  """Generate keys from a small working set that moves every period keys.
+
+  A fraction hot of the accesses go to the working set of size keys and
+  the rest are uniform over the key space.
+
+  """
+  keyspace = 2*n
+  size = size or max(1, n // 100)
+  period = period or max(1, count // 10)
+  working = [rng.randrange(keyspace) for j in range(size)]
+  for i in range(count):
+    if i and i % period == 0:
+      working = [rng.randrange(keyspace) for j in range(size)]
+    if rng.random() < hot:
+      yield working[rng.randrange(size)]
+    else:
+      yield rng.randrange(keyspace)
+
+def dynamicFinger(rng, n, count, spread=16.0):
+  """Generate keys by a random walk with small normally distributed steps."""
+
+  keyspace = 2*n
+  key = rng.randrange(keyspace)
+  for i in range(count):
+    key = int(key + rng.gauss(0, spread)) % keyspace
+    yield key
+
+WORKLOADS = {
+  "uniform": uniform,
+  "sequential": sequential,
+  "reverse": reverse,
+  "zipfian": zipfian,
+  "workingSet": workingSet,
+  "dynamicFinger": dynamicFinger,
+}
+
+class DictMap(object):
+  """Baseline wrapper around dict with the SplayTree method names."""
+
+  def __init__(self):
+    """Initialize an empty dict and bind its methods."""
+
+    self.d = {}
+    self.insert = self.d.__setitem__
+    self.find = self.d.get
+    self.remove = lambda key: self.d.pop(key, None)
+
+class BisectMap(object):
+  """Baseline ordered map kept as two sorted lists searched with bisect."""
+
+  def __init__(self):
+    """Initialize empty key and value lists."""
+
+    self.keys = []
+    self.values = []
+
+  def insert(self, key, value):
+    """Insert or overwrite key, shifting the tail of both lists."""
+
+    i = bisect.bisect_left(self.keys, key)
+    if i < len(self.keys) and self.keys[i] == key:
+      self.values[i] = value
+    else:
+      self.keys.insert(i, key)
+      self.values.insert(i, value)
+
+  def find(self, key):
+    """Return the value for key, or None."""
+
+    i = bisect.bisect_left(self.keys, key)
+    if i < len(self.keys) and self.keys[i] == key:
+      return self.values[i]
+
+  def remove(self, key):
+    """Remove key and return its value, or None."""
+
+    i = bisect.bisect_left(self.keys, key)
+    if i < len(self.keys) and self.keys[i] == key:
+      del self.keys[i]
+      return self.values.pop(i)
+
+STRUCTURES = {
+  "splay": SplayTree,
+  "splayTopDown": lambda: SplayTree(topDown=True),
+  "splayCompact": lambda: SplayTree(nodeType=CompactNode),
+  "dict": DictMap,
+  "bisect": BisectMap,
+}
+
+def operations(workload, n, count, seed, mix):
+  """Return the list of (operation, key) pairs of one seeded run.
+
+  mix gives the relative weights of insert, find and remove.
+
+  """
+  rng = random.Random(seed)
+  total = float(sum(mix))
+  cut = (mix[0] / total, (mix[0] + mix[1]) / total)
+  ops = []
+  for key in WORKLOADS[workload](rng, n, count):
+    r = rng.random()
+    ops.append((0 if r < cut[0] else 1 if r < cut[1] else 2, key))
+  return ops
+
+def preload(make, n, seed):
+  """Build a structure holding n uniformly random keys.
+
+  Return the structure and the bytes it allocated per entry, or None where
+  tracemalloc is unavailable.
+
+  """
+  rng = random.Random(seed)
+  keys = [rng.randrange(2*n) for i in range(n)]
+  gc.collect()
+  if tracemalloc:
+    tracemalloc.start()
+  structure = make()
+  for key in keys:
+    structure.insert(key, key)
+  perEntry = None
+  if tracemalloc:
+    perEntry = tracemalloc.get_traced_memory()[0] / float(len(set(keys)))
+    tracemalloc.stop()
+  return structure, perEntry
+
+def run(structure, ops):
+  """Apply ops to structure and return the elapsed seconds."""
+
+  insert, find, remove = structure.insert, structure.find, structure.remove
+  start = timer()
+  for op, key in ops:
+    if op == 1:
+      find(key)
+    elif op == 0:
+      insert(key, key)
+    else:
+      remove(key)
+  return timer() - start
+
+def benchmark(workload, name, n, count, seed, mix, rotations=True):
+  """Run one workload against one structure and return a result dictionary.
+
+  The timed run has no instrumentation. For splay trees the same operations
+  are then replayed on a fresh tree with stats enabled to count rotations.
+
+  """
+  ops = operations(workload, n, count, seed, mix)
+  structure, perEntry = preload(STRUCTURES[name], n, seed)
+  seconds = run(structure, ops)
+  result = {
+    "workload": workload,
+    "structure": name,
+    "n": n,
+    "ops": count,
+    "seed": seed,
+    "mix": list(mix),
+    "seconds": seconds,
+    "opsPerSec": count / seconds if seconds else None,
+    "bytesPerEntry": perEntry,
+    "python": platform.python_version(),
+  }
+  if rotations and isinstance(structure, SplayTree):
+    structure, perEntry = preload(STRUCTURES[name], n, seed)
+    stats = structure.enableStats()
+    run(structure, ops)
+    result.update(rotations=stats.rotations, zig=stats.zig, \
+      zigZig=stats.zigZig, zigZag=stats.zigZag, maxDepth=stats.maxDepth)
+  return result
+
+def main(argv=None):
+  """Parse the command line, run the benchmarks and write JSON lines."""
+
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--n", type=int, default=10000, \
+    help="entries preloaded before timing")
+  parser.add_argument("--ops", type=int, default=50000, \
+    help="operations timed per run")
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--mix", default="10:80:10", \
+    help="insert:find:remove weights")
+  parser.add_argument("--workloads", default=",".join(sorted(WORKLOADS)))
+  parser.add_argument("--structures", default=",".join(sorted(STRUCTURES)))
+  parser.add_argument("--no-rotations", dest="rotations", \
+    action="store_false", help="skip the instrumented replay")
+  parser.add_argument("--output", help="file to write instead of stdout")
+  args = parser.parse_args(argv)
+
+  mix = tuple(float(w) for w in args.mix.split(":"))
+  out = open(args.output, "w") if args.output else sys.stdout
+  try:
+    for workload in args.workloads.split(","):
+      for name in args.structures.split(","):
+        result = benchmark(workload, name, args.n, args.ops, args.seed, mix, \
+          args.rotations)
+        out.write(json.dumps(result, sort_keys=True) + "\n")
+        out.flush()
+  finally:
+    if args.output:
+      out.close()
+
+if __name__ == "__main__":
+  main()
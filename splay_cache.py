@@ -0,0 +1,153 @@
+import collections
+import functools
+from splay_tree import SplayTree
+
+CacheInfo = collections.namedtuple("CacheInfo", \
+  ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+class SplayCache(object):
+  """Splay Cache object.
+
+  A bounded dictionary on top of a SplayTree. Every lookup and store splays
+  its key to the root, so recently used keys gather near the top of the tree
+  and keys that have not been touched for a while sink towards the leaves.
+  When the cache is full, evict() removes a leaf at the end of the heavy path
+  from the root, the path that always descends into the larger subtree,
+  which is where the coldest entries collect. Unlike functools.lru_cache the
+  entries stay in key order and can be scanned with items() or irange().
+
+  Member Variables:
+    maxsize the number of entries the cache holds before evicting; None for
+      an unbounded cache.
+    hits the number of lookups that found their key.
+    misses the number of lookups that did not find their key.
+    evictions the number of entries removed to make room.
+    _tree the SplayTree holding the entries, with order statistics enabled.
+
+  """
+
+  def __init__(self, maxsize=128, **options):
+    """Initialize an empty cache; options are passed to the SplayTree."""
+
+    if maxsize is not None and maxsize < 1:
+      raise ValueError("maxsize must be positive or None")
+    self.maxsize = maxsize
+    self.hits = self.misses = self.evictions = 0
+    options["orderStatistics"] = True
+    self._tree = SplayTree(**options)
+
+  def __len__(self):
+    """Return the number of entries in the cache."""
+
+    return len(self._tree)
+
+  def __contains__(self, key):
+    """Determine if key is cached, without counting a hit or miss."""
+
+    key = self._sortKey(key)
+    root = self._tree._splayKey(key)
+    return bool(root) and root.key == key
+
+  def _sortKey(self, key):
+    """Return the key the tree orders key by; see SplayTree(key=...)."""
+
+    return self._tree._key(key) if self._tree._key else key
+
+  def get(self, key, default=None):
+    """Return the cached value for key, or default, counting a hit or miss.
+
+    Unlike SplayTree.find(), a cached value of None is told apart from a
+    missing key.
+
+    """
+    key = self._sortKey(key)
+    root = self._tree._splayKey(key)
+    if root and root.key == key:
+      self.hits += 1
+      return root.value
+    self.misses += 1
+    return default
+
+  def put(self, key, value):
+    """Cache value under key, evicting a cold entry if the cache is full."""
+
+    self._tree.insert(key, value)
+    if self.maxsize is not None and len(self._tree) > self.maxsize:
+      self.evict()
+
+  def remove(self, key):
+    """Remove key from the cache and return its value; see remove()."""
+
+    return self._tree.remove(key)
+
+  def evict(self):
+    """Remove a cold entry from the cache and return its (key, value) pair.
+
+    The heavy path is followed from the root down to a leaf using the subtree
+    sizes, and that leaf is removed with SplayTree.remove(). The removal
+    splays the leaf's parent, which pays for the walk, so eviction runs in
+    O(log(n)) amortized time. Return None if the cache is empty.
+
+    """
+    node = self._tree._root
+    if not node:
+      return
+    while node.left or node.right:
+      if not node.right or (node.left and node.left.size > node.right.size):
+        node = node.left
+      else:
+        node = node.right
+    key, value = self._tree._itemOf(node), node.value
+    self._tree.remove(key)
+    self.evictions += 1
+    return (key, value)
+
+  def clear(self):
+    """Remove every entry and reset the counters."""
+
+    self._tree = self._tree._emptyLike()
+    self.hits = self.misses = self.evictions = 0
+
+  def info(self):
+    """Return a CacheInfo of the counters and the current size."""
+
+    return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, \
+      len(self._tree))
+
+  def items(self):
+    """Iterate over the cached (key, value) pairs in key order."""
+
+    return self._tree.items()
+
+  def irange(self, lo=None, hi=None, inclusive=(True, True)):
+    """Iterate over the cached keys between lo and hi; see irange()."""
+
+    return self._tree.irange(lo, hi, inclusive)
+
+def splayCached(maxsize=128, **options):
+  """Decorate a function to memoize its results in a SplayCache.
+
+  A drop-in alternative to functools.lru_cache. The cache key is the tuple
+  of positional arguments followed by the sorted keyword arguments, so
+  arguments must be comparable with each other rather than hashable. The
+  decorated function gains cache, cacheInfo() and cacheClear() attributes.
+
+  """
+  def decorator(function):
+    cache = SplayCache(maxsize, **options)
+    missing = object()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      key = (args, tuple(sorted(kwargs.items())))
+      value = cache.get(key, missing)
+      if value is missing:
+        value = function(*args, **kwargs)
+        cache.put(key, value)
+      return value
+
+    wrapper.cache = cache
+    wrapper.cacheInfo = cache.info
+    wrapper.cacheClear = cache.clear
+    return wrapper
+  return decorator
@@ -0,0 +1,348 @@
+import heapq
+import threading
+from splay_tree import SplayTree
+
+try:
+  import numpy
+except ImportError: #NumPy is optional; HybridSplayMap is unavailable
+  numpy = None
+
+#Marks a key removed in the delta while the base run may still hold it.
+_TOMBSTONE = object()
+
+class HybridSplayMap(object):
+  """Hybrid Splay Map object.
+
+  A map from numeric keys to values, laid out like a two level log
+  structured merge tree. The bulk of the entries lives in a base run: a
+  sorted NumPy array of keys and a parallel array of values, which costs a
+  few bytes per entry and is searched with numpy.searchsorted(). Writes go to
+  a small SplayTree delta instead, where a removal of a key of the base run
+  is kept as a tombstone. Lookups check the delta first, so recently written
+  keys are found near the top of the splay tree, and fall back to the base.
+
+  Once the delta holds threshold entries it is compacted: its entries are
+  merged into a new base run in O(n + m) time for n base and m delta
+  entries. With background set, the full delta is frozen into sorted arrays
+  and replaced by an empty one, and the merge runs in a thread while writes
+  carry on into the new delta; lookups consult the frozen arrays until the
+  new base is in place.
+
+  Member Variables:
+    threshold the number of delta entries that triggers a compaction.
+    background whether compactions merge in a background thread.
+    _delta the SplayTree of recent writes, mapping keys to values or to
+      _TOMBSTONE.
+    _layers a pair (frozen, base), replaced as a whole so that readers see a
+      consistent pair. base is a (keys, values) pair of arrays and frozen,
+      the delta being merged in the background, is a (keys, values, dead)
+      triple of arrays, or None.
+    _size the number of live entries.
+    _merger the thread running a background merge, or None.
+    _lock guards starting and finishing a background merge.
+
+  """
+
+  def __init__(self, keys=(), values=(), threshold=4096, background=False,
+               dtype=None, valueDtype=object, **options):
+    """Initialize a map whose base run holds the given keys and values.
+
+    keys and values are parallel sequences or arrays, in any order; the
+    last value of a repeated key wins. dtype and valueDtype are the NumPy
+    types of the base run's arrays; dtype defaults to the type NumPy infers
+    for keys, float64 if there are none, and every key written later must be
+    representable in it. Any other keyword arguments are passed to the
+    SplayTree delta, except key, since the base run orders the keys
+    themselves.
+
+    """
+    if numpy is None:
+      raise ImportError("HybridSplayMap needs numpy")
+    if options.get("key"):
+      raise ValueError("hybrid maps do not support a key function")
+    if threshold < 1:
+      raise ValueError("threshold must be positive")
+    keys = numpy.asarray(keys, dtype=dtype)
+    values = _objects(values, valueDtype)
+    if len(keys) != len(values):
+      raise ValueError("keys and values differ in length")
+    order = numpy.argsort(keys, kind="stable")
+    keys, values = keys[order], values[order]
+    if len(keys):
+      last = numpy.append(keys[1:] != keys[:-1], True)
+      keys, values = keys[last], values[last]
+    self.threshold = threshold
+    self.background = background
+    self._options = options
+    self._delta = SplayTree(**options)
+    self._layers = (None, (keys, values))
+    self._size = len(keys)
+    self._merger = None
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    """Return the number of entries in the map."""
+
+    return self._size
+
+  def _lookup(self, key):
+    """Return the value for key, or _TOMBSTONE if it is missing or removed.
+
+    Helper function that checks the delta, splaying it, then the frozen
+    delta and then the base run.
+
+    """
+    node = self._delta._findNode(key)
+    if node:
+      return node.value
+    frozen, base = self._layers
+    for layer in (frozen, base):
+      if layer is None:
+        continue
+      keys, values = layer[0], layer[1]
+      i = numpy.searchsorted(keys, key)
+      if i < len(keys) and keys[i] == key:
+        if layer is frozen and frozen[2][i]:
+          return _TOMBSTONE
+        return values[i]
+    return _TOMBSTONE
+
+  def find(self, key):
+    """Return the value for key, or None; see SplayTree.find()."""
+
+    value = self._lookup(key)
+    if value is not _TOMBSTONE:
+      return value
+
+  def __contains__(self, key):
+    """Determine if a given key is within the map."""
+
+    return self._lookup(key) is not _TOMBSTONE
+
+  def insert(self, key, value):
+    """Insert an item into the delta, compacting it once it is full.
+
+    Raise ValueError if key cannot be stored exactly in the base run's key
+    type, such as 2.5 in an integer run, since compaction would otherwise
+    change it.
+
+    """
+    self._checkKey(key)
+    if self._lookup(key) is _TOMBSTONE:
+      self._size += 1
+    self._delta.insert(key, value)
+    self._compactIfFull()
+
+  def _checkKey(self, key):
+    """Raise ValueError unless key survives a cast to the base key type."""
+
+    dtype = self._layers[1][0].dtype
+    try:
+      fits = numpy.asarray(key, dtype=dtype).item() == key
+    except (TypeError, ValueError, OverflowError):
+      fits = False
+    if not fits:
+      raise ValueError("key %r does not fit the key type %s" % (key, dtype))
+
+  def remove(self, key):
+    """Remove key from the map and return its value, or None.
+
+    The key is dropped from the delta, and a tombstone is left in its place
+    if an older layer may still hold it.
+
+    """
+    value = self._lookup(key)
+    if value is _TOMBSTONE:
+      return
+    self._size -= 1
+    frozen, base = self._layers
+    if _holds(base, key) or _holds(frozen, key):
+      self._delta.insert(key, _TOMBSTONE)
+      self._compactIfFull()
+    else:
+      self._delta.remove(key)
+    return value
+
+  def insertMany(self, items):
+    """Insert every (key, value) pair; see insert()."""
+
+    for key, value in items:
+      self.insert(key, value)
+
+  def findMany(self, keys, default=None):
+    """Return an array of the values for the given keys.
+
+    keys is an array or sequence of keys. Each layer is searched for all of
+    them at once with numpy.searchsorted(), and the delta is searched in
+    the same way through a sorted copy of its entries, so the batch runs in
+    O(m log(n) + d) time for m keys and d delta entries without a Python
+    level loop over the base. Missing keys give default. The array has the
+    base run's value type, or object type if default is None.
+
+    """
+    keys = numpy.asarray(keys)
+    frozen, base = self._layers
+    valueDtype = base[1].dtype if default is not None else object
+    result = numpy.full(len(keys), default, dtype=valueDtype)
+    _probe(result, keys, base[0], base[1])
+    if frozen is not None:
+      _probe(result, keys, frozen[0], frozen[1], frozen[2], default)
+    if len(self._delta):
+      delta = self._frozenDelta(self._delta)
+      _probe(result, keys, delta[0], delta[1], delta[2], default)
+    return result
+
+  def items(self):
+    """Iterate over the (key, value) pairs of the map in ascending order.
+
+    The layers are merged on the fly; a key in a newer layer hides the same
+    key in the older ones. See SplayTree.__iter__ for the caveats on
+    modification.
+
+    """
+    frozen, base = self._layers
+    layers = [((key, 0, value) for key, value in self._delta.items())]
+    if frozen is not None:
+      layers.append(((key, 1, _TOMBSTONE if dead else value) for key, value, \
+        dead in zip(frozen[0].tolist(), frozen[1], frozen[2].tolist())))
+    layers.append(((key, 2, value) for key, value in \
+      zip(base[0].tolist(), base[1])))
+    previous = _TOMBSTONE
+    for key, layer, value in heapq.merge(*layers):
+      if previous is not _TOMBSTONE and key == previous:
+        continue
+      previous = key
+      if value is not _TOMBSTONE:
+        yield (key, value)
+
+  def __iter__(self):
+    """Iterate over the keys of the map in ascending order."""
+
+    for key, value in self.items():
+      yield key
+
+  def compact(self):
+    """Merge the delta into the base run now and wait for it to finish."""
+
+    self.wait()
+    frozen = self._freeze()
+    if frozen is not None:
+      self._merge(frozen)
+
+  def wait(self):
+    """Wait for a background merge, if one is running, to finish."""
+
+    merger = self._merger
+    if merger is not None:
+      merger.join()
+
+  def _compactIfFull(self):
+    """Start a compaction if the delta has reached the threshold."""
+
+    if len(self._delta) < self.threshold:
+      return
+    if not self.background:
+      self.compact()
+      return
+    with self._lock:
+      if self._merger is not None: #the next merge picks up the rest
+        return
+      frozen = self._freeze()
+      self._merger = threading.Thread(target=self._merge, args=(frozen,))
+      self._merger.daemon = True
+      self._merger.start()
+
+  def _freeze(self):
+    """Swap in an empty delta and return the full one as sorted arrays.
+
+    Helper function that publishes the frozen arrays as the middle layer so
+    that lookups keep finding the delta's entries during the merge. Return
+    None if the delta is empty.
+
+    """
+    if not len(self._delta):
+      return
+    frozen = self._frozenDelta(self._delta)
+    self._delta = SplayTree(**self._options)
+    self._layers = (frozen, self._layers[1])
+    return frozen
+
+  def _frozenDelta(self, delta):
+    """Return the (keys, values, dead) arrays of a delta's entries."""
+
+    items = list(delta.items())
+    base = self._layers[1]
+    keys = numpy.array([key for key, value in items], dtype=base[0].dtype)
+    values = _objects([value for key, value in items], object)
+    dead = numpy.array([value is _TOMBSTONE for key, value in items], \
+      dtype=bool)
+    return keys, values, dead
+
+  def _merge(self, frozen):
+    """Merge the frozen delta into the base run and publish the result.
+
+    Only arrays are read here, never the live delta, so the merge can run in
+    a background thread while the map is written.
+
+    """
+    keys, values = self._layers[1]
+    newKeys, newValues, dead = frozen
+    if len(keys): #drop the base entries the delta replaces or removes
+      i = numpy.minimum(numpy.searchsorted(keys, newKeys), len(keys) - 1)
+      keep = numpy.ones(len(keys), dtype=bool)
+      keep[i[keys[i] == newKeys]] = False
+      keys, values = keys[keep], values[keep]
+    live = ~dead
+    newKeys = newKeys[live]
+    newValues = newValues[live].astype(values.dtype)
+    at = numpy.searchsorted(keys, newKeys)
+    keys = numpy.insert(keys, at, newKeys)
+    values = numpy.insert(values, at, newValues)
+    with self._lock:
+      self._layers = (None, (keys, values))
+      self._merger = None
+
+def _objects(values, dtype):
+  """Return values as a one dimensional NumPy array of the given type.
+
+  Helper function that fills an empty array element by element when dtype
+  is object, so that values which are sequences themselves are kept whole.
+
+  """
+  if isinstance(values, numpy.ndarray) and values.dtype == dtype:
+    return values
+  if numpy.dtype(dtype) != object:
+    return numpy.asarray(values, dtype=dtype)
+  values = list(values)
+  array = numpy.empty(len(values), dtype=object)
+  array[:] = values
+  return array
+
+def _holds(layer, key):
+  """Return whether a frozen delta or base layer has an entry for key."""
+
+  if layer is None:
+    return False
+  keys = layer[0]
+  i = numpy.searchsorted(keys, key)
+  return bool(i < len(keys) and keys[i] == key)
+
+def _probe(result, keys, layerKeys, layerValues, dead=None, default=None):
+  """Overwrite result with a layer's values for the keys the layer holds.
+
+  Helper function for findMany(). Keys the layer marks dead are reset to
+  default, since they were removed after the older layers were written.
+
+  """
+  if not len(layerKeys):
+    return
+  i = numpy.searchsorted(layerKeys, keys)
+  i = numpy.minimum(i, len(layerKeys) - 1)
+  hit = layerKeys[i] == keys
+  if dead is None:
+    result[hit] = layerValues[i[hit]]
+    return
+  removed = hit & dead[i]
+  hit &= ~dead[i]
+  result[hit] = layerValues[i[hit]]
+  result[removed] = default
@@ -0,0 +1,385 @@
+import os
+import pickle
+import struct
+import threading
+import zlib
+from splay_tree import SplayTree
+
+#A journal file is a sequence of records, one per insert or remove. A record
+#is a header holding the length and the CRC-32 of its payload, followed by the
+#payload, the pickled (opcode, key, value) triple. A record cut short by a
+#crash, or whose checksum does not match, ends the journal.
+RECORD = struct.Struct("<II")
+INSERT, REMOVE = 1, 2
+
+#The fsync policies of JournaledSplayTree; see its constructor.
+SYNC_ALWAYS, SYNC_INTERVAL, SYNC_GROUP = "always", "interval", "group"
+
+_replace = getattr(os, "replace", os.rename) #Python 2 has no os.replace()
+
+class JournaledSplayTree(object):
+  """Journaled Splay Tree object.
+
+  A SplayTree whose contents survive a crash. Every insert and remove is
+  appended to a journal file before it returns, and on startup the tree is
+  rebuilt from the most recent checkpoint, a file written by
+  SplayTree.dump(), by replaying the journal written after it. Once the
+  journal grows past checkpointBytes, a new checkpoint is written in a
+  background thread from a SplayTree.snapshot() of the tree, so writers
+  carry on while it is written, and the journal it replaces is deleted.
+
+  The directory holds checkpoint.N files, each holding every write made
+  before journal.N, and the journal.N files themselves; a checkpoint is only
+  renamed into place once it is complete, so a crash at any point leaves a
+  checkpoint and the journals after it.
+
+  Reads go straight to the tree; writes must go through this object to be
+  journaled. Keys and values must be picklable.
+
+  Member Variables:
+    tree the SplayTree holding the entries.
+    path the directory holding the checkpoints and journals.
+    sync the fsync policy: SYNC_ALWAYS, SYNC_INTERVAL or SYNC_GROUP.
+    interval the seconds between fsyncs under SYNC_INTERVAL.
+    checkpointBytes the journal size that starts a background checkpoint.
+    _seq the number of the journal being written.
+    _fd the file descriptor of the journal being written.
+    _written the number of bytes journaled since the last checkpoint began.
+    _pending the records not yet written under SYNC_GROUP.
+    _dirty whether records were written since the last fsync.
+    _lock guards _fd and _dirty against the flusher and checkpointer.
+    _flusher the thread doing SYNC_INTERVAL fsyncs, or None.
+    _closed set once the journal is closed, which stops the flusher.
+    _checkpointer the thread writing a checkpoint, or None.
+    _view the SplayView being written by the checkpointer, released only by
+      this thread so that the tree is never touched by another.
+
+  """
+
+  def __init__(self, path, sync=SYNC_ALWAYS, interval=0.05,
+               checkpointBytes=64 << 20, **options):
+    """Open the journaled tree in the directory path, creating it if needed.
+
+    sync is the fsync policy. With SYNC_ALWAYS every insert() and remove()
+    is synced to disk before it returns. With SYNC_INTERVAL records are
+    handed to the operating system at once, which survives the process
+    crashing, and a background thread syncs them every interval seconds,
+    so a power failure loses at most that much. With SYNC_GROUP records are
+    kept in memory until commit() writes and syncs them as one group. Under
+    every policy a batch from insertMany() or removeMany() is written as one
+    group with a single fsync. Keyword arguments are passed on to the
+    SplayTree.
+
+    """
+    if sync not in (SYNC_ALWAYS, SYNC_INTERVAL, SYNC_GROUP):
+      raise ValueError("unknown sync policy %r" % (sync,))
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self.path = path
+    self.sync = sync
+    self.interval = interval
+    self.checkpointBytes = checkpointBytes
+    self._pending = []
+    self._dirty = False
+    self._lock = threading.Lock()
+    self._closed = threading.Event()
+    self._checkpointer = self._view = None
+    self.tree = self._recover(options)
+    self._fd = os.open(self._file("journal", self._seq), \
+      os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0))
+    self._written = os.fstat(self._fd).st_size
+    self._flusher = None
+    if sync == SYNC_INTERVAL:
+      self._flusher = threading.Thread(target=self._flush)
+      self._flusher.daemon = True
+      self._flusher.start()
+
+  def _file(self, kind, seq):
+    """Return the path of the checkpoint or journal file numbered seq."""
+
+    return os.path.join(self.path, "%s.%08d" % (kind, seq))
+
+  def _recover(self, options):
+    """Load the latest checkpoint, replay the journals and return the tree.
+
+    Helper function for the constructor. A torn record at the end of a
+    journal is cut off, and files that the checkpoint makes redundant,
+    including a checkpoint that was never finished, are deleted.
+
+    """
+    checkpoints, journals = [], []
+    for name in os.listdir(self.path):
+      kind, dot, seq = name.partition(".")
+      if kind == "checkpoint" and seq.isdigit():
+        checkpoints.append(int(seq))
+      elif kind == "journal" and seq.isdigit():
+        journals.append(int(seq))
+      elif kind == "checkpoint" and seq.endswith(".tmp"):
+        os.remove(os.path.join(self.path, name))
+    start = max(checkpoints) if checkpoints else 0
+    if checkpoints:
+      tree = SplayTree.load(self._file("checkpoint", start), **options)
+    else:
+      tree = SplayTree(**options)
+    for seq in sorted(journals):
+      if seq >= start:
+        self._replay(self._file("journal", seq), tree)
+    for seq in checkpoints:
+      if seq < start:
+        os.remove(self._file("checkpoint", seq))
+    for seq in journals:
+      if seq < start:
+        os.remove(self._file("journal", seq))
+    self._seq = max([start] + journals)
+    return tree
+
+  def _replay(self, path, tree):
+    """Apply the records of the journal at path to tree, in order."""
+
+    with open(path, "rb") as f:
+      data = f.read()
+    position = 0
+    while position + RECORD.size <= len(data):
+      length, crc = RECORD.unpack_from(data, position)
+      payload = data[position+RECORD.size:position+RECORD.size+length]
+      if len(payload) < length or zlib.crc32(payload) & 0xFFFFFFFF != crc:
+        break
+      op, key, value = pickle.loads(payload)
+      if op == INSERT:
+        tree.insert(key, value)
+      else:
+        tree.remove(key)
+      position += RECORD.size + length
+    if position < len(data): #cut off a record torn by a crash
+      with open(path, "r+b") as f:
+        f.truncate(position)
+
+  def __len__(self):
+    """Return the number of entries in the tree."""
+
+    return len(self.tree)
+
+  def find(self, key):
+    """Return the value for key, or None; see SplayTree.find()."""
+
+    self._release()
+    return self.tree.find(key)
+
+  def __contains__(self, key):
+    """Determine if a given key is within the tree."""
+
+    self._release()
+    return key in self.tree
+
+  def __iter__(self):
+    """Iterate over the keys of the tree in ascending order."""
+
+    return iter(self.tree)
+
+  def items(self):
+    """Iterate over the (key, value) pairs of the tree in ascending order."""
+
+    return self.tree.items()
+
+  def insert(self, key, value):
+    """Apply an insert and then journal it; see SplayTree.insert().
+
+    The record is pickled first and only written once the tree has taken
+    the entry, so a key or value that either one rejects never reaches the
+    journal.
+
+    """
+    record = self._record(INSERT, key, value)
+    self.tree.insert(key, value)
+    self._log([record])
+    self._checkpointIfFull()
+
+  def remove(self, key):
+    """Remove key and journal the removal if it was present; see remove()."""
+
+    size = len(self.tree)
+    value = self.tree.remove(key)
+    if len(self.tree) != size:
+      self._log([self._record(REMOVE, key, None)])
+      self._checkpointIfFull()
+    return value
+
+  def insertMany(self, items):
+    """Insert every (key, value) pair, journaled as one group.
+
+    If the tree rejects a pair, the pairs before it, which the tree has
+    already taken, are still journaled before the error is raised.
+
+    """
+    items = list(items)
+    records = [self._record(INSERT, key, value) for key, value in items]
+    applied = [0]
+    def accepted():
+      for item in items:
+        yield item
+        applied[0] += 1 #only resumed once the tree has taken item
+    try:
+      self.tree.insertMany(accepted())
+    finally:
+      self._log(records[:applied[0]], True)
+    self._checkpointIfFull()
+
+  def removeMany(self, keys):
+    """Remove the given keys and return their values, journaled as a group."""
+
+    records = []
+    values = []
+    try:
+      for key in keys:
+        size = len(self.tree)
+        values.append(self.tree.remove(key))
+        if len(self.tree) != size:
+          records.append(self._record(REMOVE, key, None))
+    finally:
+      self._log(records, True)
+    self._checkpointIfFull()
+    return values
+
+  def commit(self):
+    """Write and sync every pending record; a no-op unless SYNC_GROUP."""
+
+    if self._pending:
+      records, self._pending = self._pending, []
+      self._write(b"".join(records), True)
+
+  def _record(self, op, key, value):
+    """Return the bytes of one journal record."""
+
+    payload = pickle.dumps((op, key, value), 2)
+    return RECORD.pack(len(payload), zlib.crc32(payload) & 0xFFFFFFFF) + \
+      payload
+
+  def _log(self, records, group=False):
+    """Journal records under the sync policy; group syncs them as one batch."""
+
+    self._written += sum(len(record) for record in records)
+    if self.sync == SYNC_GROUP:
+      self._pending.extend(records)
+      if group:
+        self.commit()
+    elif records:
+      self._write(b"".join(records), self.sync == SYNC_ALWAYS)
+
+  def _checkpointIfFull(self):
+    """Start a checkpoint once the journal has grown past checkpointBytes.
+
+    Helper function for the writes, called once a write has been applied to
+    the tree, so that the checkpoint holds every record of the journals it
+    replaces. A finished checkpoint's view is released here first, so the
+    tree stops copying nodes at the first write after the checkpoint.
+
+    """
+    self._release()
+    if self._written > self.checkpointBytes:
+      self.checkpoint()
+
+  def _write(self, data, sync):
+    """Append data to the journal, syncing it to disk if sync is set."""
+
+    with self._lock:
+      while data:
+        data = data[os.write(self._fd, data):]
+      if sync:
+        _fsync(self._fd)
+      else:
+        self._dirty = True
+
+  def _flush(self):
+    """Sync the journal every interval seconds until it is closed."""
+
+    while not self._closed.wait(self.interval):
+      with self._lock:
+        if self._dirty:
+          _fsync(self._fd)
+          self._dirty = False
+
+  def checkpoint(self, wait=False):
+    """Start writing a checkpoint of the tree in a background thread.
+
+    The journal is synced and a new one started, and a SplayTree.snapshot()
+    of the tree is written to the new checkpoint while writes go on into the
+    new journal. Once the checkpoint is safely on disk, the checkpoints and
+    journals before it are deleted. Nothing is started while a checkpoint
+    is still being written. If wait is set, return once it is done.
+
+    """
+    self._release()
+    if self._checkpointer is None:
+      self.commit()
+      with self._lock:
+        _fsync(self._fd)
+        self._dirty = False
+        os.close(self._fd)
+        self._seq += 1
+        self._fd = os.open(self._file("journal", self._seq), os.O_WRONLY | \
+          os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0))
+        self._written = 0
+      self._view = self.tree.snapshot()
+      self._checkpointer = threading.Thread(target=self._writeCheckpoint, \
+        args=(self._view, self._seq))
+      self._checkpointer.daemon = True
+      self._checkpointer.start()
+    if wait:
+      self._checkpointer.join()
+      self._release()
+
+  def _release(self):
+    """Drop the checkpointer and its view once the checkpoint is written.
+
+    Releasing the last reference to a view lets the tree stop copying nodes,
+    which must happen on the thread that writes the tree.
+
+    """
+    if self._checkpointer is not None and not self._checkpointer.is_alive():
+      self._checkpointer = self._view = None
+
+  def _writeCheckpoint(self, view, seq):
+    """Write view as checkpoint seq, then delete what it makes redundant."""
+
+    path = self._file("checkpoint", seq)
+    with open(path + ".tmp", "wb") as f:
+      f.write(view._snapshotBytes(False))
+      f.flush()
+      _fsync(f.fileno())
+    _replace(path + ".tmp", path)
+    _syncDirectory(self.path)
+    for name in os.listdir(self.path):
+      kind, dot, number = name.partition(".")
+      if kind in ("checkpoint", "journal") and number.isdigit() and \
+         int(number) < seq:
+        os.remove(os.path.join(self.path, name))
+
+  def close(self):
+    """Commit pending records, finish any checkpoint and close the journal."""
+
+    self.commit()
+    if self._checkpointer is not None:
+      self._checkpointer.join()
+      self._release()
+    self._closed.set()
+    if self._flusher is not None:
+      self._flusher.join()
+    with self._lock:
+      _fsync(self._fd)
+      os.close(self._fd)
+
+def _fsync(fd):
+  """Sync a file's data to disk, without its metadata where possible."""
+
+  getattr(os, "fdatasync", os.fsync)(fd)
+
+def _syncDirectory(path):
+  """Sync a directory so that a rename into it survives a crash."""
+
+  if not hasattr(os, "O_DIRECTORY"): #Windows cannot open directories
+    return
+  fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
@@ -0,0 +1,333 @@
+"""Asyncio key-value server and client around a single SplayTree.
+
+Python 3 only. Keys, values and results travel pickled, so a server must only
+listen where trusted local clients can reach it: a Unix socket or localhost.
+
+"""
+import asyncio
+import itertools
+import pickle
+import struct
+from splay_tree import SplayTree
+
+#Every frame is a header followed by a pickled payload. A request header holds
+#the payload length, a request id chosen by the client and an opcode, and the
+#payload is the tuple of arguments. A response header holds the payload length,
+#the id of the request it answers and a status, and the payload is the result
+#or the exception that was raised. Clients may send any number of requests
+#before reading the responses.
+FRAME = struct.Struct("<IIB")
+INSERT, FIND, REMOVE, RANGE, LEN = range(1, 6)
+OK, ERROR = 0, 1
+
+class SplayServer(object):
+  """Splay Server object.
+
+  Serves one SplayTree to any number of connections. Connection handlers only
+  parse frames and queue the requests; a single owner task takes everything
+  that was queued during an event loop tick as one batch and applies it to
+  the tree, so the tree needs no lock. Consecutive inserts and finds in a
+  batch run as one sorted insertMany() or findMany(), which keeps the order
+  of the requests but lets nearby keys share their searches. If a run
+  raises, its requests are applied again one at a time, which is harmless
+  for inserts and finds; removes are always applied one at a time, since a
+  removal that was applied twice would answer None.
+
+  Member Variables:
+    tree the SplayTree being served.
+    requests the number of requests applied so far.
+    batches the number of batches the requests were applied in.
+    _queue the queue of (writer, request id, opcode, arguments) requests.
+    _server the asyncio server accepting connections, once started.
+    _owner the task applying batches to the tree, once started.
+    _writers the set of StreamWriters of the open connections.
+
+  """
+
+  def __init__(self, tree=None, **options):
+    """Initialize a server for tree, or a new SplayTree built with options."""
+
+    self.tree = tree if tree is not None else SplayTree(**options)
+    self.requests = self.batches = 0
+    self._queue = self._server = self._owner = None
+    self._writers = set()
+
+  async def start(self, path=None, host="127.0.0.1", port=0):
+    """Listen on the Unix socket at path, or on host and port.
+
+    Return the address the server listens on; port 0 picks a free port.
+
+    """
+    self._queue = asyncio.Queue()
+    self._owner = asyncio.ensure_future(self._run())
+    if path:
+      self._server = await asyncio.start_unix_server(self._serve, path)
+    else:
+      self._server = await asyncio.start_server(self._serve, host, port)
+    return self._server.sockets[0].getsockname()
+
+  async def close(self):
+    """Stop accepting connections, close the open ones and stop the owner.
+
+    Open connections are closed first, since from Python 3.12 wait_closed()
+    also waits for every connection to finish.
+
+    """
+    self._server.close()
+    for writer in list(self._writers):
+      writer.close()
+    await self._server.wait_closed()
+    self._owner.cancel()
+    try:
+      await self._owner
+    except asyncio.CancelledError:
+      pass
+
+  async def _serve(self, reader, writer):
+    """Read the frames of one connection and queue them for the owner.
+
+    Before each request is read, the connection's responses are drained
+    down to the transport's high-water mark, so a client that does not read
+    its responses stops being served instead of growing the server's
+    buffers without limit. Other connections are not held up.
+
+    """
+    self._writers.add(writer)
+    try:
+      while True:
+        await writer.drain()
+        length, requestId, op = \
+          FRAME.unpack(await reader.readexactly(FRAME.size))
+        args = pickle.loads(await reader.readexactly(length))
+        self._queue.put_nowait((writer, requestId, op, args))
+    except (asyncio.IncompleteReadError, ConnectionError):
+      pass
+    finally:
+      self._writers.discard(writer)
+      writer.close()
+
+  async def _run(self):
+    """Apply the queued requests to the tree one batch at a time."""
+
+    queue = self._queue
+    while True:
+      batch = [await queue.get()]
+      await asyncio.sleep(0) #let the other connections read this tick
+      while not queue.empty():
+        batch.append(queue.get_nowait())
+      self.batches += 1
+      self.requests += len(batch)
+      for op, run in itertools.groupby(batch, key=lambda request: request[2]):
+        run = list(run)
+        if op == REMOVE: #a removal applied twice would answer None
+          results = [self._applyOne(op, request[3]) for request in run]
+        else:
+          try:
+            results = [(OK, result) for result in \
+              self._apply(op, [request[3] for request in run])]
+          except Exception: #retrying an insert or find does no harm
+            results = [self._applyOne(op, request[3]) for request in run]
+        for (writer, requestId, op, args), (status, result) in \
+            zip(run, results):
+          self._respond(writer, requestId, status, result)
+
+  def _apply(self, op, batch):
+    """Apply a run of requests with the same opcode; return their results."""
+
+    tree = self.tree
+    if op == INSERT:
+      tree.insertMany(batch, sort=True)
+      return [None] * len(batch)
+    elif op == FIND:
+      return tree.findMany([args[0] for args in batch], sort=True)
+    elif op == REMOVE:
+      return tree.removeMany([args[0] for args in batch], sort=True)
+    elif op == RANGE:
+      itemOf = tree._itemOf
+      return [[(itemOf(node), node.value) for node in \
+        tree._rangeNodes(lo, hi, inclusive)] for lo, hi, inclusive in batch]
+    elif op == LEN:
+      return [len(tree)] * len(batch)
+    raise ValueError("unknown opcode %d" % op)
+
+  def _applyOne(self, op, args):
+    """Apply a single request; return its status and result or exception.
+
+    Helper function for a run that raised, so that only the requests that
+    fail get an error.
+
+    """
+    try:
+      return (OK, self._apply(op, [args])[0])
+    except Exception as e:
+      return (ERROR, e)
+
+  def _respond(self, writer, requestId, status, result):
+    """Write a response frame unless the connection has gone away."""
+
+    if writer.is_closing():
+      return
+    try:
+      payload = pickle.dumps(result, 2)
+    except Exception as e:
+      status, payload = ERROR, pickle.dumps(RuntimeError(str(e)), 2)
+    writer.write(FRAME.pack(len(payload), requestId, status) + payload)
+
+class SplayClient(object):
+  """Splay Client object.
+
+  An async client holding a pool of connections to a SplayServer. Each call
+  goes to the connection with the fewest requests in flight and is pipelined
+  behind them, so any number of tasks can share one client without waiting
+  for each other's round trips. Exceptions raised by the tree on the server
+  are raised again by the call that caused them.
+
+  Member Variables:
+    _connections the list of _Connection objects in the pool.
+
+  """
+
+  def __init__(self, connections):
+    """Initialize a client over already open connections; see connect()."""
+
+    self._connections = connections
+
+  @classmethod
+  async def connect(cls, path=None, host="127.0.0.1", port=None, size=4):
+    """Open a pool of size connections to the server at path or host:port."""
+
+    connections = []
+    for i in range(size):
+      if path:
+        reader, writer = await asyncio.open_unix_connection(path)
+      else:
+        reader, writer = await asyncio.open_connection(host, port)
+      connections.append(_Connection(reader, writer))
+    return cls(connections)
+
+  async def close(self):
+    """Close every connection in the pool."""
+
+    for connection in self._connections:
+      await connection.close()
+
+  def _request(self, op, args):
+    """Send a request on the least busy connection; return its future."""
+
+    connection = min(self._connections, key=lambda c: len(c.pending))
+    return connection.request(op, args)
+
+  async def insert(self, key, value):
+    """Insert an item into the served tree; see SplayTree.insert()."""
+
+    return await self._request(INSERT, (key, value))
+
+  async def find(self, key):
+    """Return the value for key, or None; see SplayTree.find()."""
+
+    return await self._request(FIND, (key,))
+
+  async def remove(self, key):
+    """Remove key and return its value, or None; see SplayTree.remove()."""
+
+    return await self._request(REMOVE, (key,))
+
+  async def range(self, lo=None, hi=None, inclusive=(True, True)):
+    """Return the list of (key, value) pairs with keys between lo and hi."""
+
+    return await self._request(RANGE, (lo, hi, tuple(inclusive)))
+
+  async def length(self):
+    """Return the number of entries in the served tree."""
+
+    return await self._request(LEN, ())
+
+  async def insertMany(self, items):
+    """Insert every (key, value) pair, sending them all before waiting."""
+
+    await asyncio.gather(*[self._request(INSERT, tuple(item)) \
+      for item in items])
+
+  async def findMany(self, keys):
+    """Return the values for the given keys, sending them all at once."""
+
+    return await asyncio.gather(*[self._request(FIND, (key,)) \
+      for key in keys])
+
+  async def removeMany(self, keys):
+    """Remove the given keys and return their values, sent all at once."""
+
+    return await asyncio.gather(*[self._request(REMOVE, (key,)) \
+      for key in keys])
+
+class _Connection(object):
+  """Connection object.
+
+  One connection of a SplayClient's pool. Requests are written as soon as
+  they are made, and a reader task resolves their futures by request id as
+  the responses arrive.
+
+  Member Variables:
+    reader the asyncio StreamReader of the connection.
+    writer the asyncio StreamWriter of the connection.
+    pending a dictionary of the futures of unanswered requests by id.
+
+  """
+
+  def __init__(self, reader, writer):
+    """Initialize a connection and start reading its responses."""
+
+    self.reader = reader
+    self.writer = writer
+    self.pending = {}
+    self._ids = itertools.count(1)
+    self._receiver = asyncio.ensure_future(self._receive())
+
+  def request(self, op, args):
+    """Write a request frame and return the future of its result.
+
+    Raise ConnectionError if the connection has already been closed, since
+    no response could ever resolve the future.
+
+    """
+    if self._receiver.done() or self.writer.is_closing():
+      raise ConnectionError("connection closed")
+    requestId = next(self._ids) & 0xFFFFFFFF
+    payload = pickle.dumps(args, 2)
+    future = asyncio.get_event_loop().create_future()
+    self.pending[requestId] = future
+    self.writer.write(FRAME.pack(len(payload), requestId, op) + payload)
+    return future
+
+  async def _receive(self):
+    """Resolve the futures of requests as their responses arrive."""
+
+    try:
+      while True:
+        length, requestId, status = \
+          FRAME.unpack(await self.reader.readexactly(FRAME.size))
+        result = pickle.loads(await self.reader.readexactly(length))
+        future = self.pending.pop(requestId)
+        if future.cancelled():
+          continue
+        if status == OK:
+          future.set_result(result)
+        else:
+          future.set_exception(result)
+    except (asyncio.IncompleteReadError, ConnectionError):
+      pass
+    finally:
+      for future in self.pending.values():
+        if not future.done():
+          future.set_exception(ConnectionError("connection closed"))
+      self.pending.clear()
+
+  async def close(self):
+    """Close the connection and stop reading from it."""
+
+    self.writer.close()
+    self._receiver.cancel()
+    try:
+      await self._receiver
+    except asyncio.CancelledError:
+      pass
@@ -0,0 +1,295 @@
+import bisect
+import heapq
+import itertools
+import threading
+from splay_tree import SplayTree
+
+class ShardedSplayMap(object):
+  """Sharded Splay Map object.
+
+  A dictionary of independent SplayTree shards, each guarded by its own lock,
+  so that threads touching different shards never wait on each other. Since
+  find() splays, even reads need the lock of their shard; spreading keys over
+  many shards is what lets readers run side by side.
+
+  Keys are routed to shards either by key range, when boundaries are given,
+  or by hash. Range sharding keeps every shard's keys contiguous, which makes
+  ordered iteration a concatenation and lets rebalance() move boundaries with
+  SplayTree.split() and join(). Hash sharding spreads sequential keys evenly
+  but has to merge the shards to iterate in order.
+
+  Member Variables:
+    _shards the list of _Shard objects, in key order when range sharded.
+    _boundaries the sorted keys that start every shard but the first, or None
+      when hash sharded.
+    _lock guards changes to _boundaries made by rebalance().
+
+  """
+
+  def __init__(self, boundaries=None, shards=8, **options):
+    """Initialize an empty sharded map.
+
+    If boundaries is given, it is a sorted sequence of keys and shard i holds
+    the keys from boundaries[i-1] up to but excluding boundaries[i], giving
+    len(boundaries)+1 shards. Otherwise keys are spread over the given number
+    of shards by hash. Any other keyword arguments are passed to every
+    SplayTree shard, except key, since shards are routed and merged by the
+    keys themselves; range sharded trees keep order statistics so that
+    rebalance() can find split points quickly.
+
+    """
+    if options.get("key"):
+      raise ValueError("sharded maps do not support a key function")
+    if boundaries is not None:
+      boundaries = list(boundaries)
+      if any(not a < b for a, b in zip(boundaries, boundaries[1:])):
+        raise ValueError("shard boundaries must be strictly increasing")
+      options.setdefault("orderStatistics", True)
+      bounds = [None] + boundaries + [None]
+      self._shards = [_Shard(SplayTree(**options), bounds[i], bounds[i+1]) \
+        for i in range(len(boundaries)+1)]
+    else:
+      if shards < 1:
+        raise ValueError("a sharded map needs at least one shard")
+      self._shards = [_Shard(SplayTree(**options)) for i in range(shards)]
+    self._boundaries = boundaries
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    """Return the number of entries in all shards.
+
+    The shards are counted one after another without locking, so the total
+    may be stale while other threads are writing.
+
+    """
+    return sum(len(shard.tree) for shard in self._shards)
+
+  def _route(self, key):
+    """Return the shard that key currently belongs to."""
+
+    if self._boundaries is None:
+      return self._shards[hash(key) % len(self._shards)]
+    return self._shards[bisect.bisect_right(self._boundaries, key)]
+
+  def _locked(self, key):
+    """Return the shard for key with its lock held.
+
+    Helper function that re-checks the shard's bounds once its lock is held,
+    in case rebalance() moved a boundary in between, and retries if so. The
+    caller must release the shard's lock.
+
+    """
+    while True:
+      shard = self._route(key)
+      shard.lock.acquire()
+      if shard.owns(key):
+        return shard
+      shard.lock.release()
+
+  def insert(self, key, value):
+    """Insert an item into the shard that owns key; see SplayTree.insert()."""
+
+    shard = self._locked(key)
+    try:
+      shard.tree.insert(key, value)
+    finally:
+      shard.lock.release()
+
+  def find(self, key, splay=True):
+    """Return the value for key, or None; see SplayTree.find()."""
+
+    shard = self._locked(key)
+    try:
+      return shard.tree.find(key, splay)
+    finally:
+      shard.lock.release()
+
+  def __contains__(self, key):
+    """Determine if a given key is within the map, splaying its shard."""
+
+    shard = self._locked(key)
+    try:
+      return key in shard.tree
+    finally:
+      shard.lock.release()
+
+  def remove(self, key):
+    """Remove key from its shard and return its value; see remove()."""
+
+    shard = self._locked(key)
+    try:
+      return shard.tree.remove(key)
+    finally:
+      shard.lock.release()
+
+  def _batch(self, entries, keyOf, apply):
+    """Run a batch operation one shard at a time.
+
+    Helper function for the batch methods. entries are grouped by shard, and
+    each group is handed to apply(tree, group) with the shard locked once for
+    the whole group. Entries whose keys a concurrent rebalance() moved to
+    another shard are grouped again. apply() returns a list of results, one
+    per entry, which are gathered back into the order entries were given.
+
+    """
+    results = [None] * len(entries)
+    pending = list(range(len(entries)))
+    while pending:
+      groups = {}
+      for i in pending:
+        groups.setdefault(id(self._route(keyOf(entries[i]))), []).append(i)
+      pending = []
+      for shard in self._shards:
+        group = groups.pop(id(shard), None)
+        if not group:
+          continue
+        with shard.lock:
+          mine = [i for i in group if shard.owns(keyOf(entries[i]))]
+          pending.extend(i for i in group if not shard.owns(keyOf(entries[i])))
+          group = [entries[i] for i in mine]
+          for i, result in zip(mine, apply(shard.tree, group)):
+            results[i] = result
+    return results
+
+  def insertMany(self, items):
+    """Insert every (key, value) pair, locking each shard once per batch."""
+
+    def apply(tree, group):
+      tree.insertMany(group, sort=True)
+      return [None] * len(group)
+    self._batch(list(items), lambda item: item[0], apply)
+
+  def findMany(self, keys):
+    """Return the values for the given keys, locking each shard once."""
+
+    return self._batch(list(keys), lambda key: key, \
+      lambda tree, group: tree.findMany(group, sort=True))
+
+  def removeMany(self, keys):
+    """Remove the given keys and return their values, one lock per shard."""
+
+    return self._batch(list(keys), lambda key: key, \
+      lambda tree, group: tree.removeMany(group, sort=True))
+
+  def items(self):
+    """Iterate over the (key, value) pairs of every shard in key order.
+
+    Each shard is copied into a list while its lock is held, so that
+    iteration never holds a lock while yielding. Range shards are all copied
+    under the lock that rebalance() takes, so no entry moves between shards
+    while they are copied, and are then yielded in turn; hash shards are all
+    copied and then merged. Each shard is consistent with itself, but writes
+    to shards that have not been copied yet may or may not be seen.
+
+    """
+    if self._boundaries is not None:
+      with self._lock:
+        copies = [shard.copy() for shard in self._shards]
+      for copy in copies:
+        for item in copy:
+          yield item
+    else:
+      for item in heapq.merge(*[shard.copy() for shard in self._shards]):
+        yield item
+
+  def __iter__(self):
+    """Iterate over the keys of every shard in key order; see items()."""
+
+    for key, value in self.items():
+      yield key
+
+  def sizes(self):
+    """Return a list of the number of entries in each shard."""
+
+    return [len(shard.tree) for shard in self._shards]
+
+  def rebalance(self, ratio=2.0):
+    """Even out the largest range shard with its smaller neighbour.
+
+    If the largest shard holds more than ratio times the average number of
+    entries, the boundary between it and its smaller neighbour is moved so
+    that the two hold the same number of entries, using one split() and one
+    join(). Only those two shards are locked while their entries move.
+    Return whether a boundary moved; hash sharded maps never rebalance.
+
+    """
+    if self._boundaries is None or len(self._shards) < 2:
+      return False
+    with self._lock:
+      sizes = self.sizes()
+      i = max(range(len(sizes)), key=sizes.__getitem__)
+      if sizes[i] <= ratio * sum(sizes) / float(len(sizes)):
+        return False
+      if i == 0 or (i+1 < len(sizes) and sizes[i+1] < sizes[i-1]):
+        j = i + 1
+      else:
+        j = i - 1
+      hot, cold = self._shards[i], self._shards[j]
+      first, second = (hot, cold) if i < j else (cold, hot)
+      with first.lock:
+        with second.lock:
+          return self._moveBoundary(first, second, i < j)
+
+  def _moveBoundary(self, first, second, fromFirst):
+    """Move entries across the boundary between two adjacent range shards.
+
+    Helper function for rebalance() that is called with both shards locked.
+    If fromFirst, the largest keys of first move to second; otherwise the
+    smallest keys of second move to first. Return whether anything moved.
+
+    """
+    donor = first.tree if fromFirst else second.tree
+    move = (len(donor) - len(second.tree if fromFirst else first.tree)) // 2
+    if move <= 0:
+      return False
+    index = len(donor) - move if fromFirst else move
+    if donor._orderStatistics:
+      key = donor.select(index)
+    else:
+      key = next(itertools.islice(donor, index, None))
+    left, right = donor.split(key)
+    if fromFirst:
+      right.join(second.tree)
+      first.tree, second.tree = left, right
+    else:
+      first.tree.join(left)
+      second.tree = right
+    boundaries = list(self._boundaries)
+    boundaries[self._shards.index(first)] = key
+    second.lo = first.hi = key
+    self._boundaries = boundaries
+    return True
+
+class _Shard(object):
+  """Shard object.
+
+  One SplayTree of a ShardedSplayMap together with its lock and, when range
+  sharded, the bounds of the keys it owns.
+
+  Member Variables:
+    tree the SplayTree holding this shard's entries.
+    lock the lock that must be held to read or write tree.
+    lo the smallest key this shard may hold, or None if unbounded.
+    hi the key this shard's keys must be less than, or None if unbounded.
+
+  """
+
+  def __init__(self, tree, lo=None, hi=None):
+    """Initialize a shard around a tree, owning keys from lo up to hi."""
+
+    self.tree = tree
+    self.lock = threading.Lock()
+    self.lo = lo
+    self.hi = hi
+
+  def owns(self, key):
+    """Return whether key lies within this shard's bounds."""
+
+    return (self.lo is None or not key < self.lo) and \
+      (self.hi is None or key < self.hi)
+
+  def copy(self):
+    """Return a list of this shard's (key, value) pairs, taken under lock."""
+
+    with self.lock:
+      return list(self.tree.items())
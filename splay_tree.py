@@ -1,3 +1,35 @@
+import math
+import mmap
+import pickle
+import random
+import struct
+import time
+import weakref
+from collections import Counter
+from operator import attrgetter, itemgetter
+
+try:
+  from multiprocessing import shared_memory
+except ImportError: #Python 3.8+ only; freeze() is unavailable
+  shared_memory = None
+
+#Snapshot files written by SplayTree.dump(): a header, a table of count+1
+#record offsets, an optional preorder shape of one flag byte per node, the
+#copies of every key in key order for a multiset, and one record per entry
+#in key order. A record is the length of the pickled key, the pickled key and
+#the pickled value, which runs up to the next offset. Version 1 files, which
+#never hold counts, are still read.
+SNAPSHOT_MAGIC = b"SPLY"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<4sBBxxQ")
+SNAPSHOT_OFFSET = struct.Struct("<Q")
+SNAPSHOT_KEYLEN = struct.Struct("<I")
+SNAPSHOT_COUNT = struct.Struct("<Q")
+SNAPSHOT_SHAPED = 1 #header flag: the shape section is present
+SNAPSHOT_COUNTED = 2 #header flag: the counts section is present
+SHAPE_LEFT = 1 #shape flag: the node has a left child
+SHAPE_RIGHT = 2 #shape flag: the node has a right child
+
 class SplayTree(object):
   """Splay Tree object.
 
@@ -9,14 +41,231 @@ class SplayTree(object):
   Member Variables:
     _size the number of entries in this splay tree.
     _root the root of this tree; an empty tree has a value of None.
+    _topDown whether insert(), find() and remove() use topDownSplay().
+    _nodeType the class used to store entries; TreeNode or CompactNode.
+    _key the key function deriving the sort key of every key, or None.
+    _itemOf returns the caller's key of a node; see _extendNodeType().
+    _header scratch node reused by topDownSplay() to hold its side trees.
+    _orderStatistics whether every node keeps the size of its subtree.
+    _monoid the (combine, identity, lift) triple whose summary every node
+      keeps of its subtree, or None.
+    _multiset whether every node keeps a count of the copies of its key.
+    _augmented whether nodes carry fields that _updateNode() must maintain.
+    _policy the policy deciding how find() splays; None always splays fully.
+    _stats the SplayStats collecting instrumentation, or None when disabled.
+    _version counts the operations that took nodes out of the tree, so that
+      a Cursor can tell that its node may be gone.
+    _owned the set of ids of the nodes that no snapshot() shares, which may
+      be written in place, or None while there are no live snapshots.
+    _views weak references to the live SplayViews sharing this tree's nodes.
 
   """
 
-  def __init__(self):
-    """Initialize an empty splay tree object."""
+  def __init__(self, topDown=False, nodeType=None, orderStatistics=False,
+               policy=None, stats=None, key=None, monoid=None,
+               multiset=False):
+    """Initialize an empty splay tree object.
+
+    If topDown is set, insert(), find() and remove() search and restructure
+    the tree in a single top-down pass instead of searching with
+    binaryHelper() and then splaying the node back up to the root.
+
+    nodeType selects how entries are stored. The default, TreeNode, is a plain
+    object with a __dict__; CompactNode uses __slots__ and stores its fields
+    as attributes directly. Approximate bytes per entry on a 64 bit CPython,
+    not counting the key and value objects themselves:
+
+      nodeType      CPython 2.7   CPython 3.11
+      TreeNode      344           112
+      CompactNode   88            72
+
+    orderStatistics adds one more slot, 8 bytes, to the nodes of either type.
+
+    If orderStatistics is set, every node keeps the size of its subtree up to
+    date through rotations, inserts and removes, which enables rank(),
+    select() and countRange().
+
+    policy is a FullSplay() or a subclass such as SemiSplay(), DepthSplay() or
+    RandomSplay() that decides whether and how find() and findMany()
+    restructure the tree after a search. Inserts, removes and range scans
+    always splay fully. The default, None, is the same as FullSplay().
+
+    stats enables instrumentation; pass True or a SplayStats object. See
+    enableStats().
+
+    key is a function of one argument, as for sorted(), that derives the key
+    entries are ordered and compared by. It is called once per key given to
+    an operation and the result is stored in the node next to the original
+    key, so searches never call it again. Keys with equal derived keys count
+    as duplicates. Iteration and select() return the original keys.
+
+    monoid is a triple (combine, identity, lift) that makes every node keep a
+    summary of the values in its subtree: lift(value) summarizes one value,
+    combine(a, b) joins the summaries of adjacent runs of keys, a before b,
+    and must be associative, and identity is the summary of no values, such
+    as (operator.add, 0, lambda value: value) for sums. Summaries are kept
+    up to date through rotations, inserts and removes like subtree sizes,
+    which enables aggregate().
+
+    If multiset is set, every node keeps a count of the copies of its key,
+    so a key added many times is still stored once. add(), discard() and
+    count() change and read the counts with a single splayed search each.
+    With orderStatistics the subtree sizes add up counts instead of nodes,
+    so rank(), select() and countRange() count every copy, while len() and
+    iteration still see each key once. insert() and the bulk constructors
+    give new keys a count of one and keep the count of a key already in the
+    tree, remove() drops every copy, and dump() writes the counts too.
+
+    """
 
     self._size = 0
     self._root = None
+    self._version = 0
+    self._owned = None
+    self._views = []
+    self._topDown = topDown
+    self._nodeType = nodeType or TreeNode
+    self._key = key
+    if key:
+      self._nodeType = _extendNodeType(self._nodeType, "item")
+      self._itemOf = attrgetter("item")
+    else:
+      self._itemOf = attrgetter("key")
+    self._monoid = monoid
+    if monoid:
+      self._nodeType = _extendNodeType(self._nodeType, "summary")
+    self._multiset = multiset
+    if multiset:
+      self._nodeType = _extendNodeType(self._nodeType, "count")
+    if orderStatistics:
+      self._nodeType = _extendNodeType(self._nodeType, "size")
+    self._header = self._nodeType(None, None)
+    self._orderStatistics = orderStatistics
+    self._augmented = orderStatistics or bool(monoid)
+    self._policy = policy
+    self._stats = None
+    if stats:
+      self.enableStats(None if stats is True else stats)
+
+  def enableStats(self, stats=None):
+    """Start collecting instrumentation in stats, a SplayStats, and return it.
+
+    The public operations and binaryHelper() are replaced on this instance by
+    wrappers that count and time them, so a tree without stats runs the plain
+    methods and pays nothing beyond one check per splay.
+
+    """
+    self.disableStats()
+    self._stats = stats = stats or SplayStats()
+    for name in SplayStats.OPERATIONS:
+      setattr(self, name, stats.wrap(name, getattr(self, name)))
+    self.binaryHelper = stats.wrapSearch(self.binaryHelper)
+    return stats
+
+  def disableStats(self):
+    """Stop collecting instrumentation and restore the plain methods."""
+
+    for name in SplayStats.OPERATIONS + ("binaryHelper",):
+      self.__dict__.pop(name, None)
+    self._stats = None
+
+  def height(self):
+    """Return the height of the tree; an empty tree has a height of 0.
+
+    Every node is visited, so this takes O(n) time. The result is also
+    reported to the tree's SplayStats, if any.
+
+    """
+    height = 0
+    stack = [(self._root, 1)] if self._root else []
+    while stack:
+      node, depth = stack.pop()
+      height = max(height, depth)
+      if node.left:
+        stack.append((node.left, depth+1))
+      if node.right:
+        stack.append((node.right, depth+1))
+    if self._stats:
+      self._stats.maxHeight = max(self._stats.maxHeight, height)
+    return height
+
+  @classmethod
+  def fromSorted(cls, items, **kwargs):
+    """Build a balanced splay tree from (key, value) pairs sorted by key.
+
+    The tree is linked together directly in O(n) time, without inserting or
+    splaying. Adjacent pairs with equal keys keep the last value, as repeated
+    insert() calls would. A ValueError is raised if the keys are not in
+    ascending order. Keyword arguments are passed on to the constructor.
+
+    """
+    tree = cls(**kwargs)
+    tree._linkSorted(tree._entries(items))
+    return tree
+
+  @classmethod
+  def fromItems(cls, items, **kwargs):
+    """Build a balanced splay tree from (key, value) pairs in any order.
+
+    The pairs are sorted by key, which is stable so the last value given for
+    a duplicate key wins, and then linked with fromSorted() in O(n log(n))
+    time overall.
+
+    """
+    tree = cls(**kwargs)
+    tree._linkSorted(sorted(tree._entries(items), key=itemgetter(0)))
+    return tree
+
+  def _entries(self, items):
+    """Iterate over (sortKey, value, key) triples for (key, value) pairs.
+
+    Helper function that derives the sort key of every key once; without a
+    key function the sort key is the key itself.
+
+    """
+    sortKey = self._key
+    if sortKey:
+      for key, value in items:
+        yield (sortKey(key), value, key)
+    else:
+      for key, value in items:
+        yield (key, value, key)
+
+  def _linkSorted(self, entries):
+    """Link an empty tree from (sortKey, value, key) triples in sorted order.
+
+    Helper function for the bulk constructors; see fromSorted().
+
+    """
+    linked = []
+    for entry in entries:
+      if linked and not linked[-1][0] < entry[0]:
+        if linked[-1][0] != entry[0]:
+          raise ValueError("items are not sorted by key")
+        linked[-1] = entry #Replace a duplicate key
+        continue
+      linked.append(entry)
+    self._root = self._buildBalanced(linked, 0, len(linked), None)
+    self._size = len(linked)
+
+  def _buildBalanced(self, entries, lo, hi, parent):
+    """Return the root of a balanced subtree over entries[lo:hi].
+
+    Helper function for the bulk constructors, given (sortKey, value, key)
+    triples. The middle entry becomes the root and each half is built below
+    it, so recursion only goes O(log(n)) levels deep.
+
+    """
+    if lo >= hi:
+      return
+    mid = (lo + hi) // 2
+    key, value, item = entries[mid]
+    node = self._newNode(key, value, item, parent)
+    node.left = self._buildBalanced(entries, lo, mid, node)
+    node.right = self._buildBalanced(entries, mid+1, hi, node)
+    if self._augmented:
+      self._updateNode(node)
+    return node
 
   def __len__(self):
     """Return the size(number of entries) of the splay tree."""
@@ -32,22 +281,88 @@ class SplayTree(object):
     with that key will overwrite previous keys.
 
     """
-    if self._root:
-      node = self.binaryHelper(key,self._root)
-      if key == node.key: #Replace a duplicate key
-        node._key = key
-        node._value = value
-        return
-      elif key < node.key:
-        node.left = TreeNode(key,value,node)
-        node = node.left
-      elif key > node.key:
-        node.right = TreeNode(key,value,node)
-        node = node.right
-      self.splay(node)
+    item = key
+    if self._key:
+      key = self._key(key)
+    if self._topDown:
+      self._insertTopDown(key, value, item)
+    elif self._root:
+      if self._owned is not None:
+        self._ownSearch(key)
+      self._insertAt(key, value, self.binaryHelper(key,self._root), item)
     else:
-      self._root = TreeNode(key,value)
+      self._root = self._newNode(key,value,item)
+      self._size+=1
+
+  def _newNode(self, key, value, item, parent=None, left=None, right=None):
+    """Return a new node for sort key key holding the caller's key item."""
+
+    node = self._nodeType(key,value,parent,left,right)
+    if self._key:
+      node.item = item
+    if self._multiset:
+      node.count = 1
+    if self._owned is not None:
+      self._owned.add(id(node))
+    if self._augmented:
+      self._updateNode(node)
+    return node
+
+  def _insertAt(self, key, value, node, item):
+    """Insert an item given the node that a search for its key ended on.
+
+    Helper function for insert() and insertMany(), given the sort key and
+    the caller's key. A duplicate key overwrites node in place; otherwise the
+    new node is hung below node and splayed to the root. The node that holds
+    key is returned.
+
+    """
+    if key < node.key:
+      node.left = self._newNode(key,value,item,node)
+      node = node.left
+    elif node.key < key:
+      node.right = self._newNode(key,value,item,node)
+      node = node.right
+    else: #Replace a duplicate key
+      node.key = key
+      if self._key:
+        node.item = item
+      node.value = value
+      if self._monoid:
+        self._updatePath(node)
+      return node
+    self.splay(node)
     self._size+=1
+    return node
+
+  def insertMany(self, items, sort=False):
+    """Insert every (key, value) pair of an iterable into the tree.
+
+    Equivalent to calling insert() on each pair in turn, but each search
+    starts from the node the previous one touched instead of from the root;
+    see _fingerSearch(). If sort is set the pairs are sorted by key first,
+    keeping the last value of duplicate keys, so that a batch of m keys costs
+    O(m log(n/m)) amortized time instead of O(m log(n)).
+
+    """
+    items = self._entries(items)
+    if sort:
+      items = sorted(items, key=itemgetter(0))
+    if self._topDown:
+      insert = self._insertTopDown
+      for key, value, item in items:
+        insert(key, value, item)
+      return
+    insertAt, search = self._insertAt, self._fingerSearch
+    finger = self._own(self._root)
+    for key, value, item in items:
+      if self._owned is not None:
+        self._ownSearch(key)
+      if finger:
+        finger = insertAt(key, value, search(key, finger), item)
+      else:
+        finger = self._root = self._newNode(key,value,item)
+        self._size+=1
 
   def insertHelper(self, key, node):
     """Insert an item into the splay tree given a node.
@@ -69,28 +384,456 @@ class SplayTree(object):
         node.right = TreeNode(key,parent=node)
         return node
 
-  def find(self, key):
+  def find(self, key, splay=True):
     """Return the value that corresponds to the given key.
 
     Search the tree for the given key and return its corresponding value in
     O(log(n)) amortized time. If the key is not in this tree, return None.
-    The node that the search ends on is splayed to the root of the tree. No
-    duplicates are allowed in this implementation.
+    The node that the search ends on is splayed to the root of the tree, as
+    far as the tree's policy allows. No duplicates are allowed in this
+    implementation.
+
+    If splay is False the tree is searched without being modified at all. That
+    is cheaper for keys that are already near the root, but gives up the
+    amortized bound for that access.
 
     """
-    if self._root:
+    node = self._findNode(key, splay)
+    if node:
+      return node.value
+
+  def _findNode(self, key, splay=True):
+    """Return the node holding key, or None; see find().
+
+    Helper function for find() and __contains__ that derives the sort key of
+    key and searches and splays the tree the way find() does.
+
+    """
+    if self._key:
+      key = self._key(key)
+    if not self._root:
+      return
+    if not splay:
+      node = self.binaryHelper(key,self._root)
+    elif self._topDown and not self._policy:
+      node = self.topDownSplay(key)
+    else:
+      if self._owned is not None:
+        self._ownSearch(key)
       node = self.binaryHelper(key,self._root)
-      self.splay(node) #Splay the found node to the root
+      self._access(node) #Splay the found node to the root
+    if node.key == key:
+      return node
+
+  def findMany(self, keys, sort=False):
+    """Return a list of the values for each of the given keys.
+
+    Equivalent to calling find() on each key in turn; missing keys give None.
+    Each search starts from the node the previous one ended on; see
+    _fingerSearch(). If sort is set the keys are searched in ascending order,
+    which makes a batch of m keys cost O(m log(n/m)) amortized time, but the
+    values are still returned in the order the keys were given.
+
+    """
+    keys = list(keys)
+    if self._key:
+      keys = [self._key(key) for key in keys]
+    values = [None] * len(keys)
+    order = range(len(keys))
+    if sort:
+      order = sorted(order, key=keys.__getitem__)
+    if not self._root:
+      return values
+    topDown = self._topDown and not self._policy
+    access, search = self._access, self._fingerSearch
+    node = self._own(self._root)
+    for i in order:
+      key = keys[i]
+      if topDown:
+        node = self.topDownSplay(key)
+      else:
+        if self._owned is not None:
+          self._ownSearch(key)
+        node = search(key, node)
+        access(node)
       if node.key == key:
-        return node.value
+        values[i] = node.value
+    return values
 
   def __contains__(self, key):
-    """Determine if a given key is within the tree. Wrapper for find().
+    """Determine if a given key is within the tree.
+
+    The search is splayed as in find(), but the answer only depends on the
+    key, so entries whose value is None are found too.
+
+    """
+    return self._findNode(key) is not None
+
+  def __iter__(self):
+    """Iterate over the keys of the tree in ascending order.
+
+    Iteration walks parent pointers with O(1) extra memory and does not splay,
+    so the shape of the tree is left alone. Modifying the tree, including with
+    find(), while an iterator is in use gives undefined results.
+
+    """
+    successor, itemOf = self.nextNode, self._itemOf
+    node = self.minNode(self._root)
+    while node:
+      yield itemOf(node)
+      node = successor(node)
+
+  def __reversed__(self):
+    """Iterate over the keys of the tree in descending order; see __iter__."""
+
+    predecessor, itemOf = self.prevNode, self._itemOf
+    node = self.maxNode(self._root)
+    while node:
+      yield itemOf(node)
+      node = predecessor(node)
+
+  def keys(self):
+    """Iterate over the keys of the tree in ascending order."""
+
+    return iter(self)
+
+  def values(self):
+    """Iterate over the values of the tree in ascending order of key."""
+
+    successor = self.nextNode
+    node = self.minNode(self._root)
+    while node:
+      yield node.value
+      node = successor(node)
+
+  def items(self):
+    """Iterate over the (key, value) pairs of the tree in ascending order."""
+
+    successor, itemOf = self.nextNode, self._itemOf
+    node = self.minNode(self._root)
+    while node:
+      yield (itemOf(node), node.value)
+      node = successor(node)
+
+  def irange(self, lo=None, hi=None, inclusive=(True, True)):
+    """Iterate over the keys between lo and hi in ascending order.
+
+    inclusive is a pair of booleans saying whether lo and hi themselves are
+    part of the range. A bound of None leaves that side of the range open.
+    The search for lo is splayed once, which makes the start of the range the
+    root; the rest of the range is walked through parent pointers without any
+    further splaying. See __iter__ for the caveats on modification.
+
+    """
+    itemOf = self._itemOf
+    for node in self._rangeNodes(lo, hi, inclusive):
+      yield itemOf(node)
+
+  def _rangeNodes(self, lo=None, hi=None, inclusive=(True, True)):
+    """Iterate over the nodes with keys between lo and hi in ascending order.
+
+    Helper function for irange() and for callers that want the values too,
+    without searching for every key again; see irange().
+
+    """
+    if self._key:
+      lo = None if lo is None else self._key(lo)
+      hi = None if hi is None else self._key(hi)
+    successor = self.nextNode
+    node = self._startNode(lo, inclusive[0])
+    if hi is None:
+      while node:
+        yield node
+        node = successor(node)
+    elif inclusive[1]:
+      while node and not hi < node.key:
+        yield node
+        node = successor(node)
+    else:
+      while node and node.key < hi:
+        yield node
+        node = successor(node)
+
+  def _startNode(self, lo, inclusive=True):
+    """Return the first node of a range starting at lo, splaying the search.
+
+    Helper function for range scans, given a sort key. If lo is None return
+    the minimum node without splaying. Otherwise splay the search for lo to
+    the root and return the node holding the smallest key at or above lo
+    (strictly above if not inclusive), or None if there is no such key.
+
+    """
+    if lo is None:
+      return self.minNode(self._root)
+    node = self._splayKey(lo)
+    if node and (node.key < lo or (not inclusive and not lo < node.key)):
+      node = self.nextNode(node)
+    return node
+
+  def floor(self, key, default=None):
+    """Return the (key, value) pair with the largest key at most key.
+
+    The search for key is splayed and the answer is then splayed to the root,
+    so this runs in O(log(n)) amortized time and a following query for a
+    nearby key starts next to it. Return default if there is no such key.
+
+    """
+    return self._neighbour(key, True, True, default)
+
+  def ceiling(self, key, default=None):
+    """Return the (key, value) pair with the smallest key at least key.
+
+    Return default if there is no such key; see floor().
+
+    """
+    return self._neighbour(key, False, True, default)
+
+  def lower(self, key, default=None):
+    """Return the (key, value) pair with the largest key less than key.
+
+    Return default if there is no such key; see floor().
+
+    """
+    return self._neighbour(key, True, False, default)
+
+  def higher(self, key, default=None):
+    """Return the (key, value) pair with the smallest key greater than key.
+
+    Return default if there is no such key; see floor().
+
+    """
+    return self._neighbour(key, False, False, default)
+
+  def nearest(self, key, default=None):
+    """Return the (key, value) pair whose key is closest to key.
+
+    Keys must support subtraction, and with a key function the distance is
+    measured between the derived keys. A tie goes to the smaller key. Both
+    neighbours of key are found with a single splay and the answer is
+    splayed to the root, as in floor(). Return default if the tree is empty.
+
+    """
+    if not self._root:
+      return default
+    if self._key:
+      key = self._key(key)
+    root = self._splayKey(key)
+    if root.key < key:
+      below, above = root, self.nextNode(root)
+    elif key < root.key:
+      below, above = self.prevNode(root), root
+    else:
+      below = above = root
+    if not below or (above and above.key - key < key - below.key):
+      below = above
+    self.splay(below)
+    return (self._itemOf(below), below.value)
+
+  def _neighbour(self, key, below, inclusive, default):
+    """Return the entry next to key, splayed to the root, or default.
+
+    Helper function for floor(), ceiling(), lower() and higher(). The search
+    for key is splayed, which leaves at the root either key's node or one of
+    its two neighbours; the other neighbour is the root's in-order
+    predecessor or successor.
+
+    """
+    if not self._root:
+      return default
+    if self._key:
+      key = self._key(key)
+    node = self._splayKey(key)
+    if below:
+      if key < node.key or (not inclusive and not node.key < key):
+        node = self.prevNode(node)
+    elif node.key < key or (not inclusive and not key < node.key):
+      node = self.nextNode(node)
+    if not node:
+      return default
+    self.splay(node)
+    return (self._itemOf(node), node.value)
+
+  def seek(self, key=None):
+    """Return a Cursor on the smallest key at or above key.
+
+    The search for key is splayed once; if key is None the cursor starts on
+    the minimum key without splaying. If every key is smaller than key, the
+    cursor starts past the end. See Cursor.
+
+    """
+    if key is None:
+      return Cursor(self, self.minNode(self._root), -1)
+    if self._key:
+      key = self._key(key)
+    node = self._startNode(key)
+    return Cursor(self, node, 0 if node else 1)
+
+  def _detach(self, node):
+    """Unlink node from the tree without splaying and return its value.
+
+    Helper function for Cursor.delete(). A node with two children is replaced
+    by its in-order successor, which is relinked rather than copied, so that
+    references to every other node stay valid. Only the augmented fields on
+    the path from the changed nodes to the root are recomputed.
+
+    """
+    fixFrom = node.parent
+    if node.left and node.right:
+      replace = self.minNode(node.right)
+      if replace is not node.right:
+        fixFrom = replace.parent
+        fixFrom.left = replace.right
+        if replace.right:replace.right.parent = fixFrom
+        replace.right = node.right
+        replace.right.parent = replace
+      else:
+        fixFrom = replace
+      replace.left = node.left
+      replace.left.parent = replace
+    else:
+      replace = node.left or node.right
+    parent = node.parent
+    if replace:
+      replace.parent = parent
+    if not parent:
+      self._root = replace
+    elif parent.left is node:
+      parent.left = replace
+    else:
+      parent.right = replace
+    node.parent = node.left = node.right = None
+    if self._augmented:
+      self._updatePath(fixFrom)
+    self._size -= 1
+    self._version += 1
+    return node.value
+
+  def rank(self, key):
+    """Return the number of keys in the tree that are less than key.
+
+    The search for key is splayed to the root, so this runs in O(log(n))
+    amortized time. In a multiset tree every copy of a key is counted.
+    Requires the tree to be built with orderStatistics.
+
+    """
+    if self._key:
+      key = self._key(key)
+    return self._rank(key, False)
+
+  def select(self, i):
+    """Return the key at index i of the tree's keys in ascending order.
+
+    select(0) is the minimum key and negative indices count back from the end
+    as for lists. In a multiset tree a key occupies as many indices as it
+    has copies. The selected node is splayed to the root, so this runs in
+    O(log(n)) amortized time. An IndexError is raised if i is out of range.
+    Requires the tree to be built with orderStatistics.
+
+    """
+    self._checkOrderStatistics()
+    total = self._root.size if self._root else 0
+    if i < 0:
+      i += total
+    if not 0 <= i < total:
+      raise IndexError("select index out of range")
+    node = self._root
+    while True:
+      left = node.left.size if node.left else 0
+      copies = node.count if self._multiset else 1
+      if i < left:
+        node = node.left
+      elif i >= left + copies:
+        i -= left + copies
+        node = node.right
+      else:
+        break
+    node = self._own(node)
+    self.splay(node)
+    return self._itemOf(node)
+
+  def countRange(self, lo=None, hi=None, inclusive=(True, True)):
+    """Return the number of keys between lo and hi.
+
+    The bounds follow irange(). Only the two bounds are searched and splayed,
+    so this runs in O(log(n)) amortized time however many keys are in the
+    range. Requires the tree to be built with orderStatistics.
+
+    """
+    self._checkOrderStatistics()
+    if self._key:
+      lo = None if lo is None else self._key(lo)
+      hi = None if hi is None else self._key(hi)
+    total = self._root.size if self._root else 0
+    above = total if hi is None else self._rank(hi, inclusive[1])
+    below = 0 if lo is None else self._rank(lo, not inclusive[0])
+    return max(above - below, 0)
+
+  def aggregate(self, lo=None, hi=None, inclusive=(True, True)):
+    """Return the combined summary of the values with keys between lo and hi.
+
+    The bounds follow irange(). The search for lo is splayed, which leaves
+    every larger key in the root's right subtree, and that subtree is then
+    walked along the search path for hi, combining the summaries of the
+    subtrees that lie wholly in the range. The end of that path is splayed
+    in turn, so this runs in O(log(n)) amortized time without visiting the
+    entries in the range. The identity is returned for an empty range.
+    Requires the tree to be built with a monoid.
 
-    This function returns false negatives if the entries in the tree are None.
     """
+    if not self._monoid:
+      raise ValueError("tree was not built with a monoid")
+    combine, identity, lift = self._monoid
+    if self._key:
+      lo = None if lo is None else self._key(lo)
+      hi = None if hi is None else self._key(hi)
+    if not self._root:
+      return identity
+    summary = identity
+    node = self._root
+    if lo is not None:
+      root = self._splayKey(lo)
+      node = root.right
+      if (lo < root.key or (inclusive[0] and not root.key < lo)) and \
+         (hi is None or root.key < hi or (inclusive[1] and not hi < root.key)):
+        summary = lift(root.value)
+    if hi is None:
+      return combine(summary, node.summary) if node else summary
+    last = None
+    while node:
+      last = node
+      if node.key < hi or (inclusive[1] and not hi < node.key):
+        if node.left:
+          summary = combine(summary, node.left.summary)
+        summary = combine(summary, lift(node.value))
+        node = node.right
+      else:
+        node = node.left
+    if last:
+      self.splay(self._own(last))
+    return summary
+
+  def _rank(self, key, inclusive):
+    """Return the number of keys less than key, or at most key if inclusive.
+
+    Helper function for the order statistics, given a sort key. After
+    splaying the search for key, the root's left subtree holds exactly the
+    keys below the root.
+
+    """
+    self._checkOrderStatistics()
+    root = self._splayKey(key)
+    if not root:
+      return 0
+    rank = root.left.size if root.left else 0
+    if root.key < key or (inclusive and root.key == key):
+      rank += root.count if self._multiset else 1
+    return rank
+
+  def _checkOrderStatistics(self):
+    """Raise a ValueError unless the tree maintains subtree sizes."""
 
-    return (self.find(key) != None)
+    if not self._orderStatistics:
+      raise ValueError("tree was not built with orderStatistics")
 
   def remove(self, key):
     """Remove an item from the splay tree.
@@ -98,18 +841,25 @@ class SplayTree(object):
     Given a key, it will be removed in O(log(n)) amortized time and its parent
     will be splayed to the root of the tree. If the operation is successful,
     the size of the tree will decrease be one and the value of the key will be
-    returned, otherwise, a value of None will be returned. Calling remove() on
-    a duplicate key will result in an arbitrary key being removed.
+    returned, otherwise, a value of None will be returned. In a multiset tree
+    every copy of the key is removed; see discard().
 
     """
 
     if not self._root: #nothing to remove
       return
+    if self._key:
+      key = self._key(key)
+    if self._topDown:
+      return self._removeTopDown(key)
+    if self._owned is not None:
+      self._ownSearch(key)
     remove = self.binaryHelper(key, self._root)
-    splayMe = None
+    splayMe = fixFrom = None
     #remove is not None
     if remove.key != key: #node is not in the tree
-      splayMe = remove
+      self.splay(remove)
+      return
     elif remove is self._root:
       assert not remove.parent
       if not remove.left and not remove.right: #0 children
@@ -126,6 +876,7 @@ class SplayTree(object):
         replace = self.minNode(remove.right)
         assert replace
         assert not replace.left
+        fixFrom = replace if replace is remove.right else replace.parent
 
         if replace is remove.right:
           replace.left = remove.left
@@ -189,6 +940,7 @@ class SplayTree(object):
         splayMe = replace = self.minNode(remove.right)
         assert replace
         assert not replace.left
+        fixFrom = replace if replace is remove.right else replace.parent
 
         if remove.isLeftChild:
           if replace is remove.right:
@@ -238,18 +990,298 @@ class SplayTree(object):
             replace.parent = remove.parent
             replace.parent.right = replace
             remove.parent = None
+    if self._augmented:
+      self._updatePath(fixFrom or splayMe)
     self.splay(splayMe)
     self._size -= 1
+    self._version += 1
+    return remove.value
+
+  def add(self, key, n=1):
+    """Add n copies of key to a multiset tree and return its new count.
+
+    The search for key is splayed to the root; a key already in the tree
+    has its count raised in place there, and a new key becomes the root
+    with a count of n and a value of None. Either way this takes a single
+    search and splay, in O(log(n)) amortized time. Requires the tree to be
+    built with multiset.
+
+    """
+    self._checkMultiset()
+    if n < 1:
+      raise ValueError("n must be positive")
+    item = key
+    if self._key:
+      key = self._key(key)
+    node = self._splayKey(key)
+    if not node or node.key != key:
+      node = self._insertAbove(key, None, item, node)
+      n -= 1
+    node.count += n
+    if self._augmented:
+      self._updateNode(node)
+    return node.count
+
+  def discard(self, key, n=1):
+    """Remove up to n copies of key from a multiset tree.
+
+    Return the number of copies left. The search for key is splayed to the
+    root, and once its last copy goes the key is removed as by remove().
+    A missing key is ignored and gives 0. Requires the tree to be built with
+    multiset.
+
+    """
+    self._checkMultiset()
+    if n < 1:
+      raise ValueError("n must be positive")
+    if self._key:
+      key = self._key(key)
+    node = self._splayKey(key)
+    if not node or node.key != key:
+      return 0
+    if node.count <= n:
+      self._removeRoot()
+      return 0
+    node.count -= n
+    if self._augmented:
+      self._updateNode(node)
+    return node.count
+
+  def count(self, key):
+    """Return the number of copies of key in a multiset tree, or 0.
+
+    The search is splayed as in find(). Requires the tree to be built with
+    multiset.
+
+    """
+    self._checkMultiset()
+    node = self._findNode(key)
+    return node.count if node else 0
+
+  def _checkMultiset(self):
+    """Raise a ValueError unless the tree counts copies of its keys."""
+
+    if not self._multiset:
+      raise ValueError("tree was not built with multiset")
+
+  def removeMany(self, keys, sort=False):
+    """Remove each of the given keys and return a list of their values.
+
+    Equivalent to calling remove() on each key in turn; missing keys give
+    None. remove() leaves a neighbour of the removed key at the root, so with
+    sort set each search starts next to the following key and the batch
+    benefits from the same locality as findMany(). The values are returned in
+    the order the keys were given.
+
+    """
+    keys = list(keys)
+    values = [None] * len(keys)
+    order = range(len(keys))
+    if sort:
+      order = sorted(order, key=(lambda i: self._key(keys[i])) if self._key \
+        else keys.__getitem__)
+    remove = self.remove
+    for i in order:
+      values[i] = remove(keys[i])
+    return values
+
+  def removeRange(self, lo=None, hi=None, inclusive=(True, True)):
+    """Remove every key between lo and hi and return how many were removed.
+
+    The bounds follow irange(). The whole range is cut out as one subtree
+    with at most three splays, one for each bound and one to join the rest
+    back together, so this runs in O(log(n)) amortized time with
+    orderStatistics, and otherwise in O(log(n) + k) for k removed keys,
+    which have to be counted.
+
+    """
+    removed, count = self._cutRange(lo, hi, inclusive)
+    return count
+
+  def popRange(self, lo=None, hi=None, inclusive=(True, True)):
+    """Remove every key between lo and hi and iterate over their entries.
+
+    The range is cut out of the tree as in removeRange() before this
+    returns; the returned iterator then lazily walks the detached subtree,
+    yielding the removed (key, value) pairs in ascending order of key.
+
+    """
+    removed, count = self._cutRange(lo, hi, inclusive)
+    return self._detachedItems(removed)
+
+  def _detachedItems(self, node):
+    """Iterate over the (key, value) pairs of a subtree cut from the tree."""
+
+    successor, itemOf = self.nextNode, self._itemOf
+    node = self.minNode(node)
+    while node:
+      yield (itemOf(node), node.value)
+      node = successor(node)
+
+  def _cutRange(self, lo, hi, inclusive):
+    """Cut the keys between lo and hi out of the tree.
+
+    Helper function for removeRange() and popRange() that returns the root of
+    the detached subtree and the number of keys in it. The tree is split at
+    lo and the part above is split at hi, then the outer parts are joined.
+
+    """
+    if self._key:
+      lo = None if lo is None else self._key(lo)
+      hi = None if hi is None else self._key(hi)
+    if not self._root:
+      return None, 0
+    below, middle = None, self._root
+    if lo is not None:
+      below, middle = self._splitRoot(lo, not inclusive[0])
+    above = None
+    if hi is not None and middle:
+      self._root = middle
+      middle, above = self._splitRoot(hi, inclusive[1])
+    if below and above:
+      self._root = below
+      root = self._own(self.maxNode(below))
+      self.splay(root)
+      root.right = above
+      above.parent = root
+      if self._augmented:
+        self._updateNode(root)
+    else:
+      self._root = below or above
+    if not middle:
+      return None, 0
+    if self._orderStatistics and not self._multiset:
+      count = middle.size
+    else:
+      count = sum(1 for n in self._subtreeNodes(middle))
+    self._size -= count
+    self._version += 1
+    return middle, count
+
+  def _splitRoot(self, key, after):
+    """Splay the search for key and cut the tree below the new root in two.
+
+    Helper function that returns the roots of the keys less than key, or at
+    most key if after is set, and of the rest; either may be None. The tree
+    itself is left without a root.
+
+    """
+    root = self._splayKey(key)
+    self._root = None
+    if root.key < key or (after and not key < root.key):
+      left, right = root, root.right
+      root.right = None
+    else:
+      left, right = root.left, root
+      root.left = None
+    cut = right if left is root else left
+    if cut:
+      cut.parent = None
+    if self._augmented:
+      self._updateNode(root)
+    return left, right
+
+  def _insertTopDown(self, key, value, item):
+    """Insert an item using topDownSplay(); see insert().
+
+    The search path is splayed first, so the new node only has to split the
+    root into its left and right subtrees.
+
+    """
+    root = self.topDownSplay(key)
+    if root and root.key == key: #Replace a duplicate key
+      root.key = key
+      if self._key:
+        root.item = item
+      root.value = value
+      if self._monoid:
+        self._updateNode(root)
+      return
+    self._insertAbove(key, value, item, root)
+
+  def _insertAbove(self, key, value, item, root):
+    """Insert a new node as the root, above the splayed search for its key.
+
+    Helper function given the root left by splaying the search for a key
+    that is not in the tree, so the root is one of the key's neighbours and
+    the new node only has to split it off with its outer subtree. The new
+    node is returned.
+
+    """
+    if not root:
+      node = self._root = self._newNode(key,value,item)
+    elif key < root.key:
+      node = self._newNode(key,value,item,None,root.left,root)
+      if root.left:root.left.parent = node
+      root.left = None
+      root.parent = node
+      self._root = node
+    else:
+      node = self._newNode(key,value,item,None,root,root.right)
+      if root.right:root.right.parent = node
+      root.right = None
+      root.parent = node
+      self._root = node
+    if self._augmented and root:
+      self._updateNode(root)
+      self._updateNode(node)
+    self._size+=1
+    return node
+
+  def _removeTopDown(self, key):
+    """Remove an item using topDownSplay(); see remove().
+
+    The removed node is splayed to the root, then its left subtree is splayed
+    for its maximum, which leaves a free right link for the right subtree.
+
+    """
+    remove = self.topDownSplay(key)
+    if remove.key != key: #node is not in the tree
+      return
+    left, right = remove.left, remove.right
+    remove.left = remove.right = None
+    if left:
+      left.parent = None
+      self._root = left
+      replace = self.topDownSplay(key) #key is larger than all of left
+      replace.right = right
+      if right:right.parent = replace
+      if self._augmented:
+        self._updateNode(replace)
+    else:
+      if right:right.parent = None
+      self._root = right
+    self._size -= 1
+    self._version += 1
+    return remove.value
 
-  def _removeRoot():
+  def _removeRoot(self):
     """Remove the root from the tree.
 
     Helper function that removes the root from the tree and links up its
-    replacement.
-
-    The root either has one or both children, but no parent
+    replacement: the maximum of the root's left subtree is splayed to the top
+    of that subtree, which leaves a free right link for the right subtree.
+    The removed node is returned.
 
     """
+    root = self._root
+    left, right = root.left, root.right
+    root.left = root.right = None
+    if left:
+      left.parent = None
+      self._root = left
+      replace = self._own(self.maxNode(left))
+      self.splay(replace)
+      replace.right = right
+      if right:right.parent = replace
+      if self._augmented:
+        self._updateNode(replace)
+    else:
+      if right:right.parent = None
+      self._root = right
+    self._size -= 1
+    self._version += 1
+    return root
 
   def _removeParented(remove):
     """Remove a node in the tree that has a parent.
@@ -265,52 +1297,454 @@ class SplayTree(object):
       remove.parent
 
 
-  def minNode(self, node):
-    """Return the node that contains the minimum key.
+  def split(self, key):
+    """Split the tree into a tree of smaller keys and one of the rest.
 
-    Helper function that returns the node with the minimum key in a tree given
-    the root of that tree. If the given node is None, return None.
+    Return a pair of new trees (left, right) with the same options as this
+    one, where left holds every key less than key and right holds every key
+    greater than or equal to it. The search for key is splayed to the root
+    and its one subtree is cut off, so no entries are copied and this tree is
+    left empty. With orderStatistics the sizes of the halves are known and
+    split() runs in O(log(n)) amortized time; without it the subtree that is
+    cut off has to be counted, which takes time linear in its size.
 
     """
-    if not node or not node.left:
-      return node
-    return self.minNode(node.left)
+    if self._key:
+      key = self._key(key)
+    left, right = self._emptyLike(), self._emptyLike()
+    root = self._splayKey(key)
+    if root:
+      if root.key < key:
+        cut = root.right
+        root.right = None
+        left._root, right._root = root, cut
+      else:
+        cut = root.left
+        root.left = None
+        left._root, right._root = cut, root
+      if cut:
+        cut.parent = None
+      if self._orderStatistics and not self._multiset:
+        cutSize = cut.size if cut else 0
+      else:
+        cutSize = sum(1 for n in self._subtreeNodes(cut))
+      if self._augmented:
+        self._updateNode(root)
+      if root.key < key:
+        left._size, right._size = self._size - cutSize, cutSize
+      else:
+        left._size, right._size = cutSize, self._size - cutSize
+    if self._owned is not None:
+      left._adoptViews(self)
+      right._adoptViews(self)
+      self._owned, self._views = None, []
+    self._root = None
+    self._size = 0
+    self._version += 1
+    return left, right
 
-  def maxNode(self, node):
-    """Return the node that contains the maximum key.
+  def join(self, other):
+    """Move every entry of other into this tree.
 
-    Helper function that returns the node with the maximum key in a tree given
-    the root of that tree.
+    Every key in this tree must be less than every key in other, and both
+    trees must have been built with the same options; otherwise a ValueError
+    is raised. The maximum of this tree is splayed to the root and other is
+    hung off its empty right link in O(log(n)) amortized time. other is left
+    empty.
 
     """
-    if not node or not node.right:
-      return node
-    return self.maxNode(node.right)
+    if self._nodeType is not other._nodeType or \
+       self._orderStatistics != other._orderStatistics or \
+       self._key is not other._key or self._monoid != other._monoid or \
+       self._multiset != other._multiset:
+      raise ValueError("cannot join trees built with different options")
+    if not other._root:
+      return
+    if self._root:
+      root = self.maxNode(self._root)
+      if not root.key < other.minNode(other._root).key:
+        raise ValueError("keys of the joined tree must all be larger")
+      root = self._own(root)
+      self.splay(root)
+      root.right = other._root
+      root.right.parent = root
+      if self._augmented:
+        self._updateNode(root)
+    else:
+      self._root = other._root
+    if other._owned is not None:
+      self._adoptViews(other)
+      other._owned, other._views = None, []
+    self._size += other._size
+    other._root = None
+    other._size = 0
+    other._version += 1
 
-  def binaryHelper(self, key, node):
-    """Find a node that is *right* for the given key.
+  def _emptyLike(self):
+    """Return a new, empty tree built with the same options as this one."""
 
-    Helper function that returns the node that suits the key. If the key is not
-    currently in the tree, return the parent node. If the key is already in the
-    tree, return the node that contains it. This function returns None if the
-    given node is equal to None.
+    return self.__class__(topDown=self._topDown, nodeType=self._nodeType, \
+      orderStatistics=self._orderStatistics, policy=self._policy, \
+      key=self._key, monoid=self._monoid, multiset=self._multiset)
+
+  def _subtreeNodes(self, node):
+    """Iterate over every node in the subtree rooted at node, in key order.
+
+    Helper function that walks the subtree with nextNode(), stopping when the
+    walk climbs back above node.
+
+    """
+    if not node:
+      return
+    end = self.nextNode(self.maxNode(node))
+    node = self.minNode(node)
+    while node is not end:
+      yield node
+      node = self.nextNode(node)
+
+  def snapshot(self):
+    """Return a read-only SplayView of the tree as it is now, in O(1) time.
+
+    The view shares every node with the tree instead of copying it. From
+    then on the tree copies a node before changing it, along with the
+    ancestors of that node that are still shared, so each operation copies
+    at most the path it splays and a node is copied at most once per
+    snapshot. Memory therefore grows with the number of nodes written since
+    the snapshot rather than with the size of the tree, and the view keeps
+    seeing the entries it was taken with however the tree changes. Once
+    every view is gone the tree writes in place again.
 
     """
-    if not node or key == node.key:
+    view = SplayView(self)
+    self._owned = set()
+    self._views.append(weakref.ref(view, self._released))
+    return view
+
+  def _released(self, ref):
+    """Forget a view that was garbage collected; a weakref callback."""
+
+    if ref in self._views:
+      self._views.remove(ref)
+      if not self._views:
+        self._owned = None
+
+  def _adoptViews(self, other):
+    """Share the live views of other, whose nodes this tree now holds.
+
+    Helper function for split() and join(). Which nodes other owns cannot be
+    carried over in O(1) time, so every node is treated as shared again and
+    is copied the next time it is written.
+
+    """
+    for ref in other._views:
+      view = ref()
+      if view is not None:
+        self._views.append(weakref.ref(view, self._released))
+    if self._views:
+      self._owned = set()
+
+  def _own(self, node):
+    """Return a node of the tree that holds node's entry and may be written.
+
+    Helper function for copy-on-write. A node that a snapshot shares is
+    replaced in the tree by a copy, and so are its shared ancestors, which
+    must point at the copy; the climb stops at the first ancestor the tree
+    already owns, since every ancestor of an owned node is owned too. Only
+    parent pointers are written on shared nodes, and views never read them.
+    Copying takes the original node out of the tree, which invalidates
+    cursors. Return node itself if it is None or already owned.
+
+    """
+    owned = self._owned
+    if owned is None or not node or id(node) in owned:
       return node
-    elif key < node.key:
-      if node.left:
-        return self.binaryHelper(key,node.left)
+    self._version += 1
+    original = node
+    node = copy = self._copyNode(original)
+    while True:
+      parent = original.parent
+      if parent and id(parent) not in owned:
+        parentCopy = self._copyNode(parent)
       else:
-        return node #Return the parent node
-    elif key > node.key:
-      if node.right:
-        return self.binaryHelper(key,node.right)
+        parentCopy = parent
+      if not parentCopy:
+        self._root = copy
+      elif parentCopy.left is original:
+        parentCopy.left = copy
       else:
+        parentCopy.right = copy
+      copy.parent = parentCopy
+      if parentCopy is parent:
         return node
+      original, copy = parent, parentCopy
+
+  def _copyNode(self, node):
+    """Return an owned copy of node that its children point back at."""
+
+    copy = self._nodeType(node.key,node.value,node.parent,node.left,node.right)
+    if self._key:
+      copy.item = node.item
+    if self._orderStatistics:
+      copy.size = node.size
+    if self._monoid:
+      copy.summary = node.summary
+    if self._multiset:
+      copy.count = node.count
+    if copy.left:copy.left.parent = copy
+    if copy.right:copy.right.parent = copy
+    self._owned.add(id(copy))
+    return copy
+
+  def _ownSearch(self, key):
+    """Own every node that splaying the search for key may write.
+
+    Helper function called before a search while a snapshot is alive. The
+    search path is owned down to its last node, and for a key in the tree
+    down to both of its neighbours, which remove() and the neighbour
+    queries splay in turn. Splaying an owned node only writes owned nodes.
 
-  def splay(self, node):
-    """Splay a node up to the root.
+    """
+    node, last = self._root, None
+    while node:
+      if key < node.key:
+        last, node = node, node.left
+      elif node.key < key:
+        last, node = node, node.right
+      else:
+        node = last = self._own(node)
+        self._own(self.maxNode(node.left))
+        if node.right:
+          last = self.minNode(node.right)
+        break
+    self._own(last)
+
+  def dump(self, path, balanced=False):
+    """Write a binary snapshot of the tree to the file at path.
+
+    Keys and values are pickled and written in key order behind a table of
+    their offsets, so load() can binary search the file directly. Unless
+    balanced is set, the current shape of the tree is written as well and
+    load() restores it, splayed hot keys and all; otherwise load() builds a
+    balanced tree. Writing walks the tree without splaying it.
+
+    """
+    with open(path, "wb") as f:
+      f.write(self._snapshotBytes(balanced))
+
+  def freeze(self):
+    """Copy the tree into shared memory and return it as a FrozenSplayTree.
+
+    The entries are written in the snapshot format of dump(), a table of
+    offsets followed by the pickled keys and values in key order, into a new
+    multiprocessing.shared_memory block. Other processes that receive the
+    frozen tree, for instance as an argument to a pool worker, attach to the
+    same block instead of copying it. The tree itself is left unchanged.
+    Requires Python 3.8 or later.
+
+    """
+    if shared_memory is None:
+      raise ImportError("freeze() needs multiprocessing.shared_memory")
+    data = self._snapshotBytes(True)
+    memory = shared_memory.SharedMemory(create=True, size=len(data))
+    memory.buf[:len(data)] = data
+    return FrozenSplayTree(memory, key=self._key)
+
+  def _snapshotBytes(self, balanced):
+    """Return the tree as the bytes of a snapshot; see dump()."""
+
+    return _encodeSnapshot(self._rangeNodes(), self._itemOf, self._root, \
+      balanced, self._multiset)
+
+  @classmethod
+  def load(cls, path, mmap=False, **kwargs):
+    """Read a snapshot written by dump() and return it as a tree.
+
+    By default a SplayTree is built from the file in O(n) time, in the shape
+    it was dumped in or balanced. Keyword arguments are passed on to the
+    constructor. If mmap is set, a read-only MappedSplayTree is returned
+    instead; it serves lookups from the memory mapped file and only builds
+    the tree once it is modified.
+
+    """
+    if mmap:
+      return MappedSplayTree(path, cls, **kwargs)
+    with open(path, "rb") as f:
+      return _Snapshot(f.read()).build(cls, **kwargs)
+
+  def _buildShaped(self, shape, entries):
+    """Link a tree of the given preorder shape holding entries in key order.
+
+    Helper function for load(). Nodes are created and linked in preorder,
+    keeping a stack of the nodes whose right child is still to come, then
+    filled with the entries by an in-order walk. Returns the root.
+
+    """
+    root = attach = None
+    pending = []
+    nodes = []
+    for flags in bytearray(shape):
+      node = self._nodeType(None, None)
+      if self._multiset:
+        node.count = 1
+      nodes.append(node)
+      if attach:
+        node.parent = attach[0]
+        if attach[1]:
+          attach[0].right = node
+        else:
+          attach[0].left = node
+      else:
+        root = node
+      if flags & SHAPE_RIGHT:
+        pending.append(node)
+      if flags & SHAPE_LEFT:
+        attach = (node, False)
+      elif pending:
+        attach = (pending.pop(), True)
+      else:
+        attach = None
+    node = self.minNode(root)
+    for key, value, item in self._entries(entries):
+      node.key = key
+      if self._key:
+        node.item = item
+      node.value = value
+      node = self.nextNode(node)
+    if self._augmented: #children come after their parents in preorder
+      for node in reversed(nodes):
+        self._updateNode(node)
+    return root
+
+  def _restoreCounts(self, counts):
+    """Give the nodes, in key order, the given counts of copies.
+
+    Helper function for load() on a multiset tree that refreshes the subtree
+    sizes afterwards, children before their parents.
+
+    """
+    node = self.minNode(self._root)
+    for count in counts:
+      node.count = count
+      node = self.nextNode(node)
+    if self._augmented:
+      preorder = []
+      stack = [self._root] if self._root else []
+      while stack:
+        node = stack.pop()
+        preorder.append(node)
+        if node.left:
+          stack.append(node.left)
+        if node.right:
+          stack.append(node.right)
+      for node in reversed(preorder):
+        self._updateNode(node)
+
+  def minNode(self, node):
+    """Return the node that contains the minimum key.
+
+    Helper function that returns the node with the minimum key in a tree given
+    the root of that tree. If the given node is None, return None.
+
+    """
+    if node:
+      while node.left:
+        node = node.left
+    return node
+
+  def maxNode(self, node):
+    """Return the node that contains the maximum key.
+
+    Helper function that returns the node with the maximum key in a tree given
+    the root of that tree.
+
+    """
+    if node:
+      while node.right:
+        node = node.right
+    return node
+
+  def nextNode(self, node):
+    """Return the node that holds the next larger key after the given node.
+
+    Helper function that walks the in-order successor through child and
+    parent pointers without splaying. Return None if node holds the maximum
+    key.
+
+    """
+    if node.right:
+      return self.minNode(node.right)
+    while node.parent and node.parent.right is node:
+      node = node.parent
+    return node.parent
+
+  def prevNode(self, node):
+    """Return the node that holds the next smaller key before the given node.
+
+    Helper function that walks the in-order predecessor through child and
+    parent pointers without splaying. Return None if node holds the minimum
+    key.
+
+    """
+    if node.left:
+      return self.maxNode(node.left)
+    while node.parent and node.parent.left is node:
+      node = node.parent
+    return node.parent
+
+  def _fingerSearch(self, key, finger):
+    """Find the node that is *right* for key, starting from finger.
+
+    Helper function for the batch operations that returns the same node as
+    binaryHelper(key, self._root). Instead of starting at the root, it climbs
+    from finger to the lowest ancestor whose subtree must contain key and
+    descends from there, so nearby keys are found in time logarithmic in
+    their distance from finger. Once a node has been splayed it is the root
+    and the climb ends immediately; the dynamic finger property of splaying
+    then gives the same bound.
+
+    """
+    node = finger
+    if node.key < key:
+      while node.parent:
+        if node.parent.left is node and key < node.parent.key:
+          break
+        node = node.parent
+    elif key < node.key:
+      while node.parent:
+        if node.parent.right is node and node.parent.key < key:
+          break
+        node = node.parent
+    return self.binaryHelper(key, node)
+
+  def binaryHelper(self, key, node):
+    """Find a node that is *right* for the given key.
+
+    Helper function that returns the node that suits the key. If the key is not
+    currently in the tree, return the parent node. If the key is already in the
+    tree, return the node that contains it. This function returns None if the
+    given node is equal to None.
+
+    Only < is used. A level where the search goes left costs a single
+    key < node.key test; the second test, node.key < key, is only made once
+    the first one fails, and stops the descent at an equal key, so every node
+    visited lies on the path that the caller splays.
+
+    """
+    if not node:
+      return
+    while True:
+      if key < node.key:
+        child = node.left
+      elif node.key < key:
+        child = node.right
+      else:
+        return node #The key is already in the tree
+      if not child:
+        return node #Return the parent node
+      node = child
+
+  def splay(self, node):
+    """Splay a node up to the root.
 
     Mutate this splay tree so that the given node becomes the root of the tree.
     There are three named cases:
@@ -325,34 +1759,206 @@ class SplayTree(object):
     zig(base-case):
       The node is either a right child or a left child of the root. Rotate up.
 
-    When the given node is the root of the tree, stop recursion. If node is
-    None, return.
+    When the given node is the root of the tree, stop. If node is None,
+    return.
+
+    """
+    if not node:
+      return
+    zig = zigZig = zigZag = 0
+    while node.parent:
+      parent = node.parent
+      grand = parent.parent
+      if not grand: #Zig
+        zig += 1
+        if parent.left is node:
+          self.rotateRight(node)
+        else:
+          self.rotateLeft(node)
+      elif parent.left is node:
+        if grand.left is parent: #left zig-zig
+          zigZig += 1
+          self.rotateRight(parent)
+          self.rotateRight(node)
+        else: #left right zig-zag
+          zigZag += 1
+          self.rotateRight(node)
+          self.rotateLeft(node)
+      else:
+        if grand.right is parent: #right zig-zig
+          zigZig += 1
+          self.rotateLeft(parent)
+          self.rotateLeft(node)
+        else: #right left zig-zag
+          zigZag += 1
+          self.rotateLeft(node)
+          self.rotateRight(node)
+    if self._stats:
+      self._stats.splayed(zig, zigZig, zigZag, zig + 2*(zigZig + zigZag))
+
+  def _access(self, node):
+    """Restructure the tree after a search ended on node, per its policy."""
+
+    policy = self._policy
+    if not policy:
+      self.splay(node)
+    elif policy.shouldSplay(self, node):
+      if policy.semi:
+        self.semiSplay(node)
+      else:
+        self.splay(node)
+
+  def semiSplay(self, node):
+    """Semi-splay a node towards the root.
+
+    Sleator and Tarjan's semi-splaying: in the zig-zag case the node is
+    rotated up twice as in splay(), but in the zig-zig case only its parent
+    is rotated, and the climb continues from the parent. The node ends up
+    roughly halfway to the root, with about half the rotations of splay() and
+    the same O(log(n)) amortized bound. Nodes at depth one or less are left
+    where they are.
+
+    """
+    zigZig = zigZag = 0
+    while node and node.parent and node.parent.parent:
+      parent = node.parent
+      grand = parent.parent
+      if parent.left is node:
+        if grand.left is parent: #left zig-zig
+          zigZig += 1
+          self.rotateRight(parent)
+          node = parent
+        else: #left right zig-zag
+          zigZag += 1
+          self.rotateRight(node)
+          self.rotateLeft(node)
+      else:
+        if grand.right is parent: #right zig-zig
+          zigZig += 1
+          self.rotateLeft(parent)
+          node = parent
+        else: #right left zig-zag
+          zigZag += 1
+          self.rotateLeft(node)
+          self.rotateRight(node)
+    if self._stats and node:
+      depth = 2*(zigZig + zigZag) + (1 if node.parent else 0)
+      self._stats.splayed(0, zigZig, zigZag, depth)
+
+  def _splayKey(self, key):
+    """Splay the search for key to the root with the tree's engine.
+
+    Helper function that returns the new root: the node holding key, or the
+    last node on its search path. Return None if the tree is empty.
+
+    """
+    if self._topDown:
+      return self.topDownSplay(key)
+    if self._owned is not None:
+      self._ownSearch(key)
+    node = self.binaryHelper(key, self._root)
+    self.splay(node)
+    return node
+
+  def topDownSplay(self, key):
+    """Splay the node for the given key to the root in one top-down pass.
+
+    Sleator and Tarjan's top-down splay: the search path is cut into a left
+    tree of smaller keys and a right tree of larger keys while descending, and
+    the three are reassembled around the last node reached. That node is the
+    one that holds key or, if key is not in the tree, the node binaryHelper()
+    would have returned. No recursion is used and parent pointers are only
+    written, never followed, except to refresh subtree sizes along the inner
+    spines of the side trees when the tree is augmented. Only < is used, and
+    a test that the previous level already settled is skipped, so most nodes
+    on the path cost a single comparison. The new root is returned; None if
+    the tree is empty.
 
     """
-    if not node or node is self._root:
+    if self._owned is not None:
+      self._ownSearch(key)
+    node = self._root
+    if not node:
       return
-    elif node.parent is self._root: #Zig
-      if node.isLeftChild:
-        return self.rotateRight(node)
-      elif node.isRightChild:
-        return self.rotateLeft(node)
-    #right left zig-zag
-    elif node.isRightChild and node.parent.isLeftChild:
-      self.rotateLeft(node)
-      self.rotateRight(node)
-    #left right zig-zag
-    elif node.isLeftChild and node.parent.isRightChild:
-      self.rotateRight(node)
-      self.rotateLeft(node)
-    #left zig-zig
-    elif node.isLeftChild and node.parent.isLeftChild:
-      self.rotateRight(node.parent)
-      self.rotateRight(node)
-    #right zig-zig
-    elif node.isRightChild and node.parent.isRightChild:
-      self.rotateLeft(node.parent)
-      self.rotateLeft(node)
-    return self.splay(node)#recurse
+    header = left = right = self._header
+    header.left = header.right = None
+    zig = zigZig = 0
+    #whether key < node.key or node.key < key is already known to be false,
+    #from the test that chose node, so each node is compared about once
+    notLess = notGreater = False
+    while True:
+      if not notLess and key < node.key:
+        child = node.left
+        if not child:
+          break
+        notLess = notGreater = False
+        if key < child.key: #zig-zig: rotate right before linking
+          node.left = child.right
+          if child.right:child.right.parent = node
+          child.right = node
+          node.parent = child
+          if self._augmented:
+            self._updateNode(node)
+          node = child
+          zigZig += 1
+          if not node.left:
+            break
+        else:
+          notLess = True
+        zig += 1
+        right.left = node #link the node into the right tree
+        node.parent = right
+        right = node
+        node = node.left
+      elif not notGreater and node.key < key:
+        child = node.right
+        if not child:
+          break
+        notLess = notGreater = False
+        if child.key < key: #zig-zig: rotate left before linking
+          node.right = child.left
+          if child.left:child.left.parent = node
+          child.left = node
+          node.parent = child
+          if self._augmented:
+            self._updateNode(node)
+          node = child
+          zigZig += 1
+          if not node.right:
+            break
+        else:
+          notGreater = True
+        zig += 1
+        left.right = node #link the node into the left tree
+        node.parent = left
+        left = node
+        node = node.right
+      else:
+        break
+    #reassemble: node's subtrees go to the inner edges of the side trees
+    left.right = node.left
+    if node.left:node.left.parent = left
+    right.left = node.right
+    if node.right:node.right.parent = right
+    if self._augmented: #the side trees' inner spines changed size
+      while left is not header:
+        self._updateNode(left)
+        left = left.parent
+      while right is not header:
+        self._updateNode(right)
+        right = right.parent
+    node.left = header.right
+    node.right = header.left
+    if node.left:node.left.parent = node
+    if node.right:node.right.parent = node
+    node.parent = None
+    header.left = header.right = None
+    if self._augmented:
+      self._updateNode(node)
+    self._root = node
+    if self._stats: #a zig-zag is linked as two zigs
+      self._stats.splayed(zig, zigZig, 0, zig + 2*zigZig)
+    return node
 
   def rotateRight(self, node):
     """Rotate a given node right in the tree.
@@ -394,6 +2000,9 @@ class SplayTree(object):
         node.parent.right = node
     else:
       self._root = node
+    if self._augmented:
+      self._updateNode(node.right)
+      self._updateNode(node)
 
   def rotateLeft(self, node):
     """Rotate a given node left in the tree.
@@ -417,6 +2026,39 @@ class SplayTree(object):
         node.parent.right = node
     else:
       self._root = node
+    if self._augmented:
+      self._updateNode(node.left)
+      self._updateNode(node)
+
+  def _updateNode(self, node):
+    """Recompute the augmented fields of a node from its children.
+
+    Helper function called whenever the children of a node change; the
+    children themselves must already be up to date.
+
+    """
+    if self._orderStatistics:
+      size = node.count if self._multiset else 1
+      if node.left:
+        size += node.left.size
+      if node.right:
+        size += node.right.size
+      node.size = size
+    if self._monoid:
+      combine, identity, lift = self._monoid
+      summary = lift(node.value)
+      if node.left:
+        summary = combine(node.left.summary, summary)
+      if node.right:
+        summary = combine(summary, node.right.summary)
+      node.summary = summary
+
+  def _updatePath(self, node):
+    """Recompute the augmented fields of node and all of its ancestors."""
+
+    while node:
+      self._updateNode(node)
+      node = node.parent
 
   def __str__(self):
     """Return the string representation of the tree.
@@ -465,11 +2107,21 @@ class TreeNode(object):
     """Return the key stored by this tree node."""
     return self._key
 
+  @key.setter
+  def key(self, key):
+    """Replace the key stored by this tree node with an equal key."""
+    self._key = key
+
   @property
   def value(self):
     """Return the value stored by this tree node."""
     return self._value
 
+  @value.setter
+  def value(self, value):
+    """Replace the value stored by this tree node."""
+    self._value = value
+
   @property
   def isLeftChild(self):
     """Return whether this node is a left child."""
@@ -482,6 +2134,1131 @@ class TreeNode(object):
     if self.parent:
       return (self.parent).right is self
 
+class CompactNode(object):
+  """Compact Tree Node object.
+
+  A drop-in replacement for TreeNode that declares __slots__, so no per node
+  __dict__ is allocated, and keeps key and value as plain attributes instead
+  of properties. Select it with SplayTree(nodeType=CompactNode).
+
+  Member Variables:
+    key the key that this node contains. CompactNodes are searched by key.
+    value the value that corresponds to the stored key.
+    parent the parent of this node.
+    left the left child node which has a key less than this node.
+    right the right child node which has a key greater than this node.
+
+  """
+
+  __slots__ = ('key', 'value', 'parent', 'left', 'right')
+
+  def __init__(self, key, value, parent=None, left=None, right=None):
+    """Initialize a Compact Node object given certain values."""
+
+    self.key = key
+    self.value = value
+    self.parent = parent
+    self.left = left
+    self.right = right
+
+  @property
+  def isLeftChild(self):
+    """Return whether this node is a left child."""
+    if self.parent:
+      return (self.parent).left is self
+
+  @property
+  def isRightChild(self):
+    """Return whether this node is a right child."""
+    if self.parent:
+      return (self.parent).right is self
+
+class KeyNode(object):
+  """Key Node object.
+
+  A slotted node that stores a key but no value, used by SplaySet. Its value
+  always reads as None and writes to it are dropped, so the tree algorithms
+  that copy values around work unchanged.
+
+  Member Variables:
+    key the key that this node contains. KeyNodes are searched by key.
+    parent the parent of this node.
+    left the left child node which has a key less than this node.
+    right the right child node which has a key greater than this node.
+
+  """
+
+  __slots__ = ('key', 'parent', 'left', 'right')
+
+  def __init__(self, key, value=None, parent=None, left=None, right=None):
+    """Initialize a Key Node object given certain values; value is ignored."""
+
+    self.key = key
+    self.parent = parent
+    self.left = left
+    self.right = right
+
+  @property
+  def value(self):
+    """Return None; key nodes do not store a value."""
+    return None
+
+  @value.setter
+  def value(self, value):
+    """Drop the value; key nodes do not store a value."""
+
+  @property
+  def isLeftChild(self):
+    """Return whether this node is a left child."""
+    if self.parent:
+      return (self.parent).left is self
+
+  @property
+  def isRightChild(self):
+    """Return whether this node is a right child."""
+    if self.parent:
+      return (self.parent).right is self
+
+class SplaySet(object):
+  """Splay Set object.
+
+  An ordered set of keys kept in a SplayTree of KeyNodes, which store no
+  value. Membership tests, adds and discards splay like the tree's find(),
+  insert() and remove() and run in O(log(n)) amortized time. The bulk set
+  operations merge both sets in key order and link the result directly, so
+  they run in O(n + m) time instead of O(m log(n + m)).
+
+  Member Variables:
+    _tree the SplayTree holding the keys.
+
+  """
+
+  def __init__(self, keys=(), **options):
+    """Initialize a set holding the given keys.
+
+    Keyword arguments are passed on to the SplayTree, except that nodeType
+    is always KeyNode. The initial keys are sorted and linked in one step.
+
+    """
+    options["nodeType"] = KeyNode
+    self._tree = SplayTree.fromItems(((key, None) for key in keys), \
+      **options)
+
+  @classmethod
+  def _fromSorted(cls, entries, tree):
+    """Return a set with the options of tree holding the given entries.
+
+    entries are (sortKey, key) pairs in strictly ascending sort key order.
+
+    """
+
+    result = cls.__new__(cls)
+    result._tree = tree._emptyLike()
+    entries = [(sortKey, None, key) for sortKey, key in entries]
+    result._tree._root = result._tree._buildBalanced(entries, 0, \
+      len(entries), None)
+    result._tree._size = len(entries)
+    return result
+
+  def __len__(self):
+    """Return the number of keys in the set."""
+
+    return len(self._tree)
+
+  def __contains__(self, key):
+    """Determine if key is in the set, splaying its search."""
+
+    return key in self._tree
+
+  def __iter__(self):
+    """Iterate over the keys in ascending order without splaying."""
+
+    return iter(self._tree)
+
+  def __reversed__(self):
+    """Iterate over the keys in descending order without splaying."""
+
+    return reversed(self._tree)
+
+  def irange(self, lo=None, hi=None, inclusive=(True, True)):
+    """Iterate over the keys between lo and hi; see SplayTree.irange()."""
+
+    return self._tree.irange(lo, hi, inclusive)
+
+  def add(self, key):
+    """Add key to the set; adding a key already present does nothing."""
+
+    self._tree.insert(key, None)
+
+  def discard(self, key):
+    """Remove key from the set if it is present."""
+
+    self._tree.remove(key)
+
+  def remove(self, key):
+    """Remove key from the set, raising KeyError if it is not present."""
+
+    size = len(self._tree)
+    self._tree.remove(key)
+    if len(self._tree) == size:
+      raise KeyError(key)
+
+  def popMin(self):
+    """Remove and return the smallest key, raising KeyError if empty."""
+
+    return self._pop(self._tree.minNode(self._tree._root))
+
+  def popMax(self):
+    """Remove and return the largest key, raising KeyError if empty."""
+
+    return self._pop(self._tree.maxNode(self._tree._root))
+
+  def _pop(self, node):
+    """Remove the key of node from the set and return it."""
+
+    if not node:
+      raise KeyError("pop from an empty set")
+    key = self._tree._itemOf(node)
+    self._tree.remove(key)
+    return key
+
+  def _sortedEntries(self, other):
+    """Return an ascending iterator over (sortKey, key) pairs of other.
+
+    other is any iterable of keys; one that is not a SplaySet is put into a
+    set with this set's options first. A ValueError is raised if other is a
+    SplaySet ordered by a different key function.
+
+    """
+    if not isinstance(other, SplaySet):
+      other = SplaySet(other, key=self._tree._key)
+    elif other._tree._key is not self._tree._key:
+      raise ValueError("cannot combine sets ordered by different keys")
+    tree = other._tree
+    itemOf = tree._itemOf
+    nodes = tree._subtreeNodes(tree._root)
+    return ((node.key, itemOf(node)) for node in nodes)
+
+  def union(self, other):
+    """Return a new set of the keys in this set, other, or both."""
+
+    entries = []
+    a, b = self._sortedEntries(self), self._sortedEntries(other)
+    x, y = next(a, _END), next(b, _END)
+    while x is not _END and y is not _END:
+      if x[0] < y[0]:
+        entries.append(x)
+        x = next(a, _END)
+      elif y[0] < x[0]:
+        entries.append(y)
+        y = next(b, _END)
+      else:
+        entries.append(x)
+        x, y = next(a, _END), next(b, _END)
+    if x is not _END:
+      entries.append(x)
+      entries.extend(a)
+    if y is not _END:
+      entries.append(y)
+      entries.extend(b)
+    return self._fromSorted(entries, self._tree)
+
+  def intersection(self, other):
+    """Return a new set of the keys in both this set and other."""
+
+    entries = []
+    a, b = self._sortedEntries(self), self._sortedEntries(other)
+    x, y = next(a, _END), next(b, _END)
+    while x is not _END and y is not _END:
+      if x[0] < y[0]:
+        x = next(a, _END)
+      elif y[0] < x[0]:
+        y = next(b, _END)
+      else:
+        entries.append(x)
+        x, y = next(a, _END), next(b, _END)
+    return self._fromSorted(entries, self._tree)
+
+  def difference(self, other):
+    """Return a new set of the keys in this set but not in other."""
+
+    entries = []
+    a, b = self._sortedEntries(self), self._sortedEntries(other)
+    x, y = next(a, _END), next(b, _END)
+    while x is not _END:
+      if y is _END or x[0] < y[0]:
+        entries.append(x)
+        x = next(a, _END)
+      elif y[0] < x[0]:
+        y = next(b, _END)
+      else:
+        x, y = next(a, _END), next(b, _END)
+    return self._fromSorted(entries, self._tree)
+
+  __or__ = union
+  __and__ = intersection
+  __sub__ = difference
+
+#Sentinel marking the end of a merged iterator in the SplaySet operations.
+_END = object()
+
+class Cursor(object):
+  """Cursor object.
+
+  A position in a SplayTree, returned by SplayTree.seek(), that walks the
+  entries in key order through child and parent pointers. Moving does not
+  splay, so stepping over k consecutive entries takes O(k) time after the
+  one splayed seek(), amortized O(1) per step. A cursor may also sit past
+  either end of the tree, where it is false; moving back from there returns
+  to the last or first entry.
+
+  Splaying only rotates nodes, which keeps their order, so lookups and
+  inserts through the tree leave a cursor valid. Removals, split() and
+  join() may take its node out of the tree, and so may any write while a
+  snapshot() of the tree is alive, since written nodes are replaced by
+  copies; after one of those by anything but the cursor itself, using the
+  cursor raises a RuntimeError. The cursor's own setValue() and delete()
+  keep it valid.
+
+  Member Variables:
+    _tree the SplayTree this cursor walks.
+    _node the node the cursor is on, or None past either end.
+    _past -1 before the first entry, 1 after the last, and 0 on an entry.
+    _version the tree's _version the cursor last saw.
+
+  """
+
+  def __init__(self, tree, node, past=0):
+    """Initialize a cursor on node of tree; see SplayTree.seek()."""
+
+    self._tree = tree
+    self._node = node
+    self._past = 0 if node else past
+    self._version = tree._version
+
+  def _check(self):
+    """Raise a RuntimeError if the tree lost nodes since the cursor moved."""
+
+    if self._version != self._tree._version:
+      raise RuntimeError("tree was modified outside of the cursor")
+
+  def _entry(self):
+    """Return the cursor's node, raising an IndexError past either end."""
+
+    self._check()
+    if not self._node:
+      raise IndexError("cursor is not on an entry")
+    return self._node
+
+  def __bool__(self):
+    """Return whether the cursor is on an entry."""
+
+    return self._node is not None
+
+  __nonzero__ = __bool__
+
+  @property
+  def key(self):
+    """Return the key of the entry the cursor is on."""
+    return self._tree._itemOf(self._entry())
+
+  @property
+  def value(self):
+    """Return the value of the entry the cursor is on."""
+    return self._entry().value
+
+  def setValue(self, value):
+    """Replace the value of the entry the cursor is on."""
+
+    node = self._node = self._tree._own(self._entry())
+    node.value = value
+    if self._tree._monoid:
+      self._tree._updatePath(node)
+    self._version = self._tree._version
+
+  def next(self):
+    """Move to the next larger key and return whether there is one."""
+
+    self._check()
+    if self._node:
+      self._node = self._tree.nextNode(self._node)
+    elif self._past < 0:
+      self._node = self._tree.minNode(self._tree._root)
+    self._past = 0 if self._node else 1
+    return self._node is not None
+
+  def prev(self):
+    """Move to the next smaller key and return whether there is one."""
+
+    self._check()
+    if self._node:
+      self._node = self._tree.prevNode(self._node)
+    elif self._past > 0:
+      self._node = self._tree.maxNode(self._tree._root)
+    self._past = 0 if self._node else -1
+    return self._node is not None
+
+  def delete(self):
+    """Remove the entry the cursor is on and return its value.
+
+    The cursor moves on to the next larger key, or past the end. The node
+    is unlinked without splaying, so apart from finding the next key this
+    takes O(1) time, or time proportional to its depth when the tree keeps
+    order statistics.
+
+    """
+    node = self._tree._own(self._entry())
+    self._node = self._tree._own(self._tree.nextNode(node))
+    self._past = 0 if self._node else 1
+    value = self._tree._detach(node)
+    self._version = self._tree._version
+    return value
+
+class SplayView(object):
+  """Splay View object.
+
+  A read-only view of a SplayTree as it was when SplayTree.snapshot() was
+  called. The view shares its nodes with the tree, which copies any node it
+  writes while the view is alive, so the view stays consistent however the
+  tree changes. Lookups and iteration never splay and never follow parent
+  pointers, which the tree may still rewrite; iteration instead keeps a
+  stack of the nodes still to visit, as deep as the tree.
+
+  Member Variables:
+    _root the root of the tree when the view was taken.
+    _size the number of entries in the view.
+    _key the tree's key function, or None.
+    _itemOf returns the caller's key of a node; see SplayTree._itemOf.
+    _multiset whether the nodes keep counts of copies; see SplayTree.
+
+  """
+
+  def __init__(self, tree):
+    """Initialize a view of tree's current entries; see snapshot()."""
+
+    self._root = tree._root
+    self._size = tree._size
+    self._key = tree._key
+    self._itemOf = tree._itemOf
+    self._multiset = tree._multiset
+
+  def __len__(self):
+    """Return the number of entries in the view."""
+
+    return self._size
+
+  def find(self, key):
+    """Return the value for key, or None; see SplayTree.find()."""
+
+    node = self._findNode(key)
+    if node:
+      return node.value
+
+  def __contains__(self, key):
+    """Determine if a given key is within the view."""
+
+    return self._findNode(key) is not None
+
+  def _findNode(self, key):
+    """Return the node holding key, or None, searching as binaryHelper()."""
+
+    if self._key:
+      key = self._key(key)
+    node, candidate = self._root, None
+    while node:
+      if key < node.key:
+        node = node.left
+      else:
+        candidate = node
+        node = node.right
+    if candidate is not None and not candidate.key < key:
+      return candidate
+
+  def _ascending(self, lo=None, inclusive=True):
+    """Iterate over the nodes from the first one at or above lo in order."""
+
+    stack = []
+    node = self._root
+    while node:
+      if lo is None or lo < node.key or (inclusive and not node.key < lo):
+        stack.append(node)
+        node = node.left
+      else:
+        node = node.right
+    while stack:
+      node = stack.pop()
+      yield node
+      node = node.right
+      while node:
+        stack.append(node)
+        node = node.left
+
+  def __iter__(self):
+    """Iterate over the keys of the view in ascending order."""
+
+    itemOf = self._itemOf
+    for node in self._ascending():
+      yield itemOf(node)
+
+  def __reversed__(self):
+    """Iterate over the keys of the view in descending order."""
+
+    itemOf = self._itemOf
+    stack = []
+    node = self._root
+    while stack or node:
+      while node:
+        stack.append(node)
+        node = node.right
+      node = stack.pop()
+      yield itemOf(node)
+      node = node.left
+
+  def keys(self):
+    """Iterate over the keys of the view in ascending order."""
+
+    return iter(self)
+
+  def values(self):
+    """Iterate over the values of the view in ascending order of key."""
+
+    for node in self._ascending():
+      yield node.value
+
+  def items(self):
+    """Iterate over the (key, value) pairs of the view in ascending order."""
+
+    itemOf = self._itemOf
+    for node in self._ascending():
+      yield (itemOf(node), node.value)
+
+  def irange(self, lo=None, hi=None, inclusive=(True, True)):
+    """Iterate over the keys between lo and hi; see SplayTree.irange()."""
+
+    if self._key:
+      lo = None if lo is None else self._key(lo)
+      hi = None if hi is None else self._key(hi)
+    itemOf = self._itemOf
+    for node in self._ascending(lo, inclusive[0]):
+      if hi is not None and (hi < node.key or \
+         (not inclusive[1] and not node.key < hi)):
+        return
+      yield itemOf(node)
+
+  def dump(self, path, balanced=False):
+    """Write the view to the file at path; see SplayTree.dump().
+
+    The view never changes, so it can be written by another thread while
+    the tree it was taken from goes on being modified.
+
+    """
+    with open(path, "wb") as f:
+      f.write(self._snapshotBytes(balanced))
+
+  def _snapshotBytes(self, balanced):
+    """Return the view as the bytes of a snapshot; see dump()."""
+
+    return _encodeSnapshot(self._ascending(), self._itemOf, self._root, \
+      balanced, self._multiset)
+
+_extendedNodeTypes = {}
+
+def _extendNodeType(nodeType, slot):
+  """Return a subclass of nodeType with one more slot.
+
+  Trees built with a key function store the derived sort key in node.key,
+  which is all that searching and splaying read, and the key they were given
+  in node.item. Trees built with a monoid keep the summary of every subtree
+  in node.summary, and trees built with orderStatistics its size in
+  node.size. Each subclass is made once per node type and slot.
+
+  """
+  if any(slot in getattr(cls, "__slots__", ()) for cls in nodeType.__mro__):
+    return nodeType
+  if (nodeType, slot) not in _extendedNodeTypes:
+    _extendedNodeTypes[nodeType, slot] = type(slot.capitalize() + \
+      nodeType.__name__, (nodeType,), {"__slots__": (slot,), \
+      "__doc__": nodeType.__doc__})
+  return _extendedNodeTypes[nodeType, slot]
+
+class FullSplay(object):
+  """Splay Policy object.
+
+  A splay policy decides whether the node a find() ended on is splayed, and
+  whether it is splayed all the way to the root or semi-splayed. This base
+  policy always splays fully, which is the default behaviour of SplayTree.
+
+  Member Variables:
+    semi whether accepted nodes are semi-splayed instead of splayed.
+
+  """
+
+  semi = False
+
+  def shouldSplay(self, tree, node):
+    """Return whether the given tree should restructure itself around node."""
+
+    return True
+
+class SemiSplay(FullSplay):
+  """Splay Policy that semi-splays every accessed node; see semiSplay()."""
+
+  semi = True
+
+class DepthSplay(FullSplay):
+  """Splay Policy that only splays nodes deeper than c*log2(n).
+
+  Reads of keys that are already shallow leave the tree alone. Finding the
+  depth walks parent pointers, which costs no more than the search did.
+
+  Member Variables:
+    c the multiple of log2(n) a node's depth must exceed to be splayed.
+
+  """
+
+  def __init__(self, c=2.0, semi=False):
+    """Initialize a policy splaying beyond depth c*log2(n)."""
+
+    self.c = c
+    self.semi = semi
+
+  def shouldSplay(self, tree, node):
+    """Return whether node is deeper than c*log2(n) in the given tree."""
+
+    limit = self.c * math.log(len(tree) + 1, 2)
+    depth = 0
+    while node.parent:
+      depth += 1
+      if depth > limit:
+        return True
+      node = node.parent
+    return False
+
+class RandomSplay(FullSplay):
+  """Splay Policy that splays each accessed node with probability p.
+
+  The amortized bounds of splaying hold in expectation, while on average only
+  a fraction p of the reads pay for rotations.
+
+  Member Variables:
+    p the probability of splaying an accessed node.
+    random the random number source; seeded for reproducible runs.
+
+  """
+
+  def __init__(self, p=0.5, seed=None, semi=False):
+    """Initialize a policy splaying with probability p."""
+
+    self.p = p
+    self.random = random.Random(seed).random
+    self.semi = semi
+
+  def shouldSplay(self, tree, node):
+    """Return True with probability p."""
+
+    return self.random() < self.p
+
+class SplayStats(object):
+  """Splay Statistics object.
+
+  Instrumentation collected by a SplayTree built with stats, or after
+  enableStats(). Counts and times are kept per public operation; a batch
+  operation is counted once, along with any public operations it calls.
+
+  Member Variables:
+    ops a Counter of calls per operation name.
+    times a Counter of total seconds spent per operation name.
+    zig, zigZig, zigZag the number of splay steps of each case; a top-down
+      splay reports each zig-zag as two zigs.
+    depths a Counter of the depth of every node splayed, semi-splayed or
+      reached by a top-down splay.
+    pathLengths a Counter of the number of nodes every binaryHelper() search
+      visited.
+    maxDepth the deepest access seen.
+    maxHeight the largest tree height seen by SplayTree.height().
+    before an optional callback, before(name, args), run before each
+      operation.
+    after an optional callback, after(name, args, result, seconds), run after
+      each operation.
+    timer the clock used to time operations.
+
+  """
+
+  OPERATIONS = ("insert", "find", "remove", "insertMany", "findMany", \
+    "removeMany", "rank", "select", "countRange", "split", "join", "floor", \
+    "ceiling", "lower", "higher", "nearest", "seek", "aggregate", \
+    "removeRange", "popRange", "add", "discard", "count")
+
+  def __init__(self, before=None, after=None, timer=None):
+    """Initialize empty statistics with optional callbacks."""
+
+    self.before = before
+    self.after = after
+    self.timer = timer or getattr(time, "perf_counter", time.time)
+    self.reset()
+
+  def reset(self):
+    """Zero every counter and histogram."""
+
+    self.ops = Counter()
+    self.times = Counter()
+    self.zig = self.zigZig = self.zigZag = 0
+    self.depths = Counter()
+    self.pathLengths = Counter()
+    self.maxDepth = 0
+    self.maxHeight = 0
+
+  @property
+  def rotations(self):
+    """Return the number of rotations performed by splaying."""
+
+    return self.zig + 2*(self.zigZig + self.zigZag)
+
+  def splayed(self, zig, zigZig, zigZag, depth):
+    """Record one splay of a node at the given depth."""
+
+    self.zig += zig
+    self.zigZig += zigZig
+    self.zigZag += zigZag
+    self.depths[depth] += 1
+    if depth > self.maxDepth:
+      self.maxDepth = depth
+
+  def wrap(self, name, method):
+    """Return a wrapper around method that counts, times and calls back."""
+
+    def wrapper(*args, **kwargs):
+      if self.before:
+        self.before(name, args)
+      start = self.timer()
+      result = method(*args, **kwargs)
+      elapsed = self.timer() - start
+      self.ops[name] += 1
+      self.times[name] += elapsed
+      if self.after:
+        self.after(name, args, result, elapsed)
+      return result
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+  def wrapSearch(self, search):
+    """Return a wrapper around binaryHelper() that records path lengths."""
+
+    def binaryHelper(key, node):
+      result = search(key, node)
+      length = 0
+      found = result
+      while found is not None:
+        length += 1
+        if found is node:
+          break
+        found = found.parent
+      self.pathLengths[length] += 1
+      return result
+    binaryHelper.__doc__ = search.__doc__
+    return binaryHelper
+
+  def report(self):
+    """Return every statistic as a dictionary of plain values."""
+
+    return {
+      "ops": dict(self.ops),
+      "times": dict(self.times),
+      "zig": self.zig,
+      "zigZig": self.zigZig,
+      "zigZag": self.zigZag,
+      "rotations": self.rotations,
+      "depths": dict(self.depths),
+      "pathLengths": dict(self.pathLengths),
+      "maxDepth": self.maxDepth,
+      "maxHeight": self.maxHeight,
+    }
+
+def _encodeSnapshot(nodes, itemOf, root, balanced, counted):
+  """Return the bytes of a snapshot of the given nodes in key order.
+
+  Helper function for SplayTree.dump() and SplayView.dump(); itemOf returns
+  the caller's key of a node. Unless balanced is set, the shape of the tree
+  under root is written too, and if counted the count of every node.
+
+  """
+  records = []
+  counts = []
+  for node in nodes:
+    key = pickle.dumps(itemOf(node), 2)
+    records.append(SNAPSHOT_KEYLEN.pack(len(key)) + key + \
+      pickle.dumps(node.value, 2))
+    if counted:
+      counts.append(SNAPSHOT_COUNT.pack(node.count))
+  shape = b"" if balanced else _preorderShape(root)
+  counts = b"".join(counts)
+  position = SNAPSHOT_HEADER.size + SNAPSHOT_OFFSET.size*(len(records)+1) + \
+    len(shape) + len(counts)
+  offsets = []
+  for record in records:
+    offsets.append(SNAPSHOT_OFFSET.pack(position))
+    position += len(record)
+  offsets.append(SNAPSHOT_OFFSET.pack(position))
+  flags = (0 if balanced else SNAPSHOT_SHAPED) | \
+    (SNAPSHOT_COUNTED if counted else 0)
+  return SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, flags, \
+    len(records)) + b"".join(offsets) + shape + counts + b"".join(records)
+
+def _preorderShape(root):
+  """Return the shape of a tree as one flag byte per node in preorder."""
+
+  shape = bytearray()
+  stack = [root] if root else []
+  while stack:
+    node = stack.pop()
+    shape.append((node.left and SHAPE_LEFT or 0) | \
+      (node.right and SHAPE_RIGHT or 0))
+    if node.right:
+      stack.append(node.right)
+    if node.left:
+      stack.append(node.left)
+  return bytes(shape)
+
+class _Snapshot(object):
+  """Snapshot reader object.
+
+  Reads entries out of the bytes of a snapshot written by SplayTree.dump(),
+  which may be a string or a memory map, without copying the whole file.
+
+  Member Variables:
+    data the snapshot's bytes.
+    count the number of entries in the snapshot.
+    shape the preorder shape flags, or None for a balanced snapshot.
+    counts the copies of every key in key order for a multiset, or None.
+
+  """
+
+  def __init__(self, data):
+    """Initialize a reader over data, checking the snapshot header."""
+
+    magic, version, flags, count = SNAPSHOT_HEADER.unpack_from(data, 0)
+    if magic != SNAPSHOT_MAGIC or not 1 <= version <= SNAPSHOT_VERSION:
+      raise ValueError("not a splay tree snapshot")
+    self.data = data
+    self.count = count
+    self._table = SNAPSHOT_HEADER.size
+    start = self._table + SNAPSHOT_OFFSET.size*(count+1)
+    self.shape = self.counts = None
+    if flags & SNAPSHOT_SHAPED:
+      self.shape = data[start:start+count]
+      start += count
+    if flags & SNAPSHOT_COUNTED:
+      self.counts = [SNAPSHOT_COUNT.unpack_from(data, \
+        start + SNAPSHOT_COUNT.size*i)[0] for i in range(count)]
+
+  def check(self, multiset):
+    """Raise ValueError if a tree would drop the snapshot's counts."""
+
+    if self.counts is not None and not multiset:
+      raise ValueError("the snapshot holds multiset counts; load it with " \
+        "multiset=True")
+
+  def _offset(self, i):
+    """Return the file offset of record i."""
+
+    return SNAPSHOT_OFFSET.unpack_from(self.data, \
+      self._table + SNAPSHOT_OFFSET.size*i)[0]
+
+  def key(self, i):
+    """Return the key of record i."""
+
+    start = self._offset(i)
+    length = SNAPSHOT_KEYLEN.unpack_from(self.data, start)[0]
+    start += SNAPSHOT_KEYLEN.size
+    return pickle.loads(self.data[start:start+length])
+
+  def value(self, i):
+    """Return the value of record i."""
+
+    start = self._offset(i)
+    start += SNAPSHOT_KEYLEN.size + \
+      SNAPSHOT_KEYLEN.unpack_from(self.data, start)[0]
+    return pickle.loads(self.data[start:self._offset(i+1)])
+
+  def entries(self):
+    """Iterate over every (key, value) pair in key order."""
+
+    for i in range(self.count):
+      yield (self.key(i), self.value(i))
+
+  def bisect(self, key, inclusive=True, sortKey=None):
+    """Return the index of the first record at or above key.
+
+    If inclusive is not set, return the first record strictly above key. If
+    sortKey is given, key is a sort key and records are compared by the sort
+    key sortKey derives from theirs.
+
+    """
+    lo, hi = 0, self.count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      other = self.key(mid)
+      if sortKey:
+        other = sortKey(other)
+      if other < key or (not inclusive and not key < other):
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def build(self, cls, **kwargs):
+    """Return a new tree of class cls holding every entry of the snapshot."""
+
+    self.check(kwargs.get("multiset"))
+    if self.shape is None:
+      tree = cls.fromSorted(self.entries(), **kwargs)
+    else:
+      tree = cls(**kwargs)
+      tree._root = tree._buildShaped(self.shape, self.entries())
+      tree._size = self.count
+    if self.counts is not None:
+      tree._restoreCounts(self.counts)
+    return tree
+
+class MappedSplayTree(object):
+  """Memory Mapped Splay Tree object.
+
+  A read-only view of a snapshot written by SplayTree.dump(), returned by
+  SplayTree.load(path, mmap=True). Lookups binary search the memory mapped
+  file and unpickle only the keys they compare against, so opening a
+  snapshot costs nothing up front and untouched entries are never loaded.
+  Nothing splays. The first insert() or remove() builds an ordinary
+  SplayTree from the snapshot and every call is passed on to it from then
+  on.
+
+  Member Variables:
+    _snapshot the _Snapshot reading the mapped file.
+    _tree the SplayTree built on the first modification, or None.
+
+  """
+
+  def __init__(self, path, cls=None, **kwargs):
+    """Map the snapshot at path; cls and kwargs are used to build the tree."""
+
+    with open(path, "rb") as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self._snapshot = _Snapshot(self._map)
+    self._snapshot.check(kwargs.get("multiset"))
+    self._cls = cls or SplayTree
+    self._kwargs = kwargs
+    self._key = kwargs.get("key")
+    self._tree = None
+
+  def close(self):
+    """Release the memory map; the view must not be read afterwards."""
+
+    self._map.close()
+
+  def _materialize(self):
+    """Build and return the writable tree behind this view."""
+
+    if self._tree is None:
+      self._tree = self._snapshot.build(self._cls, **self._kwargs)
+    return self._tree
+
+  def __len__(self):
+    """Return the number of entries."""
+
+    if self._tree is not None:
+      return len(self._tree)
+    return self._snapshot.count
+
+  def find(self, key, splay=True):
+    """Return the value that corresponds to key, or None if it is missing."""
+
+    if self._tree is not None:
+      return self._tree.find(key, splay)
+    i = self._index(key)
+    if i is not None:
+      return self._snapshot.value(i)
+
+  def __contains__(self, key):
+    """Determine if a given key is within the tree."""
+
+    if self._tree is not None:
+      return key in self._tree
+    return self._index(key) is not None
+
+  def _index(self, key):
+    """Return the index of the snapshot record for key, or None."""
+
+    sortKey = self._key
+    if sortKey:
+      key = sortKey(key)
+    snapshot = self._snapshot
+    i = snapshot.bisect(key, True, sortKey)
+    if i < snapshot.count:
+      other = snapshot.key(i)
+      if (sortKey(other) if sortKey else other) == key:
+        return i
+
+  def floor(self, key, default=None):
+    """Return the entry with the largest key at most key; see floor()."""
+
+    if self._tree is not None:
+      return self._tree.floor(key, default)
+    return self._neighbour(key, -1, False, default)
+
+  def ceiling(self, key, default=None):
+    """Return the entry with the smallest key at least key; see ceiling()."""
+
+    if self._tree is not None:
+      return self._tree.ceiling(key, default)
+    return self._neighbour(key, 0, True, default)
+
+  def lower(self, key, default=None):
+    """Return the entry with the largest key less than key; see lower()."""
+
+    if self._tree is not None:
+      return self._tree.lower(key, default)
+    return self._neighbour(key, -1, True, default)
+
+  def higher(self, key, default=None):
+    """Return the entry with the smallest key above key; see higher()."""
+
+    if self._tree is not None:
+      return self._tree.higher(key, default)
+    return self._neighbour(key, 0, False, default)
+
+  def _neighbour(self, key, shift, inclusive, default):
+    """Return the snapshot entry shift places from where key would go.
+
+    Helper function for the neighbour queries, which look up the first record
+    at or above key (strictly above unless inclusive) and then step shift
+    records back.
+
+    """
+    if self._key:
+      key = self._key(key)
+    snapshot = self._snapshot
+    i = snapshot.bisect(key, inclusive, self._key) + shift
+    if 0 <= i < snapshot.count:
+      return (snapshot.key(i), snapshot.value(i))
+    return default
+
+  def insert(self, key, value):
+    """Build the tree if necessary and insert an item; see insert()."""
+
+    self._materialize().insert(key, value)
+
+  def remove(self, key):
+    """Build the tree if necessary and remove an item; see remove()."""
+
+    return self._materialize().remove(key)
+
+  def irange(self, lo=None, hi=None, inclusive=(True, True)):
+    """Iterate over the keys between lo and hi; see SplayTree.irange()."""
+
+    if self._tree is not None:
+      for key in self._tree.irange(lo, hi, inclusive):
+        yield key
+      return
+    snapshot, sortKey = self._snapshot, self._key
+    if sortKey:
+      lo = None if lo is None else sortKey(lo)
+      hi = None if hi is None else sortKey(hi)
+    i = 0 if lo is None else snapshot.bisect(lo, inclusive[0], sortKey)
+    end = snapshot.count
+    if hi is not None:
+      end = snapshot.bisect(hi, not inclusive[1], sortKey)
+    for i in range(i, end):
+      yield snapshot.key(i)
+
+  def items(self):
+    """Iterate over the (key, value) pairs in key order."""
+
+    if self._tree is not None:
+      return self._tree.items()
+    return self._snapshot.entries()
+
+  def __iter__(self):
+    """Iterate over the keys in key order."""
+
+    for key, value in self.items():
+      yield key
+
+  def keys(self):
+    """Iterate over the keys in key order."""
+
+    return iter(self)
+
+  def values(self):
+    """Iterate over the values in key order."""
+
+    for key, value in self.items():
+      yield value
+
+class FrozenSplayTree(MappedSplayTree):
+  """Frozen Splay Tree object.
+
+  An immutable snapshot of a SplayTree in a multiprocessing.shared_memory
+  block, returned by SplayTree.freeze(). It reads the block the way
+  MappedSplayTree reads a mapped file: lookups, neighbour queries and range
+  scans binary search the offset table and unpickle only what they touch,
+  and nothing splays. Pickling a frozen tree only pickles the name of its
+  block, so worker processes that receive one attach to the memory that is
+  already there and N workers share a single copy. insert() and remove()
+  raise a TypeError.
+
+  The process that called freeze() owns the block and should unlink() it
+  once no process needs it any more; every process should close() its own
+  view when done.
+
+  Member Variables:
+    _memory the SharedMemory block holding the snapshot.
+
+  """
+
+  def __init__(self, memory, key=None):
+    """Attach to memory, a SharedMemory block or the name of one.
+
+    key must be the key function of the tree that was frozen, if any.
+
+    """
+    if not isinstance(memory, shared_memory.SharedMemory):
+      try: #attaching must not make this process clean the block up
+        memory = shared_memory.SharedMemory(name=memory, track=False)
+      except TypeError: #track is new in Python 3.13
+        memory = shared_memory.SharedMemory(name=memory)
+    self._memory = memory
+    self._snapshot = _Snapshot(memory.buf)
+    self._cls = None
+    self._kwargs = {"key": key}
+    self._key = key
+    self._tree = None
+
+  def __reduce__(self):
+    """Pickle the frozen tree as the name of its block."""
+
+    return (self.__class__, (self._memory.name, self._key))
+
+  @property
+  def name(self):
+    """Return the name of the shared memory block."""
+    return self._memory.name
+
+  def close(self):
+    """Detach from the block; the view must not be read afterwards."""
+
+    self._snapshot = None
+    self._memory.close()
+
+  def unlink(self):
+    """Free the shared memory block once every process has closed it."""
+
+    self._memory.unlink()
+
+  def _materialize(self):
+    """Refuse to build a writable tree."""
+
+    raise TypeError("a frozen splay tree cannot be modified")
+
 if __name__ == "__main__":
   s = SplayTree()
   from random import randint
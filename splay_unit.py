@@ -1,7 +1,29 @@
+from __future__ import print_function
 import unittest
 import pdb
+import os
+import tempfile
+import shutil
+import threading
+import pickle
+import multiprocessing
 from random import randint
-from splay_tree import SplayTree
+from splay_tree import SplayTree, CompactNode, MappedSplayTree, SplayStats
+from splay_tree import SplaySet, Cursor
+import splay_tree
+from splay_tree import FullSplay, SemiSplay, DepthSplay, RandomSplay
+from splay_shard import ShardedSplayMap
+from splay_cache import SplayCache, splayCached
+from splay_hybrid import HybridSplayMap
+import splay_hybrid
+from splay_journal import JournaledSplayTree
+import splay_journal
+import splay_bench
+try:
+  import asyncio
+  from splay_server import SplayServer, SplayClient
+except (ImportError, SyntaxError): #the server needs Python 3
+  SplayServer = None
 
 class TestSplayBasic(unittest.TestCase):
 
@@ -22,19 +44,19 @@ class TestSplayBasic(unittest.TestCase):
   def testInsert(self):
     """Test if SplayTree can be inserted into without raising an exception."""
 
-    for i in xrange(randint(50,150)):
+    for i in range(randint(50,150)):
       self.s.insert(i, None)
 
   def testInsertLength(self):
     """Test if insertions into a splay tree result in the correct length."""
 
     num = randint(60,180)
-    for i in xrange(num):
+    for i in range(num):
       self.s.insert(i, None)
     self.assertEqual(len(self.s), num)
 
     #try to insert duplicates
-    for i in xrange(num):
+    for i in range(num):
       self.s.insert(i, None)
     self.assertEqual(len(self.s), num)
 
@@ -43,9 +65,9 @@ class TestSplayBasic(unittest.TestCase):
 
     numIns = randint(70,200)
 
-    for i in xrange(numIns):
+    for i in range(numIns):
       self.s.insert(i, None)
-    for i in xrange(numIns):
+    for i in range(numIns):
       self.s.remove(i)
 
   def testRemoveLengthSimple(self):
@@ -64,11 +86,11 @@ class TestSplayBasic(unittest.TestCase):
 
     """
     numIns = randint(60, 180)
-    numRem = (numIns/2) + randint(0, numIns/2)
+    numRem = (numIns//2) + randint(0, numIns//2)
     ref = set()
     refStatic = set()
 
-    for i in xrange(numIns):
+    for i in range(numIns):
       a = randint(-2147483648,2147483647)
       ref.add(a)
       refStatic.add(a)
@@ -77,7 +99,7 @@ class TestSplayBasic(unittest.TestCase):
     self.assertEqual(len(self.s), len(ref))
     refLength = len(self.s)
     #pdb.set_trace()
-    for i in xrange(numRem):
+    for i in range(numRem):
       self.assertEqual(len(self.s), refLength)
       refLength -=1
       self.s.remove(ref.pop())
@@ -85,7 +107,7 @@ class TestSplayBasic(unittest.TestCase):
     self.assertNotEqual(len(self.s), numIns)
     self.assertEqual(len(self.s), len(ref))
 
-    for i in xrange(numRem): #try to re-remove items
+    for i in range(numRem): #try to re-remove items
       self.s.remove(refStatic.pop())
 
   def testFind(self):
@@ -93,9 +115,9 @@ class TestSplayBasic(unittest.TestCase):
 
     N = randint(20,150)
     s = SplayTree()
-    for i in xrange(N):
+    for i in range(N):
       self.s.insert(i,1)
-    for i in xrange(N):
+    for i in range(N):
       a = self.s.find(i)
       self.assertTrue(a)
       N-=a
@@ -106,12 +128,129 @@ class TestSplayBasic(unittest.TestCase):
     """Test if the number of items inserted into the tree can be re-found."""
 
     N = randint(20,100)
-    for i in xrange(N):
+    for i in range(N):
       self.s.insert(i,True)
       N-=(i in self.s)
 
     self.assertEqual(N,0)
 
+  def testIteration(self):
+    """Test that the tree iterates over its entries in key order."""
+
+    ref = {}
+    for i in range(randint(100, 300)):
+      a = randint(-2147483648,2147483647)
+      self.s.insert(a, i)
+      ref[a] = i
+    keys = sorted(ref)
+    self.assertEqual(list(self.s), keys)
+    self.assertEqual(list(self.s.keys()), keys)
+    self.assertEqual(list(reversed(self.s)), keys[::-1])
+    self.assertEqual(list(self.s.values()), [ref[k] for k in keys])
+    self.assertEqual(list(self.s.items()), [(k, ref[k]) for k in keys])
+    self.assertEqual(list(SplayTree()), [])
+
+  def testIrange(self):
+    """Test range scans against a sorted list for all bound combinations."""
+
+    keys = sorted(set(randint(-1000, 1000) for i in range(300)))
+    for k in keys:
+      self.s.insert(k, None)
+    for i in range(50):
+      lo, hi = sorted((randint(-1100, 1100), randint(-1100, 1100)))
+      for inc in ((True, True), (True, False), (False, True), (False, False)):
+        ref = [k for k in keys if (lo < k or (inc[0] and lo == k)) and \
+          (k < hi or (inc[1] and k == hi))]
+        self.assertEqual(list(self.s.irange(lo, hi, inc)), ref)
+    self.assertEqual(list(self.s.irange()), keys)
+    self.assertEqual(list(self.s.irange(hi=0)), [k for k in keys if k <= 0])
+    self.assertEqual(list(self.s.irange(lo=0)), [k for k in keys if k >= 0])
+
+  def testNeighbours(self):
+    """Test floor, ceiling, lower, higher and nearest against a sorted list."""
+
+    self.assertEqual(self.s.floor(0, "none"), "none")
+    self.assertIsNone(self.s.nearest(0))
+    keys = sorted(set(randint(-1000, 1000) for i in range(300)))
+    for k in keys:
+      self.s.insert(k, -k)
+    for i in range(200):
+      a = randint(-1100, 1100)
+      below = [k for k in keys if k <= a]
+      above = [k for k in keys if k >= a]
+      ref = {
+        "floor": below[-1] if below else None,
+        "ceiling": above[0] if above else None,
+        "lower": ([k for k in keys if k < a] or [None])[-1],
+        "higher": ([k for k in keys if k > a] or [None])[0],
+      }
+      for name, k in ref.items():
+        result = getattr(self.s, name)(a)
+        self.assertEqual(result, None if k is None else (k, -k))
+        if k is not None:
+          self.assertEqual(self.s._root.key, k)
+      k = min(keys, key=lambda k: (abs(k - a), k))
+      self.assertEqual(self.s.nearest(a), (k, -k))
+      self.assertEqual(self.s._root.key, k)
+
+  def testRemoveRange(self):
+    """Test range removal against a sorted list for all bound combinations."""
+
+    keys = set(randint(-1000, 1000) for i in range(400))
+    for k in keys:
+      self.s.insert(k, -k)
+    for i in range(30):
+      lo, hi = sorted((randint(-1100, 1100), randint(-1100, 1100)))
+      inc = (bool(randint(0, 1)), bool(randint(0, 1)))
+      gone = sorted(k for k in keys if (lo < k or (inc[0] and lo == k)) and \
+        (k < hi or (inc[1] and k == hi)))
+      if randint(0, 1):
+        self.assertEqual(self.s.removeRange(lo, hi, inc), len(gone))
+      else:
+        self.assertEqual(list(self.s.popRange(lo, hi, inc)), \
+          [(k, -k) for k in gone])
+      keys.difference_update(gone)
+      self.assertEqual(len(self.s), len(keys))
+      self.assertEqual(list(self.s), sorted(keys))
+    self.assertEqual(self.s.removeRange(hi=0), \
+      len([k for k in keys if k <= 0]))
+    self.assertEqual(list(self.s.popRange(lo=0)), \
+      [(k, -k) for k in sorted(keys) if k > 0])
+    self.assertEqual(len(self.s), 0)
+    self.assertEqual(self.s.removeRange(), 0)
+
+  def testBatch(self):
+    """Test insertMany(), findMany() and removeMany() against a dict."""
+
+    ref = {}
+    for sort in (False, True):
+      items = [(randint(-1000, 1000), i) for i in range(randint(100, 400))]
+      self.s.insertMany(items, sort)
+      ref.update(items)
+      self.assertEqual(len(self.s), len(ref))
+      keys = [randint(-1100, 1100) for i in range(300)]
+      self.assertEqual(self.s.findMany(keys, sort), [ref.get(k) for k in keys])
+      keys = [randint(-1100, 1100) for i in range(300)]
+      self.assertEqual(self.s.removeMany(keys, sort), \
+        [ref.pop(k, None) for k in keys])
+      self.assertEqual(list(self.s.items()), sorted(ref.items()))
+
+  def testFingerSearch(self):
+    """Test that searching from any finger matches searching from the root."""
+
+    for i in range(randint(100, 300)):
+      self.s.insert(randint(-1000, 1000), None)
+    nodes = []
+    node = self.s.minNode(self.s._root)
+    while node:
+      nodes.append(node)
+      node = self.s.nextNode(node)
+    for i in range(500):
+      key = randint(-1100, 1100)
+      finger = nodes[randint(0, len(nodes)-1)]
+      self.assertIs(self.s._fingerSearch(key, finger), \
+        self.s.binaryHelper(key, self.s._root))
+
 class TestSplayDeep(TestSplayBasic):
   """Test some of the internal features of the splay tree.
 
@@ -124,7 +263,7 @@ class TestSplayDeep(TestSplayBasic):
 
     n = randint(50, 170)
     l = []
-    for i in xrange(n):
+    for i in range(n):
       a = randint(-2147483648,2147483647)
       self.s.insert(a, a)
       l.append(a)
@@ -137,7 +276,7 @@ class TestSplayDeep(TestSplayBasic):
 
     n = randint(50, 170)
     l = []
-    for i in xrange(n):
+    for i in range(n):
       a = randint(-2147483648,2147483647)
       self.s.insert(a, a)
       l.append(a)
@@ -189,10 +328,10 @@ class TestSplayDeep(TestSplayBasic):
     """
     ref = set()
     #pdb.set_trace()
-    for j in xrange(randint(5, 50)):
+    for j in range(randint(5, 50)):
       N = randint(60, 170)
-      R = N/2 + randint(0, N/2) #remove over half the entries
-      for i in xrange(N): #add
+      R = N//2 + randint(0, N//2) #remove over half the entries
+      for i in range(N): #add
         a = randint(-2147483648,2147483647)
         self.s.insert(a, True)
         ref.add(a)
@@ -200,7 +339,7 @@ class TestSplayDeep(TestSplayBasic):
         self.assertTrue(a in ref)
       #ensure both contain equal number of elements
       #self.assertEqual(len(ref), len(self.s))
-      for i in xrange(R): #remove
+      for i in range(R): #remove
         a = ref.pop()
         self.s.remove(a)
         self.assertFalse(a in self.s)
@@ -210,9 +349,9 @@ class TestSplayDeep(TestSplayBasic):
           try:
             self.assertTrue(j in self.s)
           except Exception as e:
-            print "missing:", j
-            print self.s
-            print ref
+            print("missing:", j)
+            print(self.s)
+            print(ref)
             raise e
       #check consistancy twice
       self.assertEqual(len(ref), len(self.s))
@@ -226,7 +365,7 @@ class TestSplayDeep(TestSplayBasic):
     """Test if parent/child relationships in the tree 'seem' ok."""
 
     #insert
-    for i in xrange(randint(50, 180)):
+    for i in range(randint(50, 180)):
       self.s.insert(randint(-2147483648,2147483647), i)
 
     #walk through the tree
@@ -245,5 +384,1583 @@ class TestSplayDeep(TestSplayBasic):
     traversalHelper(self.s._root.left)
     traversalHelper(self.s._root.right)
 
+  def testDeepPath(self):
+    """Test that a degenerate, path shaped tree can be searched.
+
+    Ascending inserts leave the tree as a path far deeper than the recursion
+    limit; searching it must not recurse once per level.
+
+    """
+    N = randint(3000, 5000)
+    for i in range(N):
+      self.s.insert(i, i)
+    self.assertEqual(self.s.minNode(self.s._root).key, 0)
+    self.assertEqual(self.s.maxNode(self.s._root).key, N-1)
+    self.assertEqual(self.s.find(0), 0)
+    self.assertEqual(self.s.remove(N-1), N-1)
+    self.assertEqual(len(self.s), N-1)
+
+  def testRemoveMissing(self):
+    """Test that removing a missing key returns None and keeps the size."""
+
+    for i in range(0, 100, 2):
+      self.s.insert(i, i)
+    for i in range(1, 100, 2):
+      self.assertIsNone(self.s.remove(i))
+    self.assertEqual(len(self.s), 50)
+    for i in range(0, 100, 2):
+      self.assertEqual(self.s.remove(i), i)
+    self.assertEqual(len(self.s), 0)
+
+  def testFromSorted(self):
+    """Test that fromSorted() links a balanced tree with working splays."""
+
+    N = randint(500, 2000)
+    self.s = SplayTree.fromSorted((i, -i) for i in range(N))
+    self.assertEqual(len(self.s), N)
+    self.assertIsNone(self.s._root.parent)
+
+    def height(n):
+      if not n:
+        return 0
+      for c in (n.left, n.right):
+        if c:
+          self.assertIs(c.parent, n)
+      return 1 + max(height(n.left), height(n.right))
+    self.assertTrue(height(self.s._root) <= N.bit_length())
+
+    for i in range(N):
+      self.assertEqual(self.s.find(i), -i)
+    self.s.insert(N, 0)
+    self.assertEqual(len(self.s), N+1)
+
+    self.assertRaises(ValueError, SplayTree.fromSorted, [(2, 0), (1, 0)])
+
+  def testFromItems(self):
+    """Test that fromItems() sorts its input and keeps the last duplicate."""
+
+    ref = {}
+    items = []
+    for i in range(randint(200, 800)):
+      a = randint(-500, 500)
+      items.append((a, i))
+      ref[a] = i
+    self.s = SplayTree.fromItems(items, nodeType=CompactNode)
+    self.assertEqual(len(self.s), len(ref))
+    self.assertIsInstance(self.s._root, CompactNode)
+    for a in ref:
+      self.assertEqual(self.s.find(a), ref[a])
+
+class TestSplayTopDown(TestSplayBasic):
+  """Run the interface tests against the top-down splay engine."""
+
+  def setUp(self):
+    self.s = SplayTree(topDown=True)
+
+  def testTopDownShape(self):
+    """Test that top-down splaying keeps keys and parent pointers consistent.
+
+    Compare the tree against a python dict after random inserts and removes,
+    then walk it checking search tree order and parent links.
+
+    """
+    ref = {}
+    for i in range(randint(500, 1500)):
+      a = randint(-1000, 1000)
+      if randint(0, 2):
+        self.s.insert(a, i)
+        ref[a] = i
+      else:
+        self.assertEqual(self.s.remove(a), ref.pop(a, None))
+      self.assertEqual(len(self.s), len(ref))
+      self.assertIsNone(self.s._root.parent if self.s._root else None)
+    for a in ref:
+      self.assertEqual(self.s.find(a), ref[a])
+      self.assertEqual(self.s._root.key, a)
+
+    keys = []
+    stack, n = [], self.s._root
+    while stack or n:
+      if n:
+        for c in (n.left, n.right):
+          if c:
+            self.assertIs(c.parent, n)
+        stack.append(n)
+        n = n.left
+      else:
+        n = stack.pop()
+        keys.append(n.key)
+        n = n.right
+    self.assertEqual(keys, sorted(ref))
+
+  def testDeepPath(self):
+    """Test that searching a sequentially built tree does not recurse."""
+
+    N = randint(3000, 5000)
+    for i in range(N):
+      self.s.insert(i, i)
+    self.assertEqual(self.s.find(0), 0)
+    self.assertEqual(self.s.find(N-1), N-1)
+    self.assertEqual(self.s.remove(0), 0)
+    self.assertEqual(len(self.s), N-1)
+
+class TestSplayInstrumented(TestSplayBasic):
+  """Run the interface tests with instrumentation enabled."""
+
+  def setUp(self):
+    self.s = SplayTree(stats=True)
+
+  def testStats(self):
+    """Test that operations, splay steps and depths are recorded."""
+
+    N = randint(100, 300)
+    for i in range(N):
+      self.s.insert(i, i)
+    for i in range(N):
+      self.s.find(randint(0, N))
+    self.s.remove(0)
+    stats = self.s._stats
+    self.assertEqual(stats.ops["insert"], N)
+    self.assertEqual(stats.ops["find"], N)
+    self.assertEqual(stats.ops["remove"], 1)
+    self.assertTrue(stats.times["find"] >= 0)
+    depths = sum(d * c for d, c in stats.depths.items())
+    self.assertEqual(depths, stats.rotations)
+    self.assertTrue(stats.zigZig > 0)
+    self.assertEqual(stats.maxDepth, max(stats.depths))
+    self.assertEqual(sum(stats.pathLengths.values()), 2*N)
+    self.assertEqual(self.s.height(), stats.maxHeight)
+    self.assertEqual(stats.report()["ops"]["insert"], N)
+
+  def testCallbacks(self):
+    """Test that the pre and post operation callbacks see every call."""
+
+    calls = []
+    stats = self.s.enableStats(SplayStats( \
+      before=lambda name, args: calls.append(("before", name, args)), \
+      after=lambda name, args, result, t: calls.append((name, result))))
+    self.s.insert(1, "a")
+    self.assertEqual(self.s.find(1), "a")
+    self.assertEqual(calls, [("before", "insert", (1, "a")), \
+      ("insert", None), ("before", "find", (1,)), ("find", "a")])
+    self.assertIs(self.s._stats, stats)
+
+  def testDisable(self):
+    """Test that disabling stats restores the plain methods."""
+
+    self.s.disableStats()
+    self.assertFalse("insert" in self.s.__dict__)
+    self.assertFalse("binaryHelper" in self.s.__dict__)
+    for i in range(100):
+      self.s.insert(i, i)
+    self.assertEqual(self.s.height(), 100)
+
+class TestSplayCompact(TestSplayDeep):
+  """Run the internal tests against the slotted CompactNode backend."""
+
+  def setUp(self):
+    self.s = SplayTree(nodeType=CompactNode)
+
+  def testCompactNodes(self):
+    """Test that entries are stored in CompactNodes without a __dict__."""
+
+    for i in range(randint(20, 80)):
+      self.s.insert(i, -i)
+    self.s.insert(0, 1) #overwrite a duplicate
+    self.assertIsInstance(self.s._root, CompactNode)
+    self.assertFalse(hasattr(self.s._root, "__dict__"))
+    self.assertFalse(hasattr(self.s._root, "size")) #only with statistics
+    self.assertEqual(self.s.find(0), 1)
+    s = SplayTree(nodeType=CompactNode, orderStatistics=True)
+    s.insert(1, 1)
+    self.assertIsInstance(s._root, CompactNode)
+    self.assertEqual(s._root.size, 1)
+
+class TestSplayOrderStatistics(unittest.TestCase):
+  """Test the subtree size augmentation and the queries built on it."""
+
+  def setUp(self):
+    self.s = SplayTree(orderStatistics=True)
+
+  def checkSizes(self, n):
+    """Assert that every subtree size under n is correct; return n's size."""
+
+    if not n:
+      return 0
+    size = 1 + self.checkSizes(n.left) + self.checkSizes(n.right)
+    self.assertEqual(n.size, size)
+    return size
+
+  def churn(self):
+    """Randomly insert and remove keys, checking sizes; return the keys."""
+
+    ref = set()
+    for i in range(randint(300, 900)):
+      a = randint(-500, 500)
+      if randint(0, 2):
+        self.s.insert(a, a)
+        ref.add(a)
+      else:
+        self.s.remove(a)
+        ref.discard(a)
+      self.s.find(randint(-500, 500))
+      self.assertEqual(self.checkSizes(self.s._root), len(ref))
+    return sorted(ref)
+
+  def testSizes(self):
+    """Test that sizes survive inserts, removes, splays and bulk loads."""
+
+    self.churn()
+    self.s = SplayTree(orderStatistics=True, topDown=True)
+    self.churn()
+    self.s = SplayTree.fromSorted(((i, i) for i in range(100)), \
+      orderStatistics=True)
+    self.assertEqual(self.checkSizes(self.s._root), 100)
+
+  def testRemoveRange(self):
+    """Test that range removal keeps subtree sizes and summaries correct."""
+
+    total = (lambda a, b: a + b, 0, lambda value: value)
+    for i in range(20):
+      self.s = SplayTree(orderStatistics=True, monoid=total)
+      keys = self.churn()
+      lo, hi = sorted((randint(-600, 600), randint(-600, 600)))
+      gone = [k for k in keys if lo <= k <= hi]
+      self.assertEqual(self.s.removeRange(lo, hi), len(gone))
+      self.assertEqual(self.checkSizes(self.s._root), len(keys) - len(gone))
+      self.assertEqual(self.s.aggregate(), sum(keys) - sum(gone))
+
+  def testRankSelect(self):
+    """Test rank(), select() and countRange() against a sorted list."""
+
+    keys = self.churn()
+    for i, k in enumerate(keys):
+      self.assertEqual(self.s.select(i), k)
+      self.assertEqual(self.s.rank(k), i)
+      self.assertEqual(self.s.rank(k + 0.5), i + 1)
+    self.assertEqual(self.s.select(-1), keys[-1])
+    self.assertRaises(IndexError, self.s.select, len(keys))
+    for i in range(100):
+      lo, hi = sorted((randint(-600, 600), randint(-600, 600)))
+      for inc in ((True, True), (True, False), (False, True), (False, False)):
+        self.assertEqual(self.s.countRange(lo, hi, inc), \
+          len(list(self.s.irange(lo, hi, inc))))
+    self.assertEqual(self.s.countRange(), len(keys))
+    self.assertEqual(self.checkSizes(self.s._root), len(keys))
+
+  def testSplitJoin(self):
+    """Test that split() and join() partition and rebuild the tree."""
+
+    for options in ({}, {"orderStatistics": True}, {"topDown": True}):
+      s = SplayTree(**options)
+      keys = sorted(set(randint(-1000, 1000) for i in range(400)))
+      for k in keys:
+        s.insert(k, -k)
+      key = randint(-1100, 1100)
+      left, right = s.split(key)
+      self.assertEqual(len(s), 0)
+      self.assertEqual(list(left), [k for k in keys if k < key])
+      self.assertEqual(list(right), [k for k in keys if k >= key])
+      self.assertEqual(len(left) + len(right), len(keys))
+      for tree in (left, right):
+        self.assertEqual(len(tree), len(list(tree)))
+        if s._orderStatistics:
+          self.assertEqual(self.checkSizes(tree._root), len(tree))
+
+      left.join(right)
+      self.assertEqual(len(right), 0)
+      self.assertEqual(list(left.items()), [(k, -k) for k in keys])
+      self.assertEqual(len(left), len(keys))
+      if s._orderStatistics:
+        self.assertEqual(self.checkSizes(left._root), len(keys))
+      if keys:
+        other = SplayTree(**options)
+        other.insert(keys[0], None)
+        self.assertRaises(ValueError, left.join, other)
+      self.assertRaises(ValueError, left.join, SplayTree(nodeType=CompactNode))
+
+  def testDisabled(self):
+    """Test that the queries refuse to run on a tree without sizes."""
+
+    s = SplayTree()
+    s.insert(1, 1)
+    self.assertRaises(ValueError, s.rank, 1)
+    self.assertRaises(ValueError, s.select, 0)
+    self.assertRaises(ValueError, s.countRange, 0, 2)
+
+class TestSplayAggregate(unittest.TestCase):
+  """Test monoid summaries and range aggregates."""
+
+  def checkSummaries(self, s, n):
+    """Assert that every summary under n is correct; return n's values."""
+
+    if not n:
+      return []
+    values = self.checkSummaries(s, n.left) + [n.value] + \
+      self.checkSummaries(s, n.right)
+    self.assertEqual(n.summary, tuple(values))
+    return values
+
+  def testAggregate(self):
+    """Test aggregates over random ranges against a sorted dictionary."""
+
+    concat = (lambda a, b: a + b, (), lambda value: (value,))
+    for options in ({}, {"topDown": True}, {"nodeType": CompactNode}, \
+                    {"orderStatistics": True}, {"policy": SemiSplay()}):
+      s = SplayTree(monoid=concat, **options)
+      ref = {}
+      for i in range(randint(300, 600)):
+        a = randint(-500, 500)
+        if randint(0, 2):
+          s.insert(a, i)
+          ref[a] = i
+        else:
+          self.assertEqual(s.remove(a), ref.pop(a, None))
+        s.find(randint(-500, 500))
+      self.checkSummaries(s, s._root)
+      keys = sorted(ref)
+      for i in range(100):
+        lo, hi = sorted((randint(-600, 600), randint(-600, 600)))
+        for inc in ((True, True), (True, False), (False, True), \
+                    (False, False)):
+          expect = tuple(ref[k] for k in keys if \
+            (lo < k or (inc[0] and lo == k)) and \
+            (k < hi or (inc[1] and k == hi)))
+          self.assertEqual(s.aggregate(lo, hi, inc), expect)
+        self.assertEqual(s.aggregate(hi=hi), \
+          tuple(ref[k] for k in keys if k <= hi))
+        self.assertEqual(s.aggregate(lo), \
+          tuple(ref[k] for k in keys if k >= lo))
+      self.assertEqual(s.aggregate(), tuple(ref[k] for k in keys))
+      self.assertEqual(s.aggregate(1, 0), ())
+      self.checkSummaries(s, s._root)
+
+  def testUpdates(self):
+    """Test that overwrites, cursors, splits and joins keep summaries."""
+
+    total = (lambda a, b: a + b, 0, lambda value: value)
+    s = SplayTree.fromItems(((k, k) for k in range(100)), monoid=total)
+    self.assertEqual(s.aggregate(), 4950)
+    s.insert(10, 1000)
+    self.assertEqual(s.aggregate(5, 15), sum(range(5, 16)) - 10 + 1000)
+    c = s.seek(20)
+    c.setValue(0)
+    c.delete()
+    self.assertEqual(s.aggregate(20, 21), 21)
+    left, right = s.split(50)
+    self.assertEqual(left.aggregate(), sum(range(50)) - 10 + 1000 - 20)
+    self.assertEqual(right.aggregate(), sum(range(50, 100)))
+    left.join(right)
+    self.assertEqual(left.aggregate(), 4950 - 10 + 1000 - 20)
+    self.assertRaises(ValueError, left.join, SplayTree())
+    self.assertRaises(ValueError, SplayTree().aggregate)
+    self.assertEqual(SplayTree(monoid=total).aggregate(), 0)
+
+class TestSplayMultiset(unittest.TestCase):
+  """Test per-key counts in multiset trees."""
+
+  def checkSizes(self, n):
+    """Assert that every subtree size under n adds up the counts."""
+
+    if not n:
+      return 0
+    size = n.count + self.checkSizes(n.left) + self.checkSizes(n.right)
+    self.assertEqual(n.size, size)
+    return size
+
+  def testCounts(self):
+    """Test add(), discard() and count() against a dictionary of counts."""
+
+    for options in ({}, {"topDown": True}, {"nodeType": CompactNode}, \
+                    {"orderStatistics": True}, {"key": lambda k: -k}):
+      s = SplayTree(multiset=True, **options)
+      ref = {}
+      for i in range(randint(300, 600)):
+        a = randint(-50, 50)
+        n = randint(1, 3)
+        if randint(0, 1):
+          ref[a] = ref.get(a, 0) + n
+          self.assertEqual(s.add(a, n), ref[a])
+          self.assertEqual(s._itemOf(s._root), a)
+        else:
+          left = max(ref.get(a, 0) - n, 0)
+          self.assertEqual(s.discard(a, n), left)
+          if left:
+            ref[a] = left
+          else:
+            ref.pop(a, None)
+        self.assertEqual(len(s), len(ref))
+      for k in range(-50, 51):
+        self.assertEqual(s.count(k), ref.get(k, 0))
+      self.assertEqual(sorted(s), sorted(ref))
+      self.assertRaises(ValueError, s.add, 1, 0)
+
+  def testRankSelect(self):
+    """Test that rank(), select() and countRange() count every copy."""
+
+    s = SplayTree(multiset=True, orderStatistics=True)
+    copies = []
+    for i in range(200):
+      a = randint(-100, 100)
+      s.add(a, 1 + i % 3)
+      copies.extend([a] * (1 + i % 3))
+    for i in range(100):
+      a = randint(-100, 100)
+      gone = min(copies.count(a), 2)
+      s.discard(a, 2)
+      for j in range(gone):
+        copies.remove(a)
+    copies.sort()
+    self.assertEqual(self.checkSizes(s._root), len(copies))
+    self.assertEqual(s.countRange(), len(copies))
+    for i in range(0, len(copies), 7):
+      self.assertEqual(s.select(i), copies[i])
+      self.assertEqual(s.rank(copies[i]), copies.index(copies[i]))
+    self.assertEqual(s.select(-1), copies[-1])
+    self.assertRaises(IndexError, s.select, len(copies))
+    self.assertEqual(s.countRange(-10, 10), \
+      len([k for k in copies if -10 <= k <= 10]))
+    left, right = s.split(0)
+    self.assertEqual(len(left) + len(right), len(set(copies)))
+    self.assertEqual(left.countRange() + right.countRange(), len(copies))
+    left.join(right)
+    self.assertEqual(left.removeRange(-10, 10), \
+      len(set(k for k in copies if -10 <= k <= 10)))
+    self.assertEqual(self.checkSizes(left._root), \
+      len([k for k in copies if not -10 <= k <= 10]))
+
+  def testPlainTree(self):
+    """Test that counting needs a multiset tree and insert() keeps counts."""
+
+    s = SplayTree()
+    self.assertRaises(ValueError, s.add, 1)
+    self.assertRaises(ValueError, s.count, 1)
+    self.assertRaises(ValueError, s.join, SplayTree(multiset=True))
+    s = SplayTree(multiset=True)
+    s.add("a", 3)
+    s.insert("a", 1)
+    s.insert("b", 2)
+    self.assertEqual((s.count("a"), s.count("b")), (3, 1))
+    self.assertEqual(list(s.items()), [("a", 1), ("b", 2)])
+    self.assertEqual(s.remove("a"), 1)
+    self.assertEqual(s.count("a"), 0)
+
+  def testSnapshot(self):
+    """Test that dump() and load() keep the count of every key."""
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      s = SplayTree(multiset=True, orderStatistics=True)
+      ref = {}
+      for i in range(200):
+        a = randint(-50, 50)
+        n = randint(1, 5)
+        ref[a] = ref.get(a, 0) + n
+        s.add(a, n)
+      for balanced in (False, True):
+        for source in (s, s.snapshot()):
+          source.dump(path, balanced)
+          for mmap in (False, True):
+            t = SplayTree.load(path, mmap, multiset=True, orderStatistics=True)
+            if mmap:
+              t.insert(1000, None) #the first write builds the tree
+              t = t._tree
+            for a in ref:
+              self.assertEqual(t.count(a), ref[a])
+            self.checkSizes(t._root)
+          self.assertRaises(ValueError, SplayTree.load, path)
+          self.assertRaises(ValueError, SplayTree.load, path, True)
+    finally:
+      os.remove(path)
+
+class TestSplayCursor(unittest.TestCase):
+  """Test cursors returned by seek()."""
+
+  checkSizes = TestSplayOrderStatistics.__dict__["checkSizes"]
+
+  def build(self, **options):
+    """Return a tree of random keys and the sorted list of its keys."""
+
+    s = SplayTree(**options)
+    keys = sorted(set(randint(-1000, 1000) for i in range(300)))
+    for k in keys:
+      s.insert(k, -k)
+    return s, keys
+
+  def testWalk(self):
+    """Test that a cursor walks forwards and backwards in key order."""
+
+    for options in ({}, {"topDown": True}, {"key": lambda k: -k}):
+      s, keys = self.build(**options)
+      if "key" in options:
+        keys.reverse()
+      c = s.seek()
+      self.assertIsInstance(c, Cursor)
+      walked = []
+      while c:
+        walked.append((c.key, c.value))
+        c.next()
+      self.assertEqual(walked, [(k, -k) for k in keys])
+      self.assertFalse(c.next())
+      self.assertTrue(c.prev())
+      self.assertEqual(c.key, keys[-1])
+      self.assertFalse(c.next())
+      self.assertRaises(IndexError, lambda: c.value)
+      self.assertTrue(c.prev())
+      c = s.seek(keys[len(keys) // 2])
+      for k in reversed(keys[:len(keys) // 2 + 1]):
+        self.assertEqual(c.key, k)
+        c.prev()
+      self.assertFalse(c)
+      self.assertTrue(c.next())
+      self.assertEqual(c.key, keys[0])
+
+  def testDelete(self):
+    """Test deleting and updating entries through a cursor."""
+
+    for options in ({}, {"orderStatistics": True}, {"nodeType": CompactNode}):
+      s, keys = self.build(**options)
+      c = s.seek(keys[0])
+      kept = []
+      while c:
+        if randint(0, 1):
+          k = c.key
+          self.assertEqual(c.delete(), -k)
+        else:
+          kept.append(c.key)
+          c.setValue(c.key)
+          c.next()
+      self.assertEqual(list(s.items()), [(k, k) for k in kept])
+      self.assertEqual(len(s), len(kept))
+      if s._orderStatistics:
+        self.assertEqual(self.checkSizes(s._root), len(kept))
+        for i, k in enumerate(kept):
+          self.assertEqual(s.select(i), k)
+      c = s.seek()
+      while c:
+        c.delete()
+      self.assertEqual(len(s), 0)
+      self.assertIsNone(s._root)
+
+  def testInvalidation(self):
+    """Test that removals by other writers invalidate a cursor."""
+
+    s, keys = self.build()
+    c = s.seek(keys[10])
+    s.find(keys[0])
+    s.insert(keys[-1] + 1, None)
+    self.assertEqual(c.key, keys[10])
+    self.assertTrue(c.next())
+    self.assertEqual(c.key, keys[11])
+    s.remove(keys[-1])
+    self.assertRaises(RuntimeError, c.next)
+    self.assertRaises(RuntimeError, lambda: c.key)
+    c = s.seek(keys[10])
+    s.remove(keys[-1] + 10) #removing a missing key changes nothing
+    c.next()
+    left, right = s.split(keys[20])
+    self.assertRaises(RuntimeError, c.prev)
+    c = left.seek()
+    left.join(right)
+    c.next()
+    c = right.seek()
+    self.assertFalse(c)
+
+class TestSplayView(unittest.TestCase):
+  """Test copy-on-write views returned by snapshot()."""
+
+  checkSizes = TestSplayOrderStatistics.__dict__["checkSizes"]
+
+  def nodes(self, n):
+    """Return the list of nodes under n, walking child pointers only."""
+
+    if not n:
+      return []
+    return self.nodes(n.left) + [n] + self.nodes(n.right)
+
+  def testConsistent(self):
+    """Test that views keep their entries while the tree keeps changing."""
+
+    total = (lambda a, b: a + b, 0, lambda value: value)
+    for options in ({}, {"topDown": True}, {"nodeType": CompactNode}, \
+                    {"orderStatistics": True, "monoid": total}, \
+                    {"key": lambda k: -k}, {"policy": SemiSplay()}):
+      s = SplayTree(**options)
+      ref = {}
+      views = []
+      for i in range(randint(300, 600)):
+        a = randint(-200, 200)
+        if i % 50 == 0:
+          views.append((s.snapshot(), list(s.items())))
+        if randint(0, 2):
+          s.insert(a, i)
+          ref[a] = i
+        else:
+          self.assertEqual(s.remove(a), ref.pop(a, None))
+        s.find(randint(-200, 200))
+        if i % 40 == 0:
+          lo, hi = sorted((randint(-200, 200), randint(-200, 200)))
+          for k in list(s.irange(lo, hi)):
+            del ref[k]
+          s.removeRange(lo, hi)
+        if i % 30 == 0:
+          s.insertMany(((randint(-200, 200), i) for j in range(5)), True)
+          ref = dict(s.items())
+      self.assertEqual(dict(s.items()), ref)
+      if s._orderStatistics:
+        self.assertEqual(self.checkSizes(s._root), len(ref))
+        self.assertEqual(s.aggregate(), sum(ref.values()))
+      for view, items in views:
+        self.assertEqual(list(view.items()), items)
+        self.assertEqual(len(view), len(items))
+        self.assertEqual(list(reversed(view)), [k for k, v in items][::-1])
+        for k, v in items[::7]:
+          self.assertEqual(view.find(k), v)
+          self.assertTrue(k in view)
+        lo, hi = sorted((randint(-200, 200), randint(-200, 200)))
+        self.assertEqual(list(view.irange(lo, hi)), \
+          list(SplayTree.fromItems(items, **options).irange(lo, hi)))
+      view = items = None
+      del views[:]
+      self.assertIsNone(s._owned)
+
+  def testCopies(self):
+    """Test that writes copy only the paths they splay."""
+
+    s = SplayTree.fromSorted(((k, k) for k in range(1023)), \
+      orderStatistics=True)
+    view = s.snapshot()
+    shared = set(map(id, self.nodes(view._root)))
+    s.insert(511.5, None)
+    s.remove(100)
+    s.find(900)
+    copied = [n for n in self.nodes(s._root) if id(n) not in shared]
+    self.assertTrue(len(copied) < 60)
+    self.assertEqual(self.checkSizes(s._root), 1023)
+    self.assertEqual(list(view), list(range(1023)))
+    self.assertEqual(s.select(100), 101)
+
+  def testSplitJoin(self):
+    """Test that split halves and joined trees keep copying for the view."""
+
+    s = SplayTree.fromSorted(((k, -k) for k in range(200)))
+    view = s.snapshot()
+    left, right = s.split(100)
+    left.insert(50, None)
+    right.remove(150)
+    left.join(right)
+    self.assertEqual(list(view.items()), [(k, -k) for k in range(200)])
+    self.assertEqual(len(left), 199)
+    self.assertEqual(left.find(50), None)
+    other = SplayTree.fromSorted(((k, k) for k in range(300, 310)))
+    otherView = other.snapshot()
+    left.join(other)
+    left.removeRange(290, 320)
+    self.assertEqual(list(otherView), list(range(300, 310)))
+    del view, otherView
+    self.assertIsNone(left._owned)
+
+  def testCursor(self):
+    """Test that copying nodes invalidates cursors but not their own writes."""
+
+    s = SplayTree.fromSorted((k, k) for k in range(100))
+    view = s.snapshot()
+    c = s.seek(40)
+    c.setValue(None)
+    c.delete()
+    self.assertEqual(c.key, 41)
+    s.find(90)
+    self.assertRaises(RuntimeError, c.next)
+    self.assertEqual(view.find(40), 40)
+    self.assertFalse(40 in s)
+    self.assertEqual(len(list(s)), 99)
+
+class TestSplayPolicy(unittest.TestCase):
+  """Test the configurable splay policies and the non-splaying find()."""
+
+  def shape(self, s):
+    """Return the tree as a nested tuple of keys."""
+
+    def walk(n):
+      return n and (n.key, walk(n.left), walk(n.right))
+    return walk(s._root)
+
+  def testPolicies(self):
+    """Test that every policy keeps find() consistent with a dict."""
+
+    policies = [FullSplay(), SemiSplay(), DepthSplay(), DepthSplay(1, True), \
+      RandomSplay(0.3, seed=7), RandomSplay(0.5, semi=True)]
+    for policy in policies:
+      for topDown in (False, True):
+        s = SplayTree(topDown=topDown, orderStatistics=True, policy=policy)
+        ref = {}
+        for i in range(randint(300, 600)):
+          a = randint(-300, 300)
+          if randint(0, 3):
+            s.insert(a, i)
+            ref[a] = i
+          else:
+            self.assertEqual(s.remove(a), ref.pop(a, None))
+          a = randint(-300, 300)
+          self.assertEqual(s.find(a), ref.get(a))
+        keys = [randint(-300, 300) for i in range(200)]
+        self.assertEqual(s.findMany(keys, True), [ref.get(k) for k in keys])
+        self.assertEqual(list(s.items()), sorted(ref.items()))
+        for i, k in enumerate(sorted(ref)):
+          self.assertEqual(s.select(i), k)
+
+  def testSemiSplay(self):
+    """Test that semi-splaying a deep node roughly halves its depth."""
+
+    s = SplayTree()
+    for i in range(1024):
+      s.insert(i, i) #leaves a path of left children
+    node = s.minNode(s._root)
+    s.semiSplay(node)
+    depth = 0
+    while node.parent:
+      depth += 1
+      node = node.parent
+    self.assertTrue(depth <= 512)
+    self.assertEqual(list(s), list(range(1024)))
+
+  def testNoSplay(self):
+    """Test that non-splaying reads leave the shape of the tree alone."""
+
+    s = SplayTree(policy=RandomSplay(0))
+    for i in range(200):
+      s.insert(randint(-1000, 1000), i)
+    shape = self.shape(s)
+    for i in range(200):
+      s.find(randint(-1000, 1000))
+    self.assertEqual(self.shape(s), shape)
+
+    s = SplayTree(policy=DepthSplay(1000))
+    for i in range(200):
+      s.insert(i, i)
+    shape = self.shape(s)
+    self.assertEqual(s.find(0), 0)
+    self.assertEqual(self.shape(s), shape)
+
+    s = SplayTree(topDown=True)
+    for i in range(200):
+      s.insert(randint(-1000, 1000), i)
+    shape = self.shape(s)
+    for k in list(s):
+      self.assertIsNotNone(s.find(k, splay=False))
+    self.assertEqual(self.shape(s), shape)
+
+class Counted(object):
+  """A key that counts the comparisons made against it."""
+
+  comparisons = 0
+
+  def __init__(self, n):
+    self.n = n
+
+  def __lt__(self, other):
+    Counted.comparisons += 1
+    return self.n < other.n
+
+  def __eq__(self, other):
+    Counted.comparisons += 1
+    return self.n == other.n
+
+  def __ne__(self, other):
+    return not self == other
+
+class Unordered(object):
+  """A key that refuses to be compared, which every tree rejects."""
+
+  def __lt__(self, other):
+    raise TypeError("unordered key")
+
+  __gt__ = __lt__
+
+class TestSplayKey(unittest.TestCase):
+  """Test key functions and the number of comparisons per search."""
+
+  def testComparisons(self):
+    """Test that a search makes at most two comparisons per level."""
+
+    for topDown in (False, True):
+      s = SplayTree(topDown=topDown)
+      for i in range(randint(100, 200)):
+        s.insert(Counted(randint(-1000, 1000)), i)
+      for i in range(100):
+        key = Counted(randint(-1000, 1000))
+        height = s.height()
+        Counted.comparisons = 0
+        if topDown:
+          node = s.topDownSplay(key)
+        else:
+          node = s.binaryHelper(key, s._root)
+        self.assertTrue(Counted.comparisons <= 2*height)
+        self.assertEqual(node.key == key, s.find(key) is not None)
+
+  def testHotKey(self):
+    """Test that a search stops at a key equal to the one searched for."""
+
+    for topDown in (False, True):
+      s = SplayTree(topDown=topDown)
+      for i in range(500): #ascending inserts leave a path below the root
+        s.insert(Counted(i), i)
+      s.find(Counted(0))
+      for i in range(20):
+        Counted.comparisons = 0
+        self.assertEqual(s.find(Counted(0)), 0)
+        self.assertTrue(Counted.comparisons <= 3)
+
+  def testKeyFunction(self):
+    """Test that a tree orders by derived keys and returns original keys."""
+
+    for options in ({}, {"topDown": True}, {"nodeType": CompactNode}, \
+                    {"orderStatistics": True}):
+      calls = []
+      def lower(key):
+        calls.append(key)
+        return key.lower()
+      s = SplayTree(key=lower, **options)
+      for k in ["b", "A", "c", "D"]:
+        s.insert(k, k*2)
+      self.assertEqual(len(calls), 4)
+      self.assertEqual(list(s), ["A", "b", "c", "D"])
+      self.assertEqual(s.find("d"), "DD")
+      self.assertTrue("C" in s)
+      s.insert("B", "BB") #equal sort keys are duplicates
+      self.assertEqual(len(s), 4)
+      self.assertEqual(list(s.items())[1], ("B", "BB"))
+      self.assertEqual(list(s.irange("a", "C")), ["A", "B", "c"])
+      self.assertEqual(s.floor("bb"), ("B", "BB"))
+      self.assertEqual(s.higher("C"), ("D", "DD"))
+      self.assertEqual(s.remove("c"), "c"*2)
+      self.assertEqual(list(reversed(s)), ["D", "B", "A"])
+      if s._orderStatistics:
+        self.assertEqual(s.rank("d"), 2)
+        self.assertEqual(s.select(1), "B")
+      left, right = s.split("b")
+      self.assertEqual((list(left), list(right)), (["A"], ["B", "D"]))
+      left.join(right)
+      self.assertRaises(ValueError, left.join, SplayTree())
+
+  def testKeyBulk(self):
+    """Test bulk construction, batches, sets and snapshots with a key."""
+
+    neg = lambda key: -key
+    ref = dict((randint(-1000, 1000), i) for i in range(300))
+    s = SplayTree.fromItems(ref.items(), key=neg)
+    self.assertEqual(list(s), sorted(ref, reverse=True))
+    self.assertRaises(ValueError, SplayTree.fromSorted, [(1, 1), (2, 2)], \
+      key=neg)
+    keys = list(ref)[:50] + [5000]
+    self.assertEqual(s.findMany(keys, sort=True), \
+      [ref.get(k) for k in keys])
+    s.insertMany([(5000, 1), (-5000, 2)], sort=True)
+    self.assertEqual(list(s)[0], 5000)
+    a = SplaySet([1, 2, 3], key=neg)
+    self.assertEqual(list(a | [4, 0]), [4, 3, 2, 1, 0])
+    self.assertEqual(list(a - SplaySet([2], key=neg)), [3, 1])
+    self.assertRaises(ValueError, a.union, SplaySet([2]))
+    self.assertEqual(a.popMin(), 3)
+    self.assertRaises(ValueError, ShardedSplayMap, key=neg)
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      s.dump(path)
+      for mmap in (False, True):
+        t = SplayTree.load(path, mmap=mmap, key=neg)
+        self.assertEqual(list(t), list(s))
+        self.assertEqual(t.find(5000), 1)
+        self.assertTrue(-5000 in t)
+        self.assertEqual(list(t.irange(10, -10)), \
+          sorted((k for k in s if -10 <= k <= 10), reverse=True))
+        if mmap:
+          t.close()
+    finally:
+      os.remove(path)
+
+class TestShardedSplayMap(unittest.TestCase):
+  """Test the sharded map against a python dict."""
+
+  def maps(self):
+    """Return a range sharded and a hash sharded map."""
+
+    return [ShardedSplayMap(boundaries=[-500, 0, 500]), \
+      ShardedSplayMap(shards=4)]
+
+  def testInterface(self):
+    """Test single key and batch operations and ordered iteration."""
+
+    for m in self.maps():
+      ref = {}
+      for i in range(randint(300, 600)):
+        a = randint(-1000, 1000)
+        m.insert(a, i)
+        ref[a] = i
+      items = [(randint(-1000, 1000), i) for i in range(300)]
+      m.insertMany(items)
+      ref.update(items)
+      self.assertEqual(len(m), len(ref))
+      keys = [randint(-1100, 1100) for i in range(300)]
+      self.assertEqual(m.findMany(keys), [ref.get(k) for k in keys])
+      for k in keys[:50]:
+        self.assertEqual(m.remove(k), ref.pop(k, None))
+      keys = keys[50:]
+      self.assertEqual(m.removeMany(keys), [ref.pop(k, None) for k in keys])
+      self.assertEqual(list(m.items()), sorted(ref.items()))
+      self.assertEqual(list(m), sorted(ref))
+      for k in ref:
+        self.assertTrue(k in m)
+
+  def testRebalance(self):
+    """Test that rebalance() moves boundaries without losing entries."""
+
+    m = ShardedSplayMap(boundaries=[100, 200, 300])
+    m.insertMany((i, i) for i in range(1000))
+    self.assertEqual(m.sizes(), [100, 100, 100, 700])
+    while m.rebalance(1.5):
+      pass
+    self.assertTrue(max(m.sizes()) <= 1.5 * 250)
+    self.assertEqual(list(m.items()), [(i, i) for i in range(1000)])
+    for i in range(1000):
+      self.assertEqual(m.find(i), i)
+    self.assertFalse(ShardedSplayMap(shards=2).rebalance())
+
+  def testIterateRebalance(self):
+    """Test that iteration sees every key once across a rebalance()."""
+
+    for keys in (list(range(2, 120)), list(range(-80, 15))):
+      m = ShardedSplayMap(boundaries=[10, 100])
+      m.insertMany((k, k) for k in keys)
+      items = m.items()
+      first = [next(items)]
+      self.assertTrue(m.rebalance(1.1))
+      self.assertEqual(first + list(items), [(k, k) for k in keys])
+
+  def testThreads(self):
+    """Test that concurrent writers and a rebalancer keep every entry."""
+
+    m = ShardedSplayMap(boundaries=[250, 500, 750])
+    def writer(start):
+      for i in range(start, 1000, 4):
+        m.insert(i, i)
+        self.assertEqual(m.find(i), i)
+    def rebalancer():
+      for i in range(50):
+        m.rebalance(1.1)
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(4)]
+    threads.append(threading.Thread(target=rebalancer))
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(list(m), list(range(1000)))
+
+@unittest.skipIf(splay_hybrid.numpy is None, "needs numpy")
+class TestHybridSplayMap(unittest.TestCase):
+  """Test the NumPy base run and SplayTree delta hybrid."""
+
+  def churn(self, m, ref):
+    """Randomly write and read m and the dictionary ref in step."""
+
+    for i in range(randint(300, 600)):
+      a = randint(0, 999)
+      if randint(0, 2):
+        m.insert(a, float(i))
+        ref[a] = float(i)
+      else:
+        self.assertEqual(m.remove(a), ref.pop(a, None))
+      a = randint(0, 999)
+      self.assertEqual(m.find(a), ref.get(a))
+      self.assertEqual(a in m, a in ref)
+      self.assertEqual(len(m), len(ref))
+
+  def testInterface(self):
+    """Test the map against a dictionary across compactions."""
+
+    numpy = splay_hybrid.numpy
+    for threshold in (1, 7, 100, 10000):
+      keys = [randint(0, 999) for i in range(300)]
+      m = HybridSplayMap(keys, [float(k) for k in keys], threshold, \
+        dtype=numpy.int64)
+      ref = dict((k, float(k)) for k in keys)
+      self.churn(m, ref)
+      self.assertEqual(list(m.items()), sorted(ref.items()))
+      self.assertEqual(list(m), sorted(ref))
+      m.compact()
+      self.assertEqual(len(m._delta), 0)
+      self.assertEqual(list(m.items()), sorted(ref.items()))
+    self.assertRaises(ValueError, HybridSplayMap, key=abs)
+    self.assertRaises(ValueError, HybridSplayMap, [1, 2], [1])
+
+  def testKeyType(self):
+    """Test that keys the base run cannot hold exactly are rejected."""
+
+    m = HybridSplayMap([1, 2, 3, 4], "abcd", dtype="int64")
+    for key in (2.5, "x", 2**70):
+      self.assertRaises(ValueError, m.insert, key, "x")
+    m.insert(5.0, "e")
+    m.compact()
+    self.assertEqual(len(m), 5)
+    self.assertEqual(list(m.items()), list(zip(range(1, 6), "abcde")))
+
+  def testFindMany(self):
+    """Test vectorized lookups over the base, the delta and tombstones."""
+
+    numpy = splay_hybrid.numpy
+    keys = numpy.arange(0, 2000, 2)
+    m = HybridSplayMap(keys, keys * 10, threshold=50, valueDtype=numpy.int64)
+    ref = dict((k, k * 10) for k in range(0, 2000, 2))
+    for i in range(120):
+      a = randint(0, 1999)
+      if randint(0, 1):
+        m.insert(a, -a)
+        ref[a] = -a
+      else:
+        m.remove(a)
+        ref.pop(a, None)
+    probe = numpy.array([randint(-10, 2010) for i in range(500)])
+    self.assertEqual(list(m.findMany(probe)), \
+      [ref.get(k) for k in probe.tolist()])
+    found = m.findMany(probe, default=-1)
+    self.assertEqual(found.dtype, numpy.int64)
+    self.assertEqual(found.tolist(), [ref.get(k, -1) for k in probe.tolist()])
+    self.assertEqual(HybridSplayMap().findMany([1, 2]).tolist(), [None, None])
+
+  def testBackground(self):
+    """Test that background merges keep the map consistent."""
+
+    m = HybridSplayMap(threshold=5, background=True, dtype="int64")
+    ref = {}
+    self.churn(m, ref)
+    m.wait()
+    self.assertIsNone(m._merger)
+    self.assertEqual(list(m.items()), sorted(ref.items()))
+    m.compact()
+    self.assertEqual(len(m._layers[1][0]), len(ref))
+
+class TestSplayCache(unittest.TestCase):
+  """Test the bounded splay cache and its memoization decorator."""
+
+  def testBounded(self):
+    """Test that the cache stays within maxsize and keeps a hot key."""
+
+    c = SplayCache(50)
+    hot = 2147483648
+    c.put(hot, None)
+    ref = {}
+    for i in range(randint(500, 1000)):
+      a = randint(-10000, 10000)
+      c.put(a, i)
+      ref[a] = i
+      self.assertTrue(len(c) <= 50)
+      self.assertIsNone(c.get(hot, 0)) #a cached None is still a hit
+    for k, v in c.items():
+      if k != hot:
+        self.assertEqual(ref[k], v)
+    info = c.info()
+    self.assertEqual(info.currsize, 50)
+    self.assertTrue(info.evictions >= len(ref) + 1 - 50)
+    self.assertEqual(info.misses, 0)
+    c.clear()
+    self.assertEqual(len(c), 0)
+    self.assertEqual(c.info().hits, 0)
+
+  def testCounters(self):
+    """Test that hits, misses and evictions are counted."""
+
+    c = SplayCache(2)
+    c.put(1, 1)
+    c.put(2, 2)
+    self.assertEqual(c.get(1), 1)
+    self.assertEqual(c.get(3, "x"), "x")
+    c.put(3, 3)
+    self.assertEqual(c.info(), (1, 1, 1, 2, 2))
+    self.assertIsNotNone(c.evict())
+    self.assertEqual(len(c), 1)
+    self.assertTrue(SplayCache(None).maxsize is None)
+    self.assertRaises(ValueError, SplayCache, 0)
+
+  def testDecorator(self):
+    """Test that splayCached memoizes by positional and keyword arguments."""
+
+    calls = []
+    @splayCached(maxsize=64)
+    def fib(n, offset=0):
+      calls.append(n)
+      return n + offset if n < 2 else fib(n-1, offset) + fib(n-2, offset)
+
+    self.assertEqual(fib(60), 1548008755920)
+    self.assertEqual(len(calls), 61)
+    self.assertEqual(fib(60), 1548008755920)
+    self.assertEqual(len(calls), 61)
+    self.assertEqual(fib(5, offset=1), 13)
+    self.assertEqual(fib.__name__, "fib")
+    self.assertTrue(fib.cacheInfo().hits > 0)
+    fib.cacheClear()
+    self.assertEqual(fib.cacheInfo().currsize, 0)
+
+class TestSplaySet(unittest.TestCase):
+  """Test the key-only splay set."""
+
+  def testMembership(self):
+    """Test add, discard, remove and membership against a built-in set."""
+
+    s = SplaySet()
+    ref = set()
+    for i in range(randint(500, 1000)):
+      a = randint(-500, 500)
+      if randint(0, 2):
+        s.add(a)
+        ref.add(a)
+      elif a in ref:
+        s.remove(a)
+        ref.remove(a)
+      else:
+        self.assertRaises(KeyError, s.remove, a)
+        s.discard(a)
+      self.assertEqual(len(s), len(ref))
+    for a in range(-500, 501):
+      self.assertEqual(a in s, a in ref)
+    self.assertEqual(list(s), sorted(ref))
+    self.assertEqual(list(reversed(s)), sorted(ref, reverse=True))
+    self.assertEqual(list(s.irange(-100, 100)), \
+      sorted(a for a in ref if -100 <= a <= 100))
+    self.assertFalse(hasattr(s._tree._root, "__dict__"))
+
+  def testPop(self):
+    """Test that popMin and popMax drain the set from either end."""
+
+    keys = set(randint(-1000, 1000) for i in range(200))
+    s = SplaySet(keys, orderStatistics=True)
+    self.assertEqual(s.popMin(), min(keys))
+    self.assertEqual(s.popMax(), max(keys))
+    self.assertEqual(len(s), len(keys) - 2)
+    while len(s):
+      s.popMin()
+    self.assertRaises(KeyError, s.popMin)
+    self.assertRaises(KeyError, s.popMax)
+
+  def testSetOperations(self):
+    """Test union, intersection and difference against built-in sets."""
+
+    for topDown in (False, True):
+      a = set(randint(0, 300) for i in range(randint(0, 200)))
+      b = set(randint(0, 300) for i in range(randint(0, 200)))
+      x, y = SplaySet(a, topDown=topDown), SplaySet(b)
+      self.assertEqual(list(x | y), sorted(a | b))
+      self.assertEqual(list(x & y), sorted(a & b))
+      self.assertEqual(list(x - y), sorted(a - b))
+      self.assertEqual(list(x.union(list(b) + list(b))), sorted(a | b))
+      self.assertEqual(list(x.difference(b)), sorted(a - b))
+      result = x & y
+      self.assertEqual(result._tree._topDown, topDown)
+      for k in a & b:
+        self.assertTrue(k in result)
+      self.assertEqual(list(x), sorted(a)) #operands are left unchanged
+
+  def testNoneValues(self):
+    """Test that membership no longer misses entries whose value is None."""
+
+    t = SplayTree()
+    t.insert(1, None)
+    self.assertTrue(1 in t)
+    self.assertFalse(2 in t)
+    m = ShardedSplayMap()
+    m.insert(1, None)
+    self.assertTrue(1 in m)
+    self.assertFalse(2 in m)
+
+class TestSplaySnapshot(unittest.TestCase):
+  """Test dumping trees to snapshot files and loading them back."""
+
+  def setUp(self):
+    fd, self.path = tempfile.mkstemp()
+    os.close(fd)
+    self.s = SplayTree()
+    self.ref = {}
+    for i in range(randint(200, 500)):
+      a = randint(-1000, 1000)
+      self.s.insert(a, str(i))
+      self.ref[a] = str(i)
+    self.s.insert(-2000, None)
+    self.ref[-2000] = None
+
+  def tearDown(self):
+    os.remove(self.path)
+
+  def shape(self, s):
+    """Return the tree as a nested tuple of keys."""
+
+    def walk(n):
+      return n and (n.key, walk(n.left), walk(n.right))
+    return walk(s._root)
+
+  def testShaped(self):
+    """Test that a snapshot restores entries and the splayed shape."""
+
+    self.s.dump(self.path)
+    t = SplayTree.load(self.path, orderStatistics=True, nodeType=CompactNode)
+    self.assertEqual(self.shape(t), self.shape(self.s))
+    self.assertEqual(list(t.items()), sorted(self.ref.items()))
+    self.assertEqual(len(t), len(self.ref))
+    self.assertEqual(t.select(len(t) // 2), sorted(self.ref)[len(t) // 2])
+    self.assertIsNone(t._root.parent)
+
+  def testBalanced(self):
+    """Test that a balanced snapshot loads as a shallow tree."""
+
+    self.s.dump(self.path, balanced=True)
+    t = SplayTree.load(self.path)
+    self.assertEqual(list(t.items()), sorted(self.ref.items()))
+
+    def height(n):
+      return n and 1 + max(height(n.left), height(n.right)) or 0
+    self.assertTrue(height(t._root) <= len(t).bit_length())
+    SplayTree().dump(self.path)
+    self.assertEqual(len(SplayTree.load(self.path)), 0)
+
+  def testMapped(self):
+    """Test lookups served from a memory mapped snapshot."""
+
+    self.s.dump(self.path)
+    t = SplayTree.load(self.path, mmap=True)
+    self.assertIsInstance(t, MappedSplayTree)
+    self.assertEqual(len(t), len(self.ref))
+    for i in range(300):
+      a = randint(-1100, 1100)
+      self.assertEqual(t.find(a), self.ref.get(a))
+    keys = sorted(self.ref)
+    for i in range(50):
+      lo, hi = sorted((randint(-1100, 1100), randint(-1100, 1100)))
+      for inc in ((True, True), (False, False)):
+        self.assertEqual(list(t.irange(lo, hi, inc)), \
+          list(self.s.irange(lo, hi, inc)))
+    self.assertEqual(list(t.items()), sorted(self.ref.items()))
+    self.assertIsNone(t._tree)
+
+    t.insert(5000, "x") #the first write builds the tree
+    self.assertIsNotNone(t._tree)
+    self.assertEqual(t.remove(-2000), None)
+    self.assertEqual(len(t), len(self.ref))
+    self.assertEqual(list(t)[-1], 5000)
+    t.close()
+
+  def testCorrupt(self):
+    """Test that loading a file that is not a snapshot raises ValueError."""
+
+    with open(self.path, "wb") as f:
+      f.write(b"not a snapshot at all")
+    self.assertRaises(ValueError, SplayTree.load, self.path)
+
+class TestJournaledSplayTree(unittest.TestCase):
+  """Test journaling writes and recovering them after a crash."""
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def fill(self, j, ref):
+    """Apply random inserts and removes to j and ref."""
+
+    for i in range(randint(200, 400)):
+      a = randint(-300, 300)
+      if randint(0, 3):
+        j.insert(a, str(i))
+        ref[a] = str(i)
+      else:
+        self.assertEqual(j.remove(a), ref.pop(a, None))
+
+  def testRecover(self):
+    """Test that every policy replays its writes after reopening."""
+
+    for sync in (splay_journal.SYNC_ALWAYS, splay_journal.SYNC_INTERVAL, \
+                 splay_journal.SYNC_GROUP):
+      j = JournaledSplayTree(os.path.join(self.path, sync), sync, 0.001)
+      ref = {}
+      self.fill(j, ref)
+      j.insertMany([(a, -a) for a in range(1000, 1100)])
+      ref.update((a, -a) for a in range(1000, 1100))
+      self.assertEqual(j.removeMany([1000, 5000]), [-1000, None])
+      del ref[1000]
+      self.assertEqual(list(j.items()), sorted(ref.items()))
+      j.close()
+      j = JournaledSplayTree(os.path.join(self.path, sync), sync)
+      self.assertEqual(list(j.items()), sorted(ref.items()))
+      self.assertEqual(len(j), len(ref))
+      j.close()
+
+  def testGroup(self):
+    """Test that group commit writes nothing until commit()."""
+
+    j = JournaledSplayTree(self.path, splay_journal.SYNC_GROUP)
+    j.insert(1, "a")
+    j.commit()
+    j.insert(2, "b")
+    self.assertEqual(j.find(2), "b")
+    j._pending = [] #a crash before the commit loses the insert
+    j.close()
+    j = JournaledSplayTree(self.path)
+    self.assertEqual(list(j.items()), [(1, "a")])
+    j.close()
+
+  def testTorn(self):
+    """Test that a torn or corrupt record ends the journal."""
+
+    j = JournaledSplayTree(self.path)
+    ref = {}
+    self.fill(j, ref)
+    j.close()
+    journal = os.path.join(self.path, "journal.%08d" % 0)
+    size = os.path.getsize(journal)
+    with open(journal, "ab") as f:
+      f.write(j._record(splay_journal.INSERT, 5000, "torn")[:-1])
+    j = JournaledSplayTree(self.path)
+    self.assertEqual(list(j.items()), sorted(ref.items()))
+    self.assertEqual(os.path.getsize(journal), size)
+    j.insert(5000, "whole")
+    j.close()
+    record = bytearray(j._record(splay_journal.INSERT, 6000, "bad"))
+    record[-2] ^= 0xFF
+    with open(journal, "ab") as f:
+      f.write(bytes(record))
+    j = JournaledSplayTree(self.path)
+    ref[5000] = "whole"
+    self.assertEqual(list(j.items()), sorted(ref.items()))
+    j.close()
+
+  def testCheckpoint(self):
+    """Test that checkpoints replace the journals they cover."""
+
+    j = JournaledSplayTree(self.path, checkpointBytes=2000)
+    ref = {}
+    for i in range(5):
+      self.fill(j, ref)
+      self.assertEqual(list(j.items()), sorted(ref.items()))
+    j.checkpoint(wait=True)
+    self.assertIsNone(j.tree._owned)
+    self.fill(j, ref)
+    j.close()
+    names = sorted(os.listdir(self.path))
+    self.assertEqual(len(names), 2)
+    self.assertEqual(names[0], "checkpoint.%08d" % j._seq)
+    self.assertEqual(names[1], "journal.%08d" % j._seq)
+    with open(os.path.join(self.path, "checkpoint.%08d.tmp" % 99), "wb") as f:
+      f.write(b"unfinished")
+    j = JournaledSplayTree(self.path)
+    self.assertEqual(list(j.items()), sorted(ref.items()))
+    self.assertEqual(len(os.listdir(self.path)), 2)
+    j.close()
+
+  def testRejected(self):
+    """Test that writes the tree rejects are never journaled."""
+
+    j = JournaledSplayTree(self.path)
+    j.insert(1, "a")
+    self.assertRaises(TypeError, j.insert, Unordered(), "b")
+    self.assertRaises(TypeError, j.insertMany, \
+      [(2, "b"), (Unordered(), "c"), (3, "d")])
+    j.close()
+    j = JournaledSplayTree(self.path)
+    self.assertEqual(list(j.items()), [(1, "a"), (2, "b")])
+    j.close()
+
+  def testRelease(self):
+    """Test that the tree stops copying nodes once a checkpoint is done."""
+
+    j = JournaledSplayTree(self.path)
+    j.insertMany([(i, i) for i in range(100)])
+    j.checkpoint()
+    j._checkpointer.join()
+    self.assertEqual(j.find(50), 50)
+    self.assertIsNone(j.tree._owned)
+    self.assertIsNone(j._view)
+    j.close()
+
+  def testBadPolicy(self):
+    """Test that an unknown sync policy raises ValueError."""
+
+    self.assertRaises(ValueError, JournaledSplayTree, self.path, "never")
+
+def frozenLookup(args):
+  """Look a key up in a frozen tree from a pool worker."""
+
+  frozen, key = args
+  try:
+    return frozen.find(key), frozen.floor(key), list(frozen.irange(key))
+  finally:
+    frozen.close()
+
+@unittest.skipIf(splay_tree.shared_memory is None, "needs shared_memory")
+class TestSplayFrozen(unittest.TestCase):
+  """Test trees frozen into shared memory."""
+
+  def setUp(self):
+    self.s = SplayTree()
+    self.ref = {}
+    for i in range(300):
+      a = randint(-1000, 1000)
+      self.s.insert(a, str(a))
+      self.ref[a] = str(a)
+    self.frozen = self.s.freeze()
+
+  def tearDown(self):
+    self.frozen.close()
+    self.frozen.unlink()
+
+  def testLookups(self):
+    """Test lookups, neighbour queries and scans against the tree."""
+
+    f = self.frozen
+    self.assertEqual(len(f), len(self.ref))
+    self.assertEqual(list(f.items()), list(self.s.items()))
+    for i in range(200):
+      a = randint(-1100, 1100)
+      self.assertEqual(f.find(a), self.ref.get(a))
+      self.assertEqual(a in f, a in self.ref)
+      for name in ("floor", "ceiling", "lower", "higher"):
+        self.assertEqual(getattr(f, name)(a, "none"), \
+          getattr(self.s, name)(a, "none"))
+      self.assertEqual(list(f.irange(a, a + 100)), \
+        list(self.s.irange(a, a + 100)))
+    self.assertRaises(TypeError, f.insert, 1, 1)
+    self.assertRaises(TypeError, f.remove, 1)
+
+  def testShared(self):
+    """Test that pickled frozen trees attach to the same block."""
+
+    copy = pickle.loads(pickle.dumps(self.frozen))
+    self.assertEqual(copy.name, self.frozen.name)
+    self.assertEqual(list(copy), list(self.s))
+    copy.close()
+    keys = list(self.ref)[:4]
+    pool = multiprocessing.Pool(2)
+    try:
+      results = pool.map(frozenLookup, [(self.frozen, k) for k in keys])
+    finally:
+      pool.close()
+      pool.join()
+    for k, result in zip(keys, results):
+      self.assertEqual(result, (self.ref[k], (k, self.ref[k]), \
+        list(self.s.irange(k))))
+
+@unittest.skipIf(SplayServer is None, "needs Python 3 asyncio")
+class TestSplayServer(unittest.TestCase):
+  """Test the asyncio server and its pooled client."""
+
+  def setUp(self):
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self.loop)
+    self.wait = self.loop.run_until_complete
+    self.server = SplayServer()
+
+  def connect(self, path=None):
+    """Start the server and return a client connected to it."""
+
+    address = self.wait(self.server.start(path=path))
+    return self.wait(SplayClient.connect(path=path, \
+      port=None if path else address[1], size=3))
+
+  def tearDown(self):
+    self.wait(self.client.close())
+    self.wait(self.server.close())
+    self.loop.close()
+    asyncio.set_event_loop(None)
+
+  def testPipelined(self):
+    """Test concurrent pipelined requests against a dictionary."""
+
+    client = self.client = self.connect()
+    ref = dict((k, -k) for k in range(0, 400, 2))
+    self.wait(client.insertMany(ref.items()))
+    keys = [randint(-10, 410) for i in range(300)]
+    self.assertEqual(self.wait(client.findMany(keys)), \
+      [ref.get(k) for k in keys])
+    gone = list(range(0, 100, 4))
+    self.assertEqual(self.wait(client.removeMany(gone)), [-k for k in gone])
+    for k in gone:
+      del ref[k]
+    self.assertEqual(self.wait(client.length()), len(ref))
+    self.assertEqual(self.wait(client.range(100, 120, (True, False))), \
+      sorted((k, v) for k, v in ref.items() if 100 <= k < 120))
+    self.assertTrue(self.server.batches < self.server.requests)
+    self.assertEqual(self.server.tree.find(2), -2)
+
+  def testErrors(self):
+    """Test that a failing request raises and the others still succeed."""
+
+    client = self.client = self.connect()
+    self.wait(client.insert(1, "one"))
+    results = self.wait(asyncio.gather(client.insert("a", 1), \
+      client.find(1), return_exceptions=True))
+    self.assertIsInstance(results[0], TypeError)
+    self.assertEqual(results[1], "one")
+
+  def testRemoveError(self):
+    """Test that removes before a failing remove answer their values."""
+
+    client = self.client = self.connect()
+    self.wait(client.insertMany([((1, "a"), "A"), ((3, None), "C")]))
+    results = self.wait(asyncio.gather(client.remove((1, "a")), \
+      client.remove((3, "x")), return_exceptions=True))
+    self.assertEqual(results[0], "A") #not removed again after the error
+    self.assertIsInstance(results[1], TypeError)
+
+  def testClose(self):
+    """Test closing the server with clients still connected."""
+
+    client = self.client = self.connect()
+    self.wait(client.insertMany([(k, str(k)) for k in range(10)]))
+    self.assertEqual(self.wait(client.range(3, 5)), \
+      [(3, "3"), (4, "4"), (5, "5")])
+    self.wait(asyncio.wait_for(self.server.close(), 5))
+    for connection in client._connections:
+      self.wait(asyncio.wait_for(connection._receiver, 5))
+    self.assertRaises(ConnectionError, self.wait, \
+      asyncio.wait_for(client.find(1), 5))
+
+  def testUnixSocket(self):
+    """Test serving over a Unix socket."""
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "splay.sock")
+    try:
+      client = self.client = self.connect(path)
+      self.wait(client.insert("key", "value"))
+      self.assertEqual(self.wait(client.find("key")), "value")
+      self.assertEqual(self.wait(client.remove("key")), "value")
+    finally:
+      os.remove(path)
+      os.rmdir(directory)
+
+class TestSplayBench(unittest.TestCase):
+  """Test that the benchmark harness is reproducible and reports results."""
+
+  def testWorkloads(self):
+    """Test that every workload is seeded and stays inside the key space."""
+
+    for name in splay_bench.WORKLOADS:
+      a = splay_bench.operations(name, 100, 500, 3, (1, 8, 1))
+      self.assertEqual(a, splay_bench.operations(name, 100, 500, 3, (1, 8, 1)))
+      self.assertEqual(len(a), 500)
+      for op, key in a:
+        self.assertTrue(op in (0, 1, 2))
+        self.assertTrue(0 <= key < 200)
+
+  def testBenchmark(self):
+    """Test that a benchmark result has timings and rotation counts."""
+
+    for name in splay_bench.STRUCTURES:
+      result = splay_bench.benchmark("zipfian", name, 100, 300, 1, (1, 8, 1))
+      self.assertEqual(result["structure"], name)
+      self.assertTrue(result["seconds"] >= 0)
+      if name.startswith("splay"):
+        self.assertTrue(result["rotations"] > 0)
+        self.assertEqual(result["rotations"], result["zig"] + \
+          2*(result["zigZig"] + result["zigZag"]))
+
 if __name__ == "__main__":
   unittest.main()